@@ -0,0 +1,306 @@
+# Whole-ROM analysis
+#
+# Finds the functions, basic blocks and cross-references of the ROM without
+# running it. Code is found by following control flow from the reset, BRK,
+# interrupt and SWI vectors and from every BL Cadr target that a linear sweep
+# over the ROM turns up. Only the nX-U8 instructions that matter for control
+# flow and absolute data accesses are decoded here, everything else is stepped
+# over by its length.
+#
+# The sweep can take data for a BL, and code that is only reached through
+# B ERn / BL ERn (jump tables, function pointers) is not found unless a BL
+# elsewhere points at it. Data references are the L/ST Dadr and SB/RB/TB
+# Dbitadr forms; their segment is taken from a DSR prefix with an immediate
+# right before them, else it is 0. Code in fx-5800P flash is not analysed.
+#
+# Results are cached per ROM (native byte order):
+#   header   magic, format version (u16), ROM SHA-256
+#   data     zlib compressed u32 arrays, each preceded by its length (u32):
+#            block starts, block ends, function starts,
+#            code reference targets, sites, kinds (sorted by target),
+#            data reference addresses, sites, kinds (sorted by address)
+#
+# Usage:
+#   analysis.py [-c config] [--rebuild]       list the functions and how often they are called
+#   analysis.py [-c config] <label or CSR:PC>...
+#                                             callers of a function, readers and writers of data
+
+import os
+import sys
+import time
+import array
+import bisect
+import struct
+import logging
+import argparse
+import zlib
+
+MAGIC = b'U8AN'
+VERSION = 1
+
+header = struct.Struct('<4sH32s')
+
+# code reference kinds
+CALL = 0   # BL Cadr
+JUMP = 1   # B Cadr
+# data reference kinds
+READ = 0
+WRITE = 1
+
+# per code halfword
+INS = 1      # an instruction starts here
+LEADER = 2   # a basic block starts here
+END = 4      # the instruction ends its basic block
+
+# Instruction length in bytes from the first opcode word
+def ins_length(w):
+	if w & 0xf0fe == 0xf000: return 4   # B/BL Cadr
+	hi = w >> 12
+	if hi == 9:
+		if w & 0xf8 == 0x10: return 4    # L/ST Rn/ERn/XRn/QRn, Dadr
+		if w & 0x1e == 0x08: return 4    # L/ST Rn, Disp16[ERm]
+	elif hi == 0xa:
+		if w & 0x11e == 0x08: return 4   # L/ST ERn, Disp16[ERm]
+		if w & 0xff8c == 0xa080 and w & 3 != 3: return 4   # SB/TB/RB Dbitadr
+	elif hi == 0xf:
+		if w & 0xff1f == 0xf00b or w == 0xf00c: return 4   # LEA Disp16[ERm], LEA Dadr
+	return 2
+
+# DSR prefix instructions, which apply to the instruction after them
+def is_dsr_prefix(w): return w & 0xff00 == 0xe300 or w & 0xff0f == 0x900f or w == 0xfe9f
+
+class Analysis:
+	def __init__(self, block_starts, block_ends, functions, code_targets, code_sites, code_kinds, data_addrs, data_sites, data_kinds):
+		self.block_starts = block_starts
+		self.block_ends = block_ends
+		self.functions = functions
+		self.code_targets = code_targets
+		self.code_sites = code_sites
+		self.code_kinds = code_kinds
+		self.data_addrs = data_addrs
+		self.data_sites = data_sites
+		self.data_kinds = data_kinds
+
+	def arrays(self): return (self.block_starts, self.block_ends, self.functions, self.code_targets, self.code_sites, self.code_kinds, self.data_addrs, self.data_sites, self.data_kinds)
+
+	# (start, end) of the basic block CSR:PC addr is in, None if it is not in analysed code
+	def block_at(self, addr):
+		i = bisect.bisect_right(self.block_starts, addr) - 1
+		if i < 0 or addr >= self.block_ends[i]: return
+		return self.block_starts[i], self.block_ends[i]
+
+	# Start of the function CSR:PC addr is in, that is the function start at or
+	# before it in the same segment, None if it is not in analysed code
+	def function_at(self, addr):
+		if self.block_at(addr) is None: return
+		i = bisect.bisect_right(self.functions, addr)
+		if i == 0 or self.functions[i - 1] >> 16 != addr >> 16: return
+		return self.functions[i - 1]
+
+	# [(site, CALL or JUMP)] of the BL and B Cadr instructions going to addr
+	def callers(self, addr):
+		lo = bisect.bisect_left(self.code_targets, addr)
+		hi = bisect.bisect_right(self.code_targets, addr, lo)
+		return [(self.code_sites[i], self.code_kinds[i]) for i in range(lo, hi)]
+
+	# [(site, READ or WRITE)] of the instructions accessing the data at DSR:addr
+	def data_refs(self, addr):
+		lo = bisect.bisect_left(self.data_addrs, addr)
+		hi = bisect.bisect_right(self.data_addrs, addr, lo)
+		return [(self.data_sites[i], self.data_kinds[i]) for i in range(lo, hi)]
+
+# Analyses the ROM image rom, mapped from 0:0000H on
+def analyse(rom):
+	words = array.array('H', rom[:len(rom) & ~1])
+	if sys.byteorder == 'big': words.byteswap()
+	n = len(words)
+	flags = bytearray(n)
+	valid = lambda addr: not addr & 1 and addr >> 1 < n
+
+	# reset, BRK, hardware interrupt and SWI vectors, all in segment 0
+	entries = {words[i] for i in range(1, min(0x80, n)) if 0x100 <= words[i] and valid(words[i])}
+	# linear sweep for BL Cadr, the vector table is not code
+	i = 0x80
+	while i < n:
+		w = words[i]
+		if w & 0xf0ff == 0xf001 and i + 1 < n:
+			target = (w & 0xf00) << 8 | words[i + 1]
+			if valid(target): entries.add(target)
+		i += ins_length(w) >> 1
+
+	functions = set(entries)
+	work = list(entries)
+	code_refs = []
+	data_refs = []
+	while work:
+		i = work.pop() >> 1
+		flags[i] |= LEADER
+		prev = 0
+		while i < n and not flags[i] & INS:
+			flags[i] |= INS
+			w = words[i]
+			size = ins_length(w) >> 1   # in halfwords
+			if i + size > n: break
+			pc = i << 1
+			next_i = i + size
+			fallthrough = True
+
+			if size == 2:
+				w2 = words[i + 1]
+				op = w & 0xf0ff
+				if op == 0xf000 or op == 0xf001:
+					target = (w & 0xf00) << 8 | w2
+					if valid(target):
+						code_refs.append((target, pc, CALL if op == 0xf001 else JUMP))
+						if op == 0xf001: functions.add(target)
+						work.append(target)
+					if op == 0xf000: fallthrough = False
+				elif w >> 12 == 9 and w & 0xf0 == 0x10 or w >> 12 == 0xa and w & 0xff8c == 0xa080:
+					kind = READ if w & 0xf001 == 0x9000 or w & 0xf003 == 0xa001 else WRITE   # L, TB
+					if not is_dsr_prefix(prev): data_refs.append((w2, pc, kind))
+					elif prev & 0xff00 == 0xe300: data_refs.append(((prev & 0xff) << 16 | w2, pc, kind))
+			elif w >> 12 == 0xc:
+				disp = w & 0xff
+				target = pc & 0xf0000 | (pc + 2 + ((disp ^ 0x80) - 0x80) * 2) & 0xffff
+				if valid(target): work.append(target)
+				flags[i] |= END
+				if w & 0xf00 == 0xe00: fallthrough = False   # BAL
+				elif next_i < n: flags[next_i] |= LEADER
+			elif w in (0xfe1f, 0xfe0f, 0xffff) or w & 0xf2ff == 0xf28e or w & 0xff1f == 0xf002:
+				fallthrough = False   # RT, RTI, BRK, POP PC, B ERn
+
+			if not fallthrough:
+				flags[i] |= END
+				break
+			prev = w
+			i = next_i
+			if not i & 0x7fff: break   # no running off the end of a segment
+		else:
+			if i < n: flags[i] |= LEADER   # joined code that was already traced
+
+	block_starts, block_ends = array.array('I'), array.array('I')
+	i = 0
+	while i < n:
+		if not flags[i] & INS:
+			i += 1
+			continue
+		start = i
+		while True:
+			f = flags[i]
+			i += ins_length(words[i]) >> 1
+			if f & END or i >= n or flags[i] & (INS | LEADER) != INS or not i & 0x7fff: break
+		block_starts.append(start << 1)
+		block_ends.append(min(i, n) << 1)
+
+	code_refs.sort()
+	data_refs.sort()
+	return Analysis(block_starts, block_ends, array.array('I', sorted(f for f in functions if flags[f >> 1] & INS)),
+		array.array('I', (r[0] for r in code_refs)), array.array('I', (r[1] for r in code_refs)), array.array('I', (r[2] for r in code_refs)),
+		array.array('I', (r[0] for r in data_refs)), array.array('I', (r[1] for r in data_refs)), array.array('I', (r[2] for r in data_refs)))
+
+def dump(path, rom_sha256, analysis):
+	with open(path + '.tmp', 'wb') as f:
+		f.write(header.pack(MAGIC, VERSION, rom_sha256))
+		f.write(zlib.compress(b''.join(struct.pack('<I', len(a)) + a.tobytes() for a in analysis.arrays()), 6))
+	os.replace(path + '.tmp', path)
+
+# Raises ValueError if path is not an analysis of the ROM with the given hash
+def load(path, rom_sha256):
+	with open(path, 'rb') as f: data = f.read()
+	if len(data) < header.size: raise ValueError(f'{path}: not a ROM analysis')
+	magic, version, sha256 = header.unpack_from(data)
+	if magic != MAGIC: raise ValueError(f'{path}: not a ROM analysis')
+	if version != VERSION: raise ValueError(f'{path}: ROM analysis format version {version} is not supported')
+	if sha256 != rom_sha256: raise ValueError(f'{path}: analysis of a different ROM')
+	try: data = memoryview(zlib.decompress(data[header.size:]))
+	except zlib.error as e: raise ValueError(f'{path}: {e}') from None
+
+	arrays = []
+	pos = 0
+	for _ in range(9):
+		if pos + 4 > len(data): raise ValueError(f'{path}: truncated ROM analysis')
+		size = struct.unpack_from('<I', data, pos)[0] * 4
+		pos += 4
+		if pos + size > len(data): raise ValueError(f'{path}: truncated ROM analysis')
+		a = array.array('I')
+		a.frombytes(data[pos:pos + size])
+		arrays.append(a)
+		pos += size
+	return Analysis(*arrays)
+
+# Loads the analysis of rom from the cache in directory, or analyses it and
+# caches the result. No cache is used if directory is None.
+def load_or_analyse(rom, rom_sha256, directory):
+	path = os.path.join(directory, f'{rom_sha256.hex()}.u8a') if directory is not None else None
+	if path is not None:
+		try: return load(path, rom_sha256)
+		except FileNotFoundError: pass
+		except (OSError, ValueError) as e: logging.warning(f'Cannot use cached ROM analysis, redoing it: {e}')
+
+	start = time.time()
+	result = analyse(rom)
+	logging.info(f'Analysed ROM in {time.time() - start:.1f} s: {len(result.functions)} functions, {len(result.block_starts)} basic blocks')
+	if path is not None:
+		try:
+			os.makedirs(directory, exist_ok = True)
+			dump(path, rom_sha256, result)
+		except OSError as e: logging.warning(f'Cannot cache ROM analysis: {e}')
+	return result
+
+def parse_addr(s):
+	seg, _, offset = s.rpartition(':')
+	return int(seg or '0', 16) << 16 | int(offset.rstrip('Hh'), 16)
+
+if __name__ == '__main__':
+	logging.basicConfig(datefmt = '%d/%m/%Y %H:%M:%S', format = '[%(asctime)s] %(levelname)s: %(message)s', level = logging.INFO)
+
+	parser = argparse.ArgumentParser(description = 'Find the functions, basic blocks and cross-references of a ROM')
+	parser.add_argument('names', nargs = '*', help = 'code or data labels, or CSR:PC addresses, to list the references of')
+	parser.add_argument('-c', '--config', help = 'config script to take the ROM and labels from (default: config.py)')
+	parser.add_argument('--rebuild', action = 'store_true', help = 'analyse again even if there is a cached analysis')
+	args = parser.parse_args()
+
+	import emulator
+	cfg = emulator.load_config(args.config)
+	emulator.load_lib()
+	emu = emulator.Emulator(cfg)
+	if args.rebuild:
+		try: os.remove(os.path.join(emu.analysis_dir, f'{emu.rom_sha256.hex()}.u8a'))
+		except FileNotFoundError: pass
+	start = time.time()
+	result = load_or_analyse(emu.rom_bytes(), emu.rom_sha256, emu.analysis_dir)
+	logging.info(f'Loaded in {(time.time() - start) * 1000:.1f} ms')
+
+	labels, data_labels = {}, {}
+	if hasattr(cfg, 'labels') and cfg.labels: labels, data_labels, _ = emulator.load_labels(cfg.labels)
+	keys = sorted(labels)
+	fmt = lambda addr: f'{addr >> 16:X}:{addr & 0xffff:04X}H'
+	name = lambda addr: emulator.instruction_label(labels, addr, keys) or fmt(addr)
+	kinds = {CALL: 'BL', JUMP: 'B '}
+
+	if not args.names:
+		print(f'# {len(result.functions)} functions, {len(result.block_starts)} basic blocks, {len(result.code_sites)} code and {len(result.data_sites)} data references')
+		print(f'{"address":>8} {"callers":>7}  function')
+		for addr in result.functions: print(f'{fmt(addr)} {sum(1 for _, kind in result.callers(addr) if kind == CALL):7}  {name(addr)}')
+		sys.exit()
+
+	code_names = {label[0]: addr for addr, label in labels.items() if label[1]}
+	data_names = {v: k for k, v in data_labels.items()}
+	for s in args.names:
+		if s in code_names: addr, is_data = code_names[s], False
+		elif s in data_names: addr, is_data = data_names[s], True
+		else:
+			try: addr, is_data = parse_addr(s), None
+			except ValueError:
+				logging.error(f'{s}: no such label')
+				continue
+
+		print(f'{s} ({fmt(addr)})')
+		if is_data is not True:
+			func = result.function_at(addr)
+			if func is not None:
+				block = result.block_at(addr)
+				print(f'  in function {name(func)}, block {fmt(block[0])} - {fmt(block[1])}')
+			for site, kind in result.callers(addr): print(f'  {kinds[kind]} from {name(site)}')
+		if is_data is not False:
+			for site, kind in result.data_refs(addr): print(f'  {"read" if kind == READ else "written"} by {name(site)}')
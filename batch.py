@@ -0,0 +1,116 @@
+# Runs a suite of ROM regression jobs on a pool of headless emulators and
+# writes the results of the whole suite to one JSON file.
+#
+# Suites are TOML (Python 3.11+) or JSON files:
+#
+#   output = "results.json"    # optional, default: <suite>.results.json
+#   workers = 8                # optional, default: one per CPU
+#
+#   [defaults]                 # optional, merged into every job
+#   steps = 100000000
+#   timer_mode = 1
+#
+#   [[job]]
+#   name = "fx-991ES PLUS"     # optional, default: the config path
+#   config = "configs/esp.py"  # config script, relative to the suite file
+#   input = "inputs/menu.txt"  # optional input script, see emulator.load_inputs()
+#   steps = 50000000           # optional instruction limit, default: 1000000000 (see default_steps)
+#   rom_file = "esp_v2.bin"    # any other key overrides the config script setting
+#   coverage_file = "cov/menu.u8c"   # e.g. per-job code coverage, merge with execcov.py
+#
+# Usage: batch.py <suite> [-j workers] [-o output]
+
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import traceback
+import multiprocessing
+
+import emulator
+
+job_keys = ('name', 'config', 'input', 'steps')
+# so that a ROM busy-looping without ever stopping can't hang the suite
+default_steps = 1000000000
+
+def load_suite(path):
+	if path.endswith('.toml'):
+		try: import tomllib
+		except ImportError:
+			logging.error('TOML suites need Python 3.11 or newer, use JSON instead')
+			sys.exit()
+		with open(path, 'rb') as f: return tomllib.load(f)
+	with open(path) as f: return json.load(f)
+
+def init_worker(): logging.getLogger().setLevel(logging.WARNING)
+
+def run_job(job):
+	result = {'name': job.get('name', job['config'])}
+	start = time.time()
+	try:
+		cfg = emulator.load_config(job['config'])
+		for k, v in job.items():
+			if k not in job_keys: setattr(cfg, k, v)
+		emulator.load_lib()
+
+		emu = emulator.Emulator(cfg)
+		inputs = emulator.load_inputs(job['input']) if 'input' in job else ()
+		# rewinding only if the job sets it up
+		reason = emu.run(job.get('steps', default_steps), inputs, 'rewind_interval' in job)
+
+		result['stop_reason'] = reason.name
+		result['instructions'] = emu.sim.c_config.icount
+		result['ram_sha256'] = hashlib.sha256(emu.ram_bytes()).hexdigest()
+		result['lcd_sha256'] = hashlib.sha256(emu.lcd_bytes()).hexdigest()
+		emu.stop_coverage(emu.coverage_file)
+		emu.close()
+	except BaseException as e:
+		result['error'] = f'{type(e).__name__}: {e}'
+		result['traceback'] = traceback.format_exc()
+	result['seconds'] = round(time.time() - start, 3)
+	return result
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Run a suite of ROM jobs on a pool of headless emulators.')
+	parser.add_argument('suite', help = 'suite file (.toml or .json)')
+	parser.add_argument('-j', '--workers', type = int, help = 'number of worker processes (default: suite setting or one per CPU)')
+	parser.add_argument('-o', '--output', help = 'result file (default: suite setting or <suite>.results.json)')
+	args = parser.parse_args()
+
+	logging.basicConfig(datefmt = '%d/%m/%Y %H:%M:%S', format = '[%(asctime)s] %(levelname)s: %(message)s', level = logging.INFO)
+
+	suite = load_suite(args.suite)
+	base = os.path.dirname(os.path.abspath(args.suite))
+	defaults = suite.get('defaults', {})
+
+	jobs = []
+	for job in suite.get('job', []):
+		job = {**defaults, **job}
+		for k in ('config', 'input'):
+			if k in job: job[k] = os.path.join(base, job[k])
+		jobs.append(job)
+
+	workers = args.workers or suite.get('workers') or os.cpu_count()
+	# only a path from the suite file is relative to it
+	if args.output: output = args.output
+	elif suite.get('output'): output = os.path.join(base, suite['output'])
+	else: output = os.path.splitext(args.suite)[0] + '.results.json'
+
+	logging.info(f'Running {len(jobs)} jobs on {workers} workers')
+	start = time.time()
+	with multiprocessing.Pool(workers, init_worker) as pool:
+		results = []
+		for i, result in enumerate(pool.imap(run_job, jobs)):
+			results.append(result)
+			if 'error' in result: logging.error(f'[{i+1}/{len(jobs)}] {result["name"]}: {result["error"]}')
+			else: logging.info(f'[{i+1}/{len(jobs)}] {result["name"]}: {result["stop_reason"]} after {result["instructions"]} instructions ({result["seconds"]}s)')
+
+	with open(output, 'w') as f: json.dump({'suite': os.path.abspath(args.suite), 'seconds': round(time.time() - start, 3), 'jobs': results}, f, indent = 2)
+	logging.info(f'Results written to {output}')
+
+	if any('error' in r for r in results): sys.exit(1)
+
+if __name__ == '__main__': main()
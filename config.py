@@ -53,6 +53,44 @@ real_hardware = False
 # 1 = Early ES PLUS - Use F044H for KO
 ko_mode = 0
 
+# Timer mode. Decides how timer 0 advances while the CPU is in STOP mode. (optional)
+# 0 = Wall clock - Follow the host clock (default)
+# 1 = Virtual - Skip straight to the next timer match; runs are reproducible but not real-time
+timer_mode = 0
+
+# Instant resume. Saves the whole machine when the emulator is closed and restores it on the next start
+# instead of booting the ROM. States are kept per ROM and hardware configuration. Optional; default = True.
+resume = True
+
+# Folder for instant resume states. Optional; default = 'states'.
+#resume_dir = 'states'
+
+# Rewind. A snapshot is taken every this many instructions and whenever the calculator goes to sleep,
+# so right-click > Rewind can go back in time. Reverse stepping re-runs at most this many instructions,
+# so smaller values make it faster but use more memory. 0 turns rewinding off. Optional; default = 1000000.
+#rewind_interval = 1000000
+
+# Memory used by rewind snapshots at most, in MiB. The oldest snapshots are dropped first. Optional; default = 64.
+#rewind_budget = 64
+
+# Profiler. Right-click > Extra functions > Start profiling (or --profile) samples CSR:PC and the call stack
+# every this many instructions. An odd interval keeps the samples from lining up with loops. Optional; default = 997.
+#profile_interval = 997
+
+# Code coverage. If set, every code halfword the ROM executes is recorded and written to this file when the
+# emulator closes. Merge files of several runs and list coverage per labelled function with execcov.py.
+# Optional; default = None.
+#coverage_file = 'coverage.u8c'
+
+# Also count how often each instruction ran (up to 255) in the coverage file. Optional; default = False.
+#coverage_counts = False
+
+# ROM analysis. The debugger finds the functions, basic blocks and cross-references of the ROM in the background
+# and caches them in analysis_dir, so it only takes long the first time a ROM is loaded. analysis.py lists them.
+# Optional; defaults = True, 'analysis'.
+#rom_analysis = True
+#analysis_dir = 'analysis'
+
 # Pd value. Set on startup.
 # If omitted, Pd value is not set.
 pd_value = 0
@@ -0,0 +1,1237 @@
+import os
+import sys
+import ctypes
+import bisect
+import hashlib
+import logging
+import functools
+import collections
+import importlib
+import importlib.util
+import threading
+import traceback
+import zlib
+from enum import IntEnum, IntFlag
+
+from tool8 import tool8
+
+import peripheral
+import savestate
+import rewind
+import journal
+import exectrace
+import profiler
+import execcov
+import analysis
+
+# Set by load_config() and load_lib()
+config = None
+sim_lib = None
+
+# For ROM8 reading
+class DisplayBounds(ctypes.Structure):
+	_fields_ = [
+		('x',      ctypes.c_uint16),
+		('y',      ctypes.c_uint16),
+		('width',  ctypes.c_uint16),
+		('height', ctypes.c_uint16),
+		('scale',  ctypes.c_uint16),
+	]
+
+class GUIKey(ctypes.Structure):
+	_fields_ = [
+		('x',      ctypes.c_uint16),
+		('y',      ctypes.c_uint16),
+		('width',  ctypes.c_uint16),
+		('height', ctypes.c_uint16),
+		('keysym', ctypes.c_uint16),
+	]
+
+class Keybind(ctypes.Structure):
+	_fields_ = [
+		('key', ctypes.c_char),
+		('keysym', ctypes.c_uint8),
+	]
+
+# from Delta / @frsr (edited to be compatible with pitust™ quality code)
+class u8_core_t(ctypes.Structure):	# Forward definition so pointers can be used
+	pass
+
+class u8_regs_t(ctypes.Structure):
+	_fields_ = [
+		('gp',		ctypes.c_uint8 * 16),
+		('pc',		ctypes.c_uint16),
+		('csr',		ctypes.c_uint8),
+		('lcsr',	ctypes.c_uint8),
+		('ecsr',	ctypes.c_uint8 * 3),
+		('lr',		ctypes.c_uint16),
+		('elr',		ctypes.c_uint16 * 3),
+		('psw',		ctypes.c_uint8),
+		('epsw',	ctypes.c_uint8 * 3),
+		('sp',		ctypes.c_uint16),
+		('ea',		ctypes.c_uint16),
+		('dsr',		ctypes.c_uint8)
+	]
+
+class _acc_arr(ctypes.Structure):
+	_fields_ = [
+		('array',	ctypes.POINTER(ctypes.c_uint8)),
+		('dirty',	ctypes.c_uint64),
+	]
+
+class _acc_func(ctypes.Structure):
+	_fields_ = [
+		('read',	ctypes.CFUNCTYPE(ctypes.c_uint8, ctypes.POINTER(u8_core_t), ctypes.c_uint8, ctypes.c_uint16)),
+		('write',	ctypes.CFUNCTYPE(None, ctypes.POINTER(u8_core_t), ctypes.c_uint8, ctypes.c_uint16, ctypes.c_uint8))
+	]
+
+class _acc_union(ctypes.Union):
+	_anonymous_ = ['_acc_arr', '_acc_func']
+	_fields_ = [
+		('_acc_arr',	_acc_arr),
+		('_acc_func',	_acc_func)
+	]
+
+class u8_mem_reg_t(ctypes.Structure):
+	_anonymous_ = ['_acc_union']
+	_fields_ = [
+		('type',		ctypes.c_uint),
+		('rw',			ctypes.c_bool),
+		('addr_l',		ctypes.c_uint32),
+		('addr_h',		ctypes.c_uint32),
+
+		('acc',			ctypes.c_uint),
+		('_acc_union',	_acc_union)
+	]
+
+class u8_mem_t(ctypes.Structure):
+	_fields_ = [
+		('num_regions',	ctypes.c_int),
+		('regions',		ctypes.POINTER(u8_mem_reg_t))
+	]
+
+u8_core_t._fields_ = [
+		('regs',			u8_regs_t),
+		('cur_dsr',			ctypes.c_uint8),
+		('last_swi',		ctypes.c_uint8),
+		('last_read',		ctypes.c_uint32),
+		('last_read_size',	ctypes.c_uint8),
+		('last_write',		ctypes.c_uint32),
+		('last_write_size',	ctypes.c_uint8),
+		('u16_mode',		ctypes.c_bool),
+		('small_mm',		ctypes.c_bool),
+		('mem',				u8_mem_t),
+		('codemem',			u8_mem_t),
+	]
+
+class u8_mem_type_e(IntEnum):	
+	U8_REGION_BOTH = 0
+	U8_REGION_DATA = 1
+	U8_REGION_CODE = 2
+
+class u8_mem_acc_e(IntEnum):
+	U8_MACC_ARR  = 0
+	U8_MACC_FUNC = 1
+
+class stop_reason_e(IntFlag):
+	STOP_NONE     = 0
+	STOP_BRK      = 1 << 0
+	STOP_SWI      = 1 << 1
+	STOP_STOPMODE = 1 << 2
+	STOP_WILD     = 1 << 3
+	STOP_BRKPOINT = 1 << 4
+	STOP_WATCH    = 1 << 5
+	STOP_TRACE    = 1 << 6
+	STOP_PROFILE  = 1 << 7
+
+MAX_INTS = 18
+INT_IRQ_BASE = 0x14
+INT_IRQ_END = 0x20
+CALL_TRACE_MAX = 1024
+BRANCH_MAX = 4096
+MAX_WATCHPOINTS = 64
+
+class int_entry_t(ctypes.Structure):
+	_fields_ = [
+		('irq',		ctypes.c_int),
+		('bit',		ctypes.c_int),
+		('vector',	ctypes.c_int),
+		('ie_sfr',	ctypes.c_int),
+		('ie_bit',	ctypes.c_int),
+		('name',	ctypes.c_char_p),
+	]
+
+class call_frame_t(ctypes.Structure):
+	_fields_ = [
+		('func',	ctypes.c_uint32),
+		('ret',		ctypes.c_uint32),
+		('sp',		ctypes.c_uint16),
+		('icount',	ctypes.c_uint64),
+	]
+
+TRACE_PAIRS = 7
+TRACE_CONT_PAIRS = 13
+TRACE_CONT = 0xffffffff
+TRACE_SYNC = 0xfffffffe
+
+class _trace_ins(ctypes.Structure):
+	_fields_ = [
+		('ins',		ctypes.c_uint16 * 2),
+		('read',	ctypes.c_uint32),
+		('write',	ctypes.c_uint32),
+		('nregs',	ctypes.c_uint8),
+		('regs',	(ctypes.c_uint8 * 2) * TRACE_PAIRS),
+		('pad',		ctypes.c_uint8),
+	]
+
+class _trace_cont(ctypes.Structure):
+	_fields_ = [
+		('nregs',	ctypes.c_uint8),
+		('regs',	(ctypes.c_uint8 * 2) * TRACE_CONT_PAIRS),
+		('pad',		ctypes.c_uint8),
+	]
+
+class _trace_sync(ctypes.Structure):
+	_fields_ = [
+		('icount_lo',	ctypes.c_uint32),
+		('icount_hi',	ctypes.c_uint32),
+	]
+
+class _trace_union(ctypes.Union):
+	_anonymous_ = ['_trace_ins']
+	_fields_ = [
+		('_trace_ins',	_trace_ins),
+		('cont',		_trace_cont),
+		('sync',		_trace_sync),
+	]
+
+class trace_record_t(ctypes.Structure):
+	_anonymous_ = ['_trace_union']
+	_fields_ = [
+		('csrpc',			ctypes.c_uint32),
+		('_trace_union',	_trace_union),
+	]
+
+class branch_t(ctypes.Structure):
+	_fields_ = [
+		('from_',	ctypes.c_uint32),
+		('to',		ctypes.c_uint32),
+	]
+
+HEAT_PAGES = 0x10000
+
+class heat_t(ctypes.Structure):
+	_fields_ = [
+		('reads',	ctypes.c_uint64),
+		('writes',	ctypes.c_uint64),
+	]
+
+class watchpoint_t(ctypes.Structure):
+	_fields_ = [
+		('type',	ctypes.c_int),
+		('start',	ctypes.c_uint32),
+		('end',		ctypes.c_uint32),
+	]
+
+class c_config(ctypes.Structure):
+	_fields_ = [
+		('hwid',		ctypes.c_int),
+		('real_hw',		ctypes.c_bool),
+		('ko_mode',		ctypes.c_bool),
+		('sample',		ctypes.c_bool),
+		('is_5800p',	ctypes.c_bool),
+		('pd_value',	ctypes.c_uint8),
+		('rom',			ctypes.POINTER(ctypes.c_uint8)),
+		('flash',		ctypes.POINTER(ctypes.c_uint8)),
+		('ram',			ctypes.POINTER(ctypes.c_uint8)),
+		('sfr',			ctypes.POINTER(ctypes.c_uint8)),
+		('emu_seg',		ctypes.POINTER(ctypes.c_uint8)),
+		('sfr_write',	(ctypes.CFUNCTYPE(ctypes.c_uint8, ctypes.c_uint16, ctypes.c_uint8)) * 0x1000),
+		('flash_mode',	ctypes.c_int),
+
+		('rom_size',		ctypes.c_uint32),
+		('flash_size',		ctypes.c_uint32),
+		('icount',			ctypes.c_uint64),
+		('stop_mode',		ctypes.c_bool),
+		('factory_test',	ctypes.c_bool),
+		('tick_pending',	ctypes.c_bool),
+		('int_timer',		ctypes.c_int),
+		('wdt_counter',		ctypes.c_int),
+		('kb_matrix',		ctypes.c_uint8 * 8),
+		('num_ints',		ctypes.c_int),
+		('ints',			ctypes.POINTER(int_entry_t)),
+		('int_lookup',		(ctypes.c_int8 * 8) * (INT_IRQ_END - INT_IRQ_BASE)),
+		('int_count',		ctypes.c_uint32 * MAX_INTS),
+		('call_depth',		ctypes.c_int),
+		('call_top',		ctypes.c_int),
+		('call_lost',		ctypes.c_uint32),
+		('call_trace',		call_frame_t * CALL_TRACE_MAX),
+		('branch_top',		ctypes.c_uint32),
+		('branch_count',	ctypes.c_uint64),
+		('branches',		branch_t * BRANCH_MAX),
+		('brk_bitmap',		ctypes.POINTER(ctypes.c_uint8)),
+		('num_watchpoints',	ctypes.c_int),
+		('watchpoints',		watchpoint_t * MAX_WATCHPOINTS),
+		('watch_pages',		ctypes.POINTER(ctypes.c_uint8)),
+		('watch_hit',		ctypes.c_int),
+		('timer_mode',		ctypes.c_int),
+		('timer_ticks',		ctypes.c_uint64),
+		('emu_seg_size',	ctypes.c_uint32),
+		('trace_buf',		ctypes.POINTER(trace_record_t)),
+		('trace_pos',		ctypes.c_uint64),
+		('trace_cap',		ctypes.c_uint64),
+		('trace_steps',		ctypes.c_int),
+		('trace_sync',		ctypes.c_bool),
+		('trace_regs',		ctypes.c_uint8 * ctypes.sizeof(u8_regs_t)),
+		('cov_bitmap',		ctypes.POINTER(ctypes.c_uint8)),
+		('cov_counts',		ctypes.POINTER(ctypes.c_uint8)),
+		('op_counts',		ctypes.POINTER(ctypes.c_uint64)),
+		('heat_pages',		ctypes.POINTER(heat_t)),
+		('heat_sfr',		ctypes.POINTER(heat_t)),
+		('prof_buf',		ctypes.POINTER(ctypes.c_uint32)),
+		('prof_pos',		ctypes.c_uint32),
+		('prof_cap',		ctypes.c_uint32),
+		('prof_interval',	ctypes.c_uint32),
+		('prof_countdown',	ctypes.c_uint32),
+		('prof_steps',		ctypes.c_int),
+		('code_dirty',		ctypes.POINTER(ctypes.c_uint8)),
+		('code_changed',	ctypes.c_bool),
+	]
+
+class machine_t(ctypes.Structure):
+	_fields_ = [
+		('core',	u8_core_t),
+		('config',	ctypes.POINTER(c_config)),
+	]
+
+class Core:
+	def __init__(self, sim, rom, flash):
+		self.sim = sim
+		self.config = sim.config
+
+		pd_value = self.config.pd_value if hasattr(self.config, 'pd_value') else 0
+		self.c_config = c_config(self.config.hardware_id, self.config.real_hardware, self.sim.ko_mode, self.sim.sample, self.sim.is_5800p)
+		self.c_config.pd_value = pd_value
+		self.c_config.timer_mode = self.sim.timer_mode
+
+		# the core has to live inside a machine_t for the native memory callbacks
+		self.machine = machine_t()
+		self.core = self.machine.core
+
+		# Initialise memory
+		if self.config.hardware_id == 5 and self.config.real_hardware:
+			self.rom_length = 0xfffff
+			self.code_mem = (ctypes.c_uint8 * 0x100000)(*rom, *rom)
+			self.flash_length = 0
+		else:
+			self.rom_length = len(rom)
+			self.code_mem = (ctypes.c_uint8 * (0x80000 if self.config.hardware_id == 2 and self.sim.is_5800p else 0x100000))(*rom)
+			if self.config.hardware_id == 2 and self.sim.is_5800p:
+				self.flash_length = len(flash)
+				self.flash_mem = (ctypes.c_uint8 * 0x80000)(*flash)
+			else: self.flash_length = 0
+
+		data_size = {
+		0: (0xe000, 0x1000),
+		3: (0x8000, 0xe00 if self.config.real_hardware else 0x7000),
+		4: (0xd000, 0x2000),
+		5: (0x9000, 0x6000),
+		6: (0xb000, 0x4000),
+		}
+
+		self.c_config.rom_size = self.rom_length
+		self.c_config.flash_size = self.flash_length
+
+		ramstart, ramsize = data_size[self.config.hardware_id if self.config.hardware_id in data_size else 3]
+		self.ramstart = ramstart
+		self.ramsize = ramsize
+
+		self.sfr_write_ft = ctypes.CFUNCTYPE(ctypes.c_uint8, ctypes.c_uint16, ctypes.c_uint8)
+		self.sfr_default_write_f = self.sfr_write_ft(self.sfr_default_write)
+
+		self.setup_mcu(ramstart, ramsize)
+
+	def setup_mcu(self, ramstart, ramsize):
+		sim_lib.setup_mcu(ctypes.pointer(self.c_config), ctypes.pointer(self.core), self.code_mem, self.flash_mem if self.config.hardware_id == 2 and self.sim.is_5800p else None, ramstart, ramsize)
+
+		if self.config.hardware_id == 2 and self.sim.is_5800p: self.c_config.sfr[0x46] = 4
+		self.register_sfr(0, 1, self.write_dsr)
+
+		if self.config.hardware_id in (4, 5):
+			self.register_sfr(0xd0, 1)
+			self.register_sfr(0xd1, 1, lambda x, y: 6 if self.c_config.sfr[0xd0] == 3 and self.c_config.sfr[0xd2] == 0 and y == 5 else y)
+			self.register_sfr(0xd2, 1)
+
+		if self.config.hardware_id == 5:
+			self.bcd = peripheral.BCD(self.sim)
+			self.register_sfr(0x400, 1, self.bcd.tick)  # BCDCMD
+			self.register_sfr(0x402, 1, self.bcd.tick)  # BCDCON
+			self.c_config.sfr[0x402] = 6
+			self.register_sfr(0x404, 1, self.bcd.tick)  # BCDMCN
+			self.register_sfr(0x405, 1, self.bcd.tick)  # BCDMCR
+			self.register_sfr(0x410, 1)                 # BCDFLG
+			# F414H: BCDLLZ, F415H: BCDMLZ (both read-only)
+			for i in range(4): self.register_sfr(0x480 + i*0x20, 12)  # BCDREG000 - BCDREG311
+
+		if self.config.hardware_id == 6: self.register_sfr(0x901, 1, lambda a, v: int(not v))
+	
+	def close(self): sim_lib.free_mcu(ctypes.pointer(self.c_config), ctypes.pointer(self.core))
+
+	def u8_reset(self): sim_lib.u8_reset(ctypes.pointer(self.core))
+
+	def read_reg_er(self, n): return sim_lib.read_reg_er(ctypes.pointer(self.core), n)
+
+	def run_steps(self, max_steps, stop_mask):
+		while True:
+			reason = stop_reason_e(sim_lib.run_steps(ctypes.pointer(self.c_config), ctypes.pointer(self.core), max_steps, stop_mask))
+			if reason == stop_reason_e.STOP_TRACE:
+				max_steps -= self.c_config.trace_steps
+				self.sim.trace.grow()
+			elif reason == stop_reason_e.STOP_PROFILE:
+				max_steps -= self.c_config.prof_steps
+				self.sim.profiler.drain()
+			else: return reason
+
+	def set_brkpoint(self, addr, enabled): sim_lib.set_brkpoint(ctypes.pointer(self.c_config), addr, enabled)
+
+	def clear_watchpoints(self): sim_lib.clear_watchpoints(ctypes.pointer(self.c_config))
+
+	def add_watchpoint(self, typ, start, end): return sim_lib.add_watchpoint(ctypes.pointer(self.c_config), typ, start, end)
+
+	def timer_tick(self, ticks): sim_lib.timer_tick(ctypes.pointer(self.c_config), ctypes.pointer(self.core), ticks)
+
+	def timer_skip(self): sim_lib.timer_skip(ctypes.pointer(self.c_config), ctypes.pointer(self.core))
+
+	def timer_ticks_left(self): return sim_lib.timer_ticks_left(ctypes.pointer(self.c_config))
+
+	def diff_pages(self, mem, shadow, size, undo, pages): return sim_lib.diff_pages(mem, shadow, size, undo, pages)
+
+	def undo_pages(self, shadow, size, undo, pages, n): sim_lib.undo_pages(shadow, size, undo, pages, n)
+
+	def heat_regions(self):
+		out = (heat_t * self.core.mem.num_regions)()
+		sim_lib.heat_regions(ctypes.pointer(self.c_config), ctypes.pointer(self.core), out)
+		return [(h.reads, h.writes) for h in out]
+
+	def int_counts(self): return [(self.c_config.ints[i].name.decode(), self.c_config.int_count[i]) for i in range(self.c_config.num_ints)]
+
+	# Memory Access
+	def read_mem_data(self, dsr, offset, size): return sim_lib.read_mem_data(ctypes.pointer(self.core), dsr, offset, size)
+	
+	def write_mem_data(self, dsr, offset, size, value): return sim_lib.write_mem_data(ctypes.pointer(self.core), dsr, offset, size, value)
+	
+	def register_sfr(self, addr, length, handler = None):
+		for i in range(addr, addr+length): self.c_config.sfr_write[i] = self.sfr_default_write_f if handler is None else self.sfr_write_ft(handler)
+
+	def sfr_default_write(self, addr, value): return value
+
+	def write_dsr(self, addr, value):
+		self.core.regs.dsr = value
+		return value
+
+	def write_sfr(self, addr, value):
+		if addr >= 0x1000:
+			logging.warning(f'Overflown write to {(0xf000 + addr) & 0xffff:04X}H @ {self.sim.get_addr_label(self.core.regs.csr, self.core.regs.pc-2)}')
+			return self.read_mem_data(seg, (0xf000 + addr) & 0xffff, 1)
+
+		try:
+			if self.config.hardware_id == 5:
+				if self.config.real_hardware:
+					if addr >= 0x800:
+						y, x = self.get_idx(addr - 0x800)
+						if self.c_config.sfr[0x37] & 4: self.sim.cwii_screen_hi[y][x] = value
+						else: self.sim.cwii_screen_lo[y][x] = value
+						return value
+					elif addr == 0xd1: return 
+				if addr == 0x312:
+					if self.sim.shutdown_accept:
+						if value == 0x3c:
+							self.c_config.sfr[0x31] = 3
+							self.sim.shutdown = True
+						elif value != 0x5a: self.sim.shutdown_accept = False
+					elif value == 0x5a: self.sim.shutdown_accept = True
+				elif addr in (0x400, 0x402, 0x404, 0x405): self.sim.bcd.tick(addr)
+				else: return value
+			elif self.config.hardware_id == 6:
+				if addr == 0xe: return value == 0x5a
+				elif addr == 0x900: return 0x34
+				elif addr == 0x901: return int(not value)
+				else: return value
+			elif addr == 0x46 and self.config.hardware_id == 2 and self.sim.is_5800p: return 4
+			else: return value
+		except Exception as e:
+			logging.error(f'{type(e).__name__} writing to {0xf000+addr:04X}H: {e}')
+			return 0
+
+	def battery(self, core, seg, addr): return 0xff
+
+	@staticmethod
+	@functools.lru_cache
+	def get_idx(x): return x // 32, x % 32
+
+
+class Emulator:
+	# cfg is a config module as returned by load_config(), the last one loaded by default
+	def __init__(self, cfg = None):
+		self.config = config if cfg is None else cfg
+
+		self.rom8 = self.config.rom8 if hasattr(self.config, 'rom8') else False
+		self.use_char = self.config.use_char if hasattr(self.config, 'use_char') else False
+		self.ko_mode = self.config.ko_mode if hasattr(self.config, 'ko_mode') and self.config.ko_mode == 1 else 0
+		self.is_5800p = self.config.is_5800p if hasattr(self.config, 'is_5800p') else False
+		self.sample = self.config.sample if hasattr(self.config, 'sample') else False
+		self.timer_mode = self.config.timer_mode if hasattr(self.config, 'timer_mode') and self.config.timer_mode == 1 else 0
+		self.resume = self.config.resume if hasattr(self.config, 'resume') else True
+		self.resume_dir = self.config.resume_dir if hasattr(self.config, 'resume_dir') else 'states'
+		rewind_interval = self.config.rewind_interval if hasattr(self.config, 'rewind_interval') else 1000000
+		rewind_budget = self.config.rewind_budget if hasattr(self.config, 'rewind_budget') else 64
+		self.profile_interval = self.config.profile_interval if hasattr(self.config, 'profile_interval') else 997
+		self.coverage_file = self.config.coverage_file if hasattr(self.config, 'coverage_file') else None
+		self.coverage_counts = self.config.coverage_counts if hasattr(self.config, 'coverage_counts') else False
+		self.rom_analysis = self.config.rom_analysis if hasattr(self.config, 'rom_analysis') else True
+		self.analysis_dir = self.config.analysis_dir if hasattr(self.config, 'analysis_dir') else 'analysis'
+
+		# ROM8 face tags, applied by the GUI
+		self.face = None
+		self.face_bounds = None
+
+		rom, flash = self.load_rom()
+		# identifies the ROM in save states
+		self.rom_sha256 = hashlib.sha256(rom).digest()
+
+		if self.config.hardware_id == 2: self.ko_mode = 1 
+		elif self.config.hardware_id != 3: self.ko_mode = 0
+
+		self.sim = Core(self, rom, flash)
+
+		self.init_sp = rom[0] | rom[1] << 8
+		self.init_pc = rom[2] | rom[3] << 8
+		self.init_brk = rom[4] | rom[5] << 8
+
+		# code labels, see load_labels(); only the GUI loads them
+		self.labels = {}
+		self.label_keys = []
+
+		self.keys_pressed = set()
+		# (press, key) from other threads, applied by core_step() so that replays see them at the same instruction
+		self.inputs = collections.deque()
+
+		self.screen_stuff = {
+	   # hwid: (alloc, used, rows,buffers,          columns)
+			0: [0x8,   0x8,  3,   [],               64],
+			2: [0x10,  0xc,  32,  [0x80e0 if self.is_5800p else 0x8600], 96],
+			3: [0x10,  0xc,  32,  [0x87d0],         96],
+			4: [0x20,  0x18, 64,  [0xddd4, 0xe3d4], 192],
+			5: [0x20,  0x18, 64,  [0xca54, 0xd654], 192],
+			6: [0x8,   0x8,  192, [None, None],     64],
+		}
+
+		if self.config.hardware_id in self.screen_stuff: self.scr = self.screen_stuff[self.config.hardware_id]
+		else: self.scr = self.screen_stuff[3]
+		if self.config.hardware_id != 6 and hasattr(self.config, 'custom_buffers') and type(self.config.custom_buffers) == list: self.scr[3] = self.config.custom_buffers
+
+		# actual peripherals
+		self.disp = peripheral.Screen(self, self.scr)
+		self.wdt = peripheral.WDT(self)
+		self.standby = peripheral.Standby(self)
+		self.timer = peripheral.Timer(self)
+		self.kb = peripheral.Keyboard(self)
+
+		if self.config.hardware_id == 5 and self.config.real_hardware:
+			self.cwii_screen_hi = [bytearray(32) for _ in range(64)]
+			self.cwii_screen_lo = [bytearray(32) for _ in range(64)]
+
+		self.single_step = False
+
+		self.shutdown_accept = False
+		self.shutdown = False
+
+		# number of instructions run per native call while not single-stepping
+		self.slice_steps = 0x10000
+
+		# set on input and single-step so an idle STOP mode wait returns early
+		self.wake_event = threading.Event()
+		self.idle_timeout = 0.5
+		# only worth it when someone can press a key, see run()
+		self.idle_in_stop = True
+
+		# TI MathPrint only
+		self.screen_changed = False
+		self.curr_key = 0
+
+		self.qr_active = False
+		# instruction count of the last STOP mode spin without ticks, see core_step()
+		self.idle_stop = None
+
+		self.rewind = rewind.Rewind(self, rewind_interval, rewind_budget << 20) if rewind_interval > 0 else None
+		self.journal = None
+		self.trace = None
+		self.profiler = None
+		self.coverage = None
+		# data access counters, see start_heatmap()
+		self.heat_pages = None
+		self.heat_sfr = None
+		# executions of each opcode word, see start_op_counts()
+		self.op_counts = None
+		# functions, basic blocks and cross-references, see start_analysis()
+		self.analysis = None
+		if self.coverage_file: self.start_coverage()
+
+	def close(self): self.sim.close()
+
+	def load_rom(self):
+		if self.rom8:
+			tags = list(tool8.read8(self.config.rom_file))
+			props = {}
+			keymap = {}
+			found_tags = set()
+			
+			for tag, data in tags:
+				if tag in found_tags and tag != 2:
+					logging.error(f'Duplicate tag (type {int(tag)}) found')
+					sys.exit()
+				else: found_tags.add(tag)
+
+				# end
+				if tag == 0: break
+				# prop
+				elif tag == 2:
+					ds = data.decode().split('=', 1)
+					props[ds[0]] = ds[1]
+				# rom
+				elif tag == 3: rom = data
+				# faceSVG / facePNG
+				elif tag in (4, 5):
+					if tag == 4 and 5 in found_tags:
+						logging.error('facePNG tag already used')
+						sys.exit()
+					elif tag == 5 and 4 in found_tags:
+						logging.error('faceSVG tag already used')
+						sys.exit()
+
+					self.face = (tag, data)
+
+				# faceDisplayBounds
+				elif tag == 6: self.face_bounds = DisplayBounds.from_buffer_copy(data)
+				
+				# faceGUIKeys
+				elif tag == 7:
+					for i in range(0, len(data), 10):
+						key = GUIKey.from_buffer_copy(data[i:i+10])
+						if key.keysym == 0x80: kio = None
+						else: kio = (key.keysym >> 4 & 0xf, key.keysym & 0xf)
+						if kio in keymap: keymap[kio][0] = (key.x, key.y, key.width, key.height)
+						else: keymap[kio] = [(key.x, key.y, key.width, key.height)]
+				
+				# calcType
+				elif tag == 9:
+					calctype = data[0]
+					if calctype & 3 == 1: self.config.hardware_id = 3
+					elif calctype & 3 == 2: self.config.hardware_id = 4
+					elif calctype & 3 == 3: self.config.hardware_id = 5
+					self.config.real_hardware = calctype & 0xfc != 4
+				
+				# faceKeybinds
+				elif tag == 10:
+					self.use_char = True
+					for i in range(0, len(data), 2):
+						key = Keybind.from_buffer_copy(data[i:i+2])
+						if key.keysym == 0x80: kio = None
+						kio = (key.keysym >> 4 & 0xf, key.keysym & 0xf)
+						if kio not in keymap: keymap[kio] = [(0, 0, 0, 0)]
+						keymap[kio].append(key.key.decode())
+
+			if keymap != {}: self.config.keymap = keymap
+			if 'model' in props: self.config.root_w_name = props['model']
+			for k, v in props.items(): logging.info(f'{k}: {v}')
+		else:
+			rom = open(self.config.rom_file, 'rb').read()
+			if len(rom) % 2 != 0:
+				logging.error('ROM size cannot be odd')
+				sys.exit()
+
+		if self.config.hardware_id == 2 and self.is_5800p:
+			flash = open(self.config.flash_rom_file, 'rb').read()
+			if len(flash) % 2 != 0:
+				logging.error('Flash ROM size cannot be odd')
+				sys.exit()
+		else: flash = None
+
+		return rom, flash
+
+	# (function address, return address, SP, instruction count) of each call, innermost first
+	@property
+	def call_trace(self):
+		c_config = self.sim.c_config
+		top = c_config.call_top
+		frames = [c_config.call_trace[(top - i - 1) % CALL_TRACE_MAX] for i in range(c_config.call_depth)]
+		return [(f.func, f.ret, f.sp, f.icount) for f in frames]
+
+	# (from, to) CSR:PC of the last taken branches, newest first
+	@property
+	def branch_trace(self):
+		c_config = self.sim.c_config
+		top = c_config.branch_top
+		branches = [c_config.branches[(top - i - 1) % BRANCH_MAX] for i in range(min(c_config.branch_count, BRANCH_MAX))]
+		return [(b.from_, b.to) for b in branches]
+
+	@property
+	def last_branch(self):
+		c_config = self.sim.c_config
+		if not c_config.branch_count: return
+		b = c_config.branches[(c_config.branch_top - 1) % BRANCH_MAX]
+		return b.from_, b.to
+
+	@functools.lru_cache
+	def get_emu_kb_addr(self, idx):
+		segment = 0
+		if self.config.hardware_id == 0: addr = 0xe800 + idx
+		elif self.config.hardware_id in (4, 5):
+			segment = 4 if self.config.hardware_id == 4 else 8
+			if self.config.hardware_id == 5 and self.sample:
+				if idx == 0: addr = 0x8e07
+				elif idx == 1: addr = 0x8e05
+				elif idx == 2: addr = 0x8e08
+			else: addr = 0x8e00 + idx
+		else: addr = 0x8e00 + idx
+		return segment, addr
+
+	def read_emu_kb(self, idx): return self.sim.read_mem_data(*self.get_emu_kb_addr(idx), 1)
+
+	def write_emu_kb(self, idx, val): self.sim.write_mem_data(*self.get_emu_kb_addr(idx), 1, val)
+
+	def read_dmem(self, addr, num_bytes, segment = 0): return self.sim.read_mem_data(segment, addr, num_bytes)
+
+	def write_dmem(self, addr, num_bytes, data, segment = 0): self.sim.write_mem_data(segment, addr, num_bytes, data)
+
+	def read_dmem_bytes(self, addr, num_bytes, segment = 0):
+		data = b''
+		bytes_grabbed = 0
+
+		if num_bytes > 8:
+			while bytes_grabbed < num_bytes:
+				remaining = num_bytes - bytes_grabbed
+				if remaining >= 8: grab = 8
+				else: grab = remaining
+
+				dt = self.read_dmem(addr + bytes_grabbed, grab, segment)
+				data += dt.to_bytes(grab, 'little')
+				bytes_grabbed += grab
+			
+			return data
+		else: return self.read_dmem(addr, num_bytes, segment).to_bytes(num_bytes, 'little')
+
+	def read_cmem(self, addr, segment = 0):
+		if self.config.hardware_id == 2 and self.is_5800p and segment > 7:
+			mem = self.sim.flash_mem
+			segment -= 8
+		else: mem = self.sim.code_mem
+		return (mem[(segment << 16) + addr + 1] << 8) + mem[(segment << 16) + addr]
+
+	# LCD contents as one byte per pixel (0 = off, 1-3 = shade), row by row.
+	# TI MathPrint has no LCD SFRs, so the raw buffer passed to SWI 1 is returned instead.
+	def lcd_bytes(self):
+		if self.config.hardware_id == 6: return b'' if self.scr[3][0] is None else self.read_dmem_bytes(self.scr[3][0], self.scr[1]*self.scr[2])
+		self.disp.update_emu_hi_scr()
+		return bytes(pix for row in self.disp.screen for pix in row)
+
+	def keyboard(self):
+		kb_matrix = [0]*8
+		for val in tuple(self.keys_pressed):
+			if val is None: continue
+			kb_matrix[val[1]] |= 1 << val[0]
+		self.sim.c_config.kb_matrix[:] = kb_matrix
+
+	# k is a (KI, KO) tuple, None for the core reset key, or a key ID on TI MathPrint
+	def press_key(self, k):
+		if self.config.hardware_id != 6:
+			self.keys_pressed.add(k)
+			self.keyboard()
+			if k is None: self.reset_core()
+			else:
+				if self.config.real_hardware:
+					self.sim.c_config.sfr[0x14] = 2
+					if self.sim.c_config.sfr[0x42] & (1 << k[0]): self.standby.stop_mode = False
+				else:
+					self.standby.stop_mode = False
+					self.write_emu_kb(1, 1 << k[0])
+					self.write_emu_kb(2, 1 << k[1])
+			self.wake_event.set()
+		elif len(self.keys_pressed) == 0: self.curr_key = k
+
+	def release_key(self, k):
+		if self.config.hardware_id != 6:
+			self.keys_pressed.discard(k)
+			self.keyboard()
+		else: self.curr_key = 0
+
+	def check_stop_type(self):
+		temp = self.read_emu_kb(0)
+		if temp in (2, 8): self.write_emu_kb(0, int([self.read_emu_kb(i) for i in (1, 2)] == [1<<2, 1<<4]))
+		elif temp in (5, 7) and not self.qr_active:
+			self.qr_active = True
+			self.show_qr_notice()
+		elif temp == 6: self.qr_active = False
+
+	def show_qr_notice(self): logging.info('Detected emulator ROM QR code')
+
+	def core_step(self, max_steps = 1):
+		if self.shutdown: return
+		while self.inputs: self.apply_input(*self.inputs.popleft())
+		if self.config.hardware_id != 6 and self.standby.stop_mode:
+			ticks = self.timer.ticks_due()
+			# spinning in STOP mode mostly gives no ticks, and doing that again at
+			# the same instruction count changes nothing, so it is logged once
+			if ticks != 0 or self.sim.c_config.icount != self.idle_stop: self.log_event('stop', ticks)
+			self.idle_stop = self.sim.c_config.icount if ticks == 0 else None
+			self.stop_tick(ticks)
+			if not self.config.real_hardware and self.standby.stop_mode: self.check_stop_type()
+
+		stop_mask = stop_reason_e.STOP_BRK | stop_reason_e.STOP_SWI | stop_reason_e.STOP_BRKPOINT | stop_reason_e.STOP_WATCH
+		if not self.single_step: stop_mask |= stop_reason_e.STOP_WILD
+		# TI MathPrint only leaves STOP mode through WDTINT, which is counted natively
+		if self.config.hardware_id != 6: stop_mask |= stop_reason_e.STOP_STOPMODE
+
+		reason = self.sim.run_steps(max_steps, stop_mask)
+		if reason == stop_reason_e.STOP_SWI: self.handle_swi()
+
+		if self.rewind is not None: self.rewind.update(reason == stop_reason_e.STOP_STOPMODE)
+		if reason == stop_reason_e.STOP_STOPMODE and not self.single_step and self.idle_in_stop: self.idle()
+
+		return reason
+
+	# TI MathPrint system calls
+	def handle_swi(self):
+		last_swi = self.sim.core.last_swi
+		if last_swi == 1:
+			self.scr[3][0] = self.sim.read_reg_er(0)
+			self.sim.core.regs.gp[0] = self.sim.core.regs.gp[1] = 0
+			self.screen_changed = True
+		elif last_swi == 2:
+			self.sim.core.regs.gp[1] = 0
+			self.sim.core.regs.gp[0] = self.curr_key
+			self.curr_key = 0
+		elif last_swi == 4:
+			self.scr[3][1] = self.sim.read_reg_er(0)
+			self.sim.core.regs.gp[0] = self.sim.core.regs.gp[1] = 0
+			self.screen_changed = True
+
+	# Runs the events recorded by Rewind from the current state until target
+	# instructions have run in total, the same way core_step() ran them the
+	# first time. events is a deque, left holding whatever was not reached.
+	# Returns the stop reason if a breakpoint or watchpoint was hit first.
+	def replay(self, target, events, stop_at_breakpoints = False):
+		stop_mask = stop_reason_e.STOP_BRKPOINT | stop_reason_e.STOP_WATCH if stop_at_breakpoints else stop_reason_e.STOP_NONE
+		mask = stop_mask | stop_reason_e.STOP_SWI
+		if self.config.hardware_id != 6: mask |= stop_reason_e.STOP_STOPMODE
+
+		while self.sim.c_config.icount < target and not self.shutdown:
+			icount = self.sim.c_config.icount
+			if events and events[0][0] < icount:
+				logging.warning(f'Replay went past a recorded event at instruction {events[0][0]}')
+				break
+
+			# every recorded STOP mode wake-up was followed by a native call, so stop at the first one
+			while events and events[0][0] == icount:
+				_, kind, arg = events.popleft()
+				self.replay_event(kind, arg)
+				if kind == 'stop': break
+
+			if self.shutdown: break
+			steps = target - icount
+			if events: steps = min(steps, max(events[0][0] - icount, 1))
+			reason = self.sim.run_steps(steps, mask)
+			if reason == stop_reason_e.STOP_SWI: self.handle_swi()
+			elif reason & stop_mask: return reason
+			elif reason == stop_reason_e.STOP_STOPMODE and not (events and events[0][0] == self.sim.c_config.icount): break
+
+		return stop_reason_e.STOP_NONE
+
+	def replay_event(self, kind, arg):
+		if kind == 'stop':
+			self.log_event(kind, arg)
+			self.stop_tick(arg)
+			if not self.config.real_hardware and self.standby.stop_mode: self.check_stop_type()
+		else: self.apply_input(kind == 'press', arg)
+
+	# Timer 0 on a STOP mode wake-up, ticks is None in virtual mode
+	def stop_tick(self, ticks):
+		if ticks is None: self.sim.timer_skip()
+		else: self.timer.timer_tick(ticks)
+
+	# Everything that changes the machine between native calls goes through here,
+	# before it takes effect, so that it can be replayed
+	def log_event(self, kind, arg):
+		if self.rewind is not None: self.rewind.log(kind, arg)
+		if self.journal is not None: self.journal.log(kind, arg)
+
+	def idle(self):
+		# nothing but timer 0 and key presses can end STOP mode, so sleep until either happens
+		timeout = self.timer.time_to_match()
+		self.wake_event.wait(self.idle_timeout if timeout is None else min(timeout, self.idle_timeout))
+		self.wake_event.clear()
+
+	def reset_core(self):
+		self.sim.u8_reset()
+		if self.config.hardware_id == 6:
+			self.scr[3][0] = self.scr[3][1] = None
+			for i in range(0x1000): self.sim.c_config.sfr[i] = 0xff
+			self.sim.c_config.sfr[2] = 0x13
+			self.sim.c_config.sfr[3] = 3
+			self.sim.c_config.sfr[4] = 2
+			self.sim.c_config.sfr[5] = 0x40
+			self.sim.c_config.sfr[0xa] = 3
+			self.sim.c_config.sfr[0xe] = 0
+			self.sim.c_config.sfr[0xf] = 0x82
+			self.sim.c_config.sfr[0x900] = 6
+			self.sim.c_config.sfr[1] = 0x30
+			for i in range(0x10, 0x4f): self.sim.c_config.sfr[i] = 0
+		elif self.config.hardware_id == 2 and self.is_5800p: self.sim.write_mem_data(4, 0x7ffe, 2, 0x44ff)
+
+		self.sim.c_config.call_depth = 0
+		self.sim.c_config.call_lost = 0
+		self.sim.c_config.int_count[:] = (0,) * MAX_INTS
+		self.standby.stop_mode = False
+		self.shutdown = False
+		self.sim.c_config.branch_top = 0
+		self.sim.c_config.branch_count = 0
+		self.wake_event.set()
+
+	# Returns the state as bytes if path is None, see savestate.py for the format
+	def save_state(self, path = None):
+		data = savestate.dump(self)
+		if path is None: return data
+		with open(path, 'wb') as f: f.write(data)
+
+	# src is a path or a bytes-like object returned by save_state()
+	def load_state(self, src):
+		if isinstance(src, (str, os.PathLike)):
+			with open(src, 'rb') as f: src = f.read()
+		savestate.load(self, src)
+		self.state_loaded()
+		self.state_edited()
+
+	# Python side fixups after the machine state was replaced
+	def state_loaded(self):
+		kb_matrix = self.sim.c_config.kb_matrix
+		self.keys_pressed = {(ki, ko) for ko in range(8) for ki in range(8) if kb_matrix[ko] & (1 << ki)}
+		self.wake_event.set()
+		self.idle_stop = None
+		if self.journal is not None: self.journal.resync()
+		self.sim.c_config.trace_sync = True
+
+	# Call after changing the machine state other than through core_step() or apply_input(),
+	# so reverse execution doesn't replay over the change
+	def state_edited(self):
+		if self.rewind is not None: self.rewind.checkpoint()
+		if self.journal is not None: self.journal.resync()
+
+	# Records inputs from here on to path, see journal.py
+	def start_journal(self, path):
+		self.stop_journal()
+		self.journal = journal.Journal(self, path)
+
+	def stop_journal(self):
+		if self.journal is None: return
+		self.journal.close()
+		self.journal = None
+
+	# Returns whether the RAM ended up as recorded, None if the journal doesn't say
+	def replay_journal(self, path): return journal.replay(self, path)
+
+	# Traces every instruction from here on to path, see exectrace.py
+	def start_trace(self, path):
+		self.stop_trace()
+		self.trace = exectrace.Trace(self, path)
+
+	def stop_trace(self):
+		if self.trace is None: return
+		self.trace.close()
+		self.trace = None
+
+	# Samples CSR:PC and the call stack every interval instructions from here on, see profiler.py
+	def start_profile(self, interval = None):
+		self.stop_profile()
+		self.profiler = profiler.Profiler(self, self.profile_interval if interval is None else interval)
+
+	# Writes the reports to path if given, see Profiler.write()
+	def stop_profile(self, path = None):
+		if self.profiler is None: return
+		self.profiler.close()
+		if path is not None: self.profiler.write(path)
+		self.profiler = None
+
+	# Counts reads and writes of every 256-byte data page and every SFR from here on
+	def start_heatmap(self):
+		if self.heat_pages is None:
+			self.heat_pages = (heat_t * HEAT_PAGES)()
+			self.heat_sfr = (heat_t * 0x1000)()
+		c_config = self.sim.c_config
+		c_config.heat_sfr = self.heat_sfr
+		c_config.heat_pages = self.heat_pages
+
+	# Stops counting, the counts so far are kept
+	def stop_heatmap(self): self.sim.c_config.heat_pages = None
+
+	def clear_heatmap(self):
+		if self.heat_pages is None: return
+		ctypes.memset(self.heat_pages, 0, ctypes.sizeof(self.heat_pages))
+		ctypes.memset(self.heat_sfr, 0, ctypes.sizeof(self.heat_sfr))
+
+	# (name, first seg:addr, last seg:addr, reads, writes) of each data memory region
+	def data_regions(self):
+		c_config = self.sim.c_config
+		mem = self.sim.core.mem
+		heat = self.sim.heat_regions() if self.heat_pages is not None else [(0, 0)] * mem.num_regions
+		ptr = lambda p: ctypes.cast(p, ctypes.c_void_p).value
+		regions = []
+		for i in range(mem.num_regions):
+			reg = mem.regions[i]
+			if reg.addr_l == 0xf000: name = 'SFRs'
+			elif reg.addr_l == 0x100000: name = 'Battery'
+			elif reg.acc == u8_mem_acc_e.U8_MACC_FUNC: name = 'Flash'
+			elif ptr(reg.array) == ptr(c_config.ram): name = 'Main RAM'
+			elif c_config.emu_seg_size and ptr(reg.array) == ptr(c_config.emu_seg): name = 'PRAM' if self.is_5800p else f'Segment {reg.addr_l >> 16}'
+			elif reg.addr_l == 0: name = 'ROM window'
+			else: name = f'Code segment {(ptr(reg.array) - ptr(c_config.rom)) >> 16} mirror'
+			regions.append((name, reg.addr_l, reg.addr_h, *heat[i]))
+		return regions
+
+	# Counts the executions of every opcode word from here on, see insmix.py
+	def start_op_counts(self):
+		if self.op_counts is None: self.op_counts = (ctypes.c_uint64 * 0x10000)()
+		self.sim.c_config.op_counts = self.op_counts
+
+	# Stops counting, the counts so far are kept
+	def stop_op_counts(self): self.sim.c_config.op_counts = None
+
+	def clear_op_counts(self):
+		if self.op_counts is not None: ctypes.memset(self.op_counts, 0, ctypes.sizeof(self.op_counts))
+
+	# Records which code runs from here on, see execcov.py
+	def start_coverage(self):
+		self.stop_coverage()
+		self.coverage = execcov.Coverage(self, self.coverage_counts)
+
+	# Writes the coverage to path if given
+	def stop_coverage(self, path = None):
+		if self.coverage is None: return
+		self.coverage.close()
+		if path: self.coverage.save(path)
+		self.coverage = None
+
+	# Analyses the ROM on a background thread, or loads the cached analysis.
+	# self.analysis is set when it is done.
+	def start_analysis(self):
+		rom = self.rom_bytes()
+		def analyse():
+			try: self.analysis = analysis.load_or_analyse(rom, self.rom_sha256, self.analysis_dir)
+			except Exception: logging.error(f'ROM analysis failed:\n{traceback.format_exc()}')
+		threading.Thread(target = analyse, daemon = True).start()
+
+	# Instant resume state for this ROM and hardware configuration
+	@property
+	def resume_path(self): return os.path.join(self.resume_dir, f'{self.rom_sha256.hex()}_{self.config.hardware_id}_{int(self.config.real_hardware)}_{self.ko_mode}.u8s.z')
+
+	def save_resume(self):
+		os.makedirs(self.resume_dir, exist_ok = True)
+		path = self.resume_path
+		with open(path + '.tmp', 'wb') as f: f.write(zlib.compress(self.save_state(), 1))
+		os.replace(path + '.tmp', path)
+
+	# Returns whether a resume state was loaded. Anything unusable means a cold boot.
+	def load_resume(self):
+		try:
+			with open(self.resume_path, 'rb') as f: data = zlib.decompress(f.read())
+		except FileNotFoundError: return False
+		except (OSError, zlib.error) as e:
+			logging.warning(f'Cannot read resume state, booting normally: {e}')
+			return False
+
+		try: self.load_state(data)
+		except ValueError as e:
+			logging.warning(f'Cannot use resume state, booting normally: {e}')
+			return False
+
+		return True
+
+	def ram_bytes(self): return ctypes.string_at(self.sim.c_config.ram, self.sim.ramsize)
+
+	# The ROM as mapped from 0:0000H on, without fx-5800P flash
+	def rom_bytes(self): return ctypes.string_at(self.sim.code_mem, self.sim.rom_length & ~1)
+
+	def get_instruction_label(self, addr):
+		if len(self.label_keys) != len(self.labels): self.label_keys = sorted(self.labels)
+		return instruction_label(self.labels, addr, self.label_keys)
+
+	def get_function_label(self, addr):
+		if len(self.label_keys) != len(self.labels): self.label_keys = sorted(self.labels)
+		return function_label(self.labels, addr, self.label_keys)
+
+	def get_addr_label(self, csr, pc):
+		label = self.get_instruction_label((csr << 16) + pc)
+		return f'{csr:X}:{pc:04X}H{" ("+label+")" if label is not None else ""}'
+
+	# For inputs from threads other than the one calling core_step()
+	def queue_input(self, press, key):
+		self.inputs.append((press, key))
+		self.wake_event.set()
+
+	# Keys that are pressed once the queued inputs are applied
+	def pending_keys(self):
+		keys = set(self.keys_pressed)
+		for press, key in tuple(self.inputs):
+			if press: keys.add(key)
+			else: keys.discard(key)
+		return keys
+
+	def apply_input(self, press, key):
+		self.log_event('press' if press else 'release', key)
+		if press: self.press_key(key)
+		else: self.release_key(key)
+
+	# Run without a GUI until max_steps instructions have run (None = no limit),
+	# the ROM shuts down, or something only a debugger could deal with happens.
+	# inputs is a list of (instruction count, press, key) as returned by load_inputs(),
+	# counted from the start of the run. An input due while the CPU sits in STOP mode
+	# with nothing else to wake it up is delivered straight away.
+	# Rewinding is off unless rewind is True, nothing could go back in time here.
+	def run(self, max_steps = None, inputs = (), rewind = False):
+		self.idle_in_stop = False
+		if not rewind: self.rewind = None
+		self.reset_core()
+		if self.config.hardware_id == 6: self.wdt.start_wdt()
+
+		inputs = sorted(inputs, key = lambda x: x[0])
+		idx = 0
+		start = self.sim.c_config.icount
+		end = None if max_steps is None else start + max_steps
+		while not self.shutdown:
+			icount = self.sim.c_config.icount
+			while idx < len(inputs) and start + inputs[idx][0] <= icount:
+				self.apply_input(*inputs[idx][1:])
+				idx += 1
+
+			steps = self.slice_steps
+			if idx < len(inputs): steps = min(steps, start + inputs[idx][0] - icount)
+			if end is not None: steps = min(steps, end - icount)
+			if steps <= 0: return stop_reason_e.STOP_NONE
+
+			reason = self.core_step(steps)
+			if reason in (stop_reason_e.STOP_BRK, stop_reason_e.STOP_WILD, stop_reason_e.STOP_BRKPOINT, stop_reason_e.STOP_WATCH): return reason
+			# nothing left that could wake the CPU up but the next input
+			if reason == stop_reason_e.STOP_STOPMODE and self.standby.stop_mode and self.timer.time_to_match() is None:
+				if idx == len(inputs): return reason
+				self.apply_input(*inputs[idx][1:])
+				idx += 1
+
+		return stop_reason_e.STOP_NONE
+
+# Input scripts have one event per line: <instruction count> press|release <key>
+# where <key> is "KI KO", "reset" for the core reset key, or a key ID on TI MathPrint.
+# Everything after a # is ignored.
+def load_inputs(path):
+	inputs = []
+	with open(path) as f:
+		for n, line in enumerate(f, 1):
+			tokens = line.split('#', 1)[0].split()
+			if not tokens: continue
+			try:
+				icount = int(tokens[0], 0)
+				if tokens[1] not in ('press', 'release'): raise ValueError(f'unknown action {tokens[1]!r}')
+				key = journal.parse_key(tokens[2:])
+			except (IndexError, ValueError) as e: raise ValueError(f'{path}:{n}: {e}') from None
+			inputs.append((icount, tokens[1] == 'press', key))
+	return inputs
+
+# Loads label files in the format of pyu8disas's labeltool.
+# Returns code labels, data labels and data bit labels.
+def load_labels(files):
+	if 'pyu8disas' not in sys.path: sys.path.append('pyu8disas')
+	from pyu8disas.labeltool import labeltool
+
+	labels, data_labels, data_bit_labels = {}, {}, {}
+	for file in files:
+		with open(file) as f: code, data, data_bit = labeltool.load_labels(f, 0)
+		labels.update(code)
+		data_labels.update(data)
+		data_bit_labels.update(data_bit)
+	return labels, data_labels, data_bit_labels
+
+# Code label of CSR:PC addr as name+offset, None if no label comes before it in the same segment.
+# keys is the label addresses in ascending order.
+def instruction_label(labels, addr, keys):
+	i = bisect.bisect_right(keys, addr)
+	if i == 0: return
+	near = keys[i - 1]
+	if near >> 16 != addr >> 16: return
+	label = labels[near]
+	offset = addr - near
+	offset_str = hex(offset) if offset > 9 else str(offset)
+	return f'{label[0] if label[1] else labels[label[2]][0]+label[0]}{"+"+offset_str if offset != 0 else ""}'
+
+# Name of the function CSR:PC addr is in, that is the global label at or before it
+# in the same segment, None if there is none. keys is as for instruction_label().
+def function_label(labels, addr, keys):
+	i = bisect.bisect_right(keys, addr)
+	if i == 0: return
+	near = keys[i - 1]
+	if near >> 16 != addr >> 16: return
+	label = labels[near]
+	return label[0] if label[1] else labels[label[2]][0]
+
+def load_config(path = None):
+	global config
+
+	logging.info(f'Importing config script {path if path is not None else "config.py"}')
+	spec = importlib.util.spec_from_file_location('config', path if path is not None else 'config.py')
+	if spec is None:
+		logging.warning(f'Cannot import config script as file, importing as module')
+		try: config = importlib.import_module(path if path is not None else 'config')
+		except ImportError as e:
+			logging.error(f'Cannot import config script as module: {str(e)}')
+			sys.exit()
+	else:
+		config = importlib.util.module_from_spec(spec)
+		sys.modules['config'] = config
+		spec.loader.exec_module(config)
+
+	if hasattr(config, 'dt_format') and config.dt_format != '%d/%m/%Y %H:%M:%S':
+		logging.basicConfig(datefmt = config.dt_format, format = '[%(asctime)s] %(levelname)s: %(message)s', level = logging.root.level, force = True)
+		logging.info(f'Config script imported sucessfully. Date-time format is {config.dt_format}')
+	else: logging.info('Config script imported sucessfully')
+
+	return config
+
+def load_lib():
+	global sim_lib
+
+	sim_lib = ctypes.CDLL(os.path.abspath(config.shared_lib))
+
+	sim_lib.u8_step.argtypes = [ctypes.POINTER(u8_core_t)]
+
+	sim_lib.setup_mcu.argtypes = [ctypes.POINTER(c_config), ctypes.POINTER(u8_core_t), ctypes.POINTER(ctypes.c_uint8), ctypes.POINTER(ctypes.c_uint8), ctypes.c_int, ctypes.c_int]
+	sim_lib.free_mcu.argtypes = [ctypes.POINTER(c_config), ctypes.POINTER(u8_core_t)]
+	sim_lib.run_steps.argtypes = [ctypes.POINTER(c_config), ctypes.POINTER(u8_core_t), ctypes.c_int, ctypes.c_int]
+	sim_lib.run_steps.restype = ctypes.c_int
+	sim_lib.set_brkpoint.argtypes = [ctypes.POINTER(c_config), ctypes.c_uint32, ctypes.c_bool]
+	sim_lib.clear_watchpoints.argtypes = [ctypes.POINTER(c_config)]
+	sim_lib.add_watchpoint.argtypes = [ctypes.POINTER(c_config), ctypes.c_int, ctypes.c_uint32, ctypes.c_uint32]
+	sim_lib.add_watchpoint.restype = ctypes.c_bool
+	sim_lib.timer_tick.argtypes = [ctypes.POINTER(c_config), ctypes.POINTER(u8_core_t), ctypes.c_uint32]
+	sim_lib.timer_skip.argtypes = [ctypes.POINTER(c_config), ctypes.POINTER(u8_core_t)]
+	sim_lib.timer_ticks_left.argtypes = [ctypes.POINTER(c_config)]
+	sim_lib.timer_ticks_left.restype = ctypes.c_uint32
+	sim_lib.heat_regions.argtypes = [ctypes.POINTER(c_config), ctypes.POINTER(u8_core_t), ctypes.POINTER(heat_t)]
+	sim_lib.diff_pages.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_void_p]
+	sim_lib.diff_pages.restype = ctypes.c_int
+	sim_lib.undo_pages.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int]
+
+	sim_lib.read_reg_er.argtypes = [ctypes.POINTER(u8_core_t), ctypes.c_uint8]
+	sim_lib.read_reg_er.restype = ctypes.c_uint16
+
+	sim_lib.read_mem_data.argtypes = [ctypes.POINTER(u8_core_t), ctypes.c_uint8, ctypes.c_uint16, ctypes.c_uint8]
+	sim_lib.read_mem_data.restype = ctypes.c_uint64
+	sim_lib.write_mem_data.argtypes = [ctypes.POINTER(u8_core_t), ctypes.c_uint8, ctypes.c_uint16, ctypes.c_uint8, ctypes.c_uint64]
+
+	return sim_lib
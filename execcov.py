@@ -0,0 +1,156 @@
+# Code coverage
+#
+# The native run loop sets a bit for every code halfword it executes, over
+# the whole 1 MiB code space (CSR 0-F), and can also count how often each
+# instruction ran, saturating at 255. Wide instructions get both halfwords
+# marked. Coverage is kept across resets and state loads, so it covers
+# everything a session or a headless run executed.
+#
+# Coverage files (native byte order):
+#   header   magic, format version (u16), flags (u8, 1 = has counts), hardware ID (u8),
+#            ROM SHA-256, number of runs merged into the file (u32)
+#   data     zlib compressed bitmap (BITMAP_SIZE bytes), followed by the counts
+#            (HALFWORDS bytes) if there are any
+#
+# Usage:
+#   execcov.py merge -o <output> <file>...    adds up runs of the same ROM
+#   execcov.py report <file> [-c config] [--missed]
+#                                             coverage per labelled function
+
+import os
+import sys
+import ctypes
+import struct
+import logging
+import argparse
+import zlib
+
+MAGIC = b'U8CV'
+VERSION = 1
+HALFWORDS = 0x80000
+BITMAP_SIZE = HALFWORDS // 8
+HAS_COUNTS = 1
+
+header = struct.Struct('<4sHBB32sI')
+
+class Coverage:
+	def __init__(self, emu, counts = False):
+		self.emu = emu
+		self.bitmap = (ctypes.c_uint8 * BITMAP_SIZE)()
+		self.counts = (ctypes.c_uint8 * HALFWORDS)() if counts else None
+
+		c_config = emu.sim.c_config
+		c_config.cov_bitmap = self.bitmap
+		c_config.cov_counts = self.counts
+
+	def close(self):
+		c_config = self.emu.sim.c_config
+		c_config.cov_bitmap = None
+		c_config.cov_counts = None
+
+	def save(self, path): dump(path, self.emu.rom_sha256, self.emu.config.hardware_id, bytes(self.bitmap), None if self.counts is None else bytes(self.counts))
+
+def dump(path, rom_sha256, hwid, bitmap, counts = None, runs = 1):
+	with open(path + '.tmp', 'wb') as f:
+		f.write(header.pack(MAGIC, VERSION, HAS_COUNTS if counts is not None else 0, hwid, rom_sha256, runs))
+		f.write(zlib.compress(bitmap + (counts or b''), 6))
+	os.replace(path + '.tmp', path)
+
+# Returns (ROM SHA-256, hardware ID, bitmap, counts or None, runs) of a coverage file,
+# raising ValueError if it is not one
+def load(path):
+	with open(path, 'rb') as f: data = f.read()
+	if len(data) < header.size: raise ValueError(f'{path}: not a coverage file')
+	magic, version, flags, hwid, rom_sha256, runs = header.unpack_from(data)
+	if magic != MAGIC: raise ValueError(f'{path}: not a coverage file')
+	if version > VERSION: raise ValueError(f'{path}: coverage format version {version} is not supported')
+	try: data = zlib.decompress(data[header.size:])
+	except zlib.error as e: raise ValueError(f'{path}: {e}') from None
+	size = BITMAP_SIZE + (HAS_COUNTS & flags) * HALFWORDS
+	if len(data) != size: raise ValueError(f'{path}: truncated coverage data')
+	return rom_sha256, hwid, data[:BITMAP_SIZE], data[BITMAP_SIZE:] if flags & HAS_COUNTS else None, runs
+
+# Adds up coverage files of the same ROM. Counts are kept only if every file has them.
+def merge(paths):
+	rom_sha256, hwid, bitmap, counts, runs = load(paths[0])
+	bitmap = int.from_bytes(bitmap, 'little')
+	counts = None if counts is None else bytearray(counts)
+	for path in paths[1:]:
+		rom_sha256_, _, bitmap_, counts_, runs_ = load(path)
+		if rom_sha256_ != rom_sha256: raise ValueError(f'{path}: coverage of a different ROM')
+		bitmap |= int.from_bytes(bitmap_, 'little')
+		if counts is not None and counts_ is not None:
+			for i in (i for i, n in enumerate(counts_) if n): counts[i] = min(counts[i] + counts_[i], 0xff)
+		else: counts = None
+		runs += runs_
+	return rom_sha256, hwid, bitmap.to_bytes(BITMAP_SIZE, 'little'), None if counts is None else bytes(counts), runs
+
+# Halfwords of [start, end) that were executed
+def covered(bitmap, start, end):
+	h0, h1 = start >> 1, end >> 1
+	n = 0
+	for i in range(h0 >> 3, (h1 + 7) >> 3):
+		byte = bitmap[i]
+		if not byte: continue
+		if i == h0 >> 3: byte &= 0xff << (h0 & 7)
+		if i == h1 >> 3: byte &= (1 << (h1 & 7)) - 1
+		n += bin(byte).count('1')
+	return n
+
+# [(address, name, size in bytes, halfwords executed, times the entry ran or None)]
+# of every global code label, where a function runs until the next global label
+# or the end of its segment. labels is as returned by emulator.load_labels().
+def functions(labels, bitmap, counts = None):
+	names = {addr & 0xffffe: label[0] for addr, label in labels.items() if label[1]}
+	starts = sorted(names)
+	result = []
+	for i, addr in enumerate(starts):
+		end = (addr | 0xffff) + 1
+		if i + 1 < len(starts) and starts[i + 1] < end: end = starts[i + 1]
+		result.append((addr, names[addr], end - addr, covered(bitmap, addr, end), None if counts is None else counts[addr >> 1]))
+	return result
+
+def report(path, labels, missed = False, out = sys.stdout):
+	_, _, bitmap, counts, runs = load(path)
+	total = covered(bitmap, 0, HALFWORDS * 2)
+	out.write(f'# {runs} run{"s" if runs != 1 else ""}, {total} code halfwords executed\n')
+	if not labels: return
+
+	funcs = functions(labels, bitmap, counts)
+	entered = sum(1 for f in funcs if bitmap[f[0] >> 4] & (1 << (f[0] >> 1 & 7)))
+	out.write(f'# {entered} of {len(funcs)} functions entered\n')
+	out.write(f'{"address":>8} {"covered":>8} {"halfwords":>11}{"  entries " if counts is not None else ""} function\n')
+	for addr, name, size, hit, entries in funcs:
+		if missed and hit: continue
+		entries = '' if entries is None else f' {entries:8}' + ('+' if entries == 0xff else ' ')
+		out.write(f'{addr >> 16:X}:{addr & 0xffff:04X}H {hit * 200 / size:7.1f}% {hit:5}/{size // 2:<5}{entries} {name}\n')
+
+if __name__ == '__main__':
+	logging.basicConfig(datefmt = '%d/%m/%Y %H:%M:%S', format = '[%(asctime)s] %(levelname)s: %(message)s', level = logging.INFO)
+
+	parser = argparse.ArgumentParser(description = 'Merge and report code coverage files')
+	sub = parser.add_subparsers(dest = 'command', required = True)
+	p = sub.add_parser('merge', help = 'add up coverage files of the same ROM')
+	p.add_argument('files', nargs = '+', help = 'coverage files written with --coverage or coverage_file')
+	p.add_argument('-o', '--output', required = True, help = 'merged coverage file')
+	p = sub.add_parser('report', help = 'list the coverage of every labelled function')
+	p.add_argument('file', help = 'coverage file')
+	p.add_argument('-c', '--config', help = 'config script to take code labels from (default: config.py)')
+	p.add_argument('--missed', action = 'store_true', help = 'only list functions that never ran')
+	args = parser.parse_args()
+
+	try:
+		if args.command == 'merge':
+			rom_sha256, hwid, bitmap, counts, runs = merge(args.files)
+			dump(args.output, rom_sha256, hwid, bitmap, counts, runs)
+			logging.info(f'Merged {runs} runs into {args.output}')
+		else:
+			import emulator
+			labels = {}
+			cfg = emulator.load_config(args.config)
+			if hasattr(cfg, 'labels') and cfg.labels: labels = emulator.load_labels(cfg.labels)[0]
+			else: logging.warning('No labels in the config script, only the total is reported')
+			report(args.file, labels, args.missed)
+	except (OSError, ValueError) as e:
+		logging.error(e)
+		sys.exit(1)
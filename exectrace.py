@@ -0,0 +1,130 @@
+# Execution traces
+#
+# The native run loop writes one fixed-size record per instruction straight
+# into a memory-mapped file, see struct trace_record in peripheral.c. When the
+# mapping is full, run_steps() returns STOP_TRACE and Trace.grow() extends the
+# file by another chunk, so nothing of the trace is kept in Python memory.
+#
+# File layout:
+#   header   magic, format version (u16), record size (u16), hardware ID (u8), register
+#            block size (u8), ROM SHA-256, registers at the start (struct u8_regs),
+#            padded to HEADER_SIZE
+#   records  RECORD_SIZE bytes each:
+#     instruction   CSR:PC (u32), opcode word and the word after it (2 x u16),
+#                   last read and last write (u32 each, size << 24 | seg:addr, 0 if none),
+#                   changed register byte count (u8), (offset, value) pairs
+#     TRACE_CONT    more changed register bytes of the instruction before it
+#     TRACE_SYNC    instruction count of the next instruction (u64); the first
+#                   record, and again wherever the count jumped (state loads, rewinding)
+
+import ctypes
+import mmap
+import struct
+
+MAGIC = b'U8TR'
+VERSION = 1
+HEADER_SIZE = 128
+RECORD_SIZE = 32
+CHUNK = 64 << 20  # bytes the file grows by
+
+TRACE_CONT = 0xffffffff
+TRACE_SYNC = 0xfffffffe
+
+header = struct.Struct('<4sHHBB2x32s')
+ins_record = struct.Struct('<IHHIIB14sx')
+cont_record = struct.Struct('<IB26sx')
+sync_record = struct.Struct('<IQ20x')
+
+class Trace:
+	def __init__(self, emu, path, chunk = CHUNK):
+		self.emu = emu
+		self.path = path
+		self.chunk = chunk // RECORD_SIZE
+		self.cap = 0
+		self.map = None
+		self.buf = None
+
+		regs = bytes(emu.sim.core.regs)
+		self.file = open(path, 'w+b')
+		self.file.write(header.pack(MAGIC, VERSION, RECORD_SIZE, emu.config.hardware_id, len(regs), emu.rom_sha256) + regs)
+		self.file.truncate(HEADER_SIZE)
+
+		c_config = emu.sim.c_config
+		c_config.trace_regs[:] = regs
+		c_config.trace_pos = 0
+		c_config.trace_sync = True
+		self.grow()
+
+	def unmap(self):
+		c_config = self.emu.sim.c_config
+		c_config.trace_buf = None
+		c_config.trace_cap = 0
+		# the ctypes view has to go before the mapping can be closed
+		self.buf = None
+		if self.map is not None: self.map.close()
+		self.map = None
+
+	# Called by Core.run_steps() when the native loop runs out of room
+	def grow(self):
+		self.unmap()
+		self.cap += self.chunk
+		self.file.truncate(HEADER_SIZE + self.cap * RECORD_SIZE)
+		self.map = mmap.mmap(self.file.fileno(), HEADER_SIZE + self.cap * RECORD_SIZE)
+		self.buf = ctypes.c_char.from_buffer(self.map, HEADER_SIZE)
+
+		c_config = self.emu.sim.c_config
+		c_config.trace_buf = ctypes.cast(ctypes.addressof(self.buf), type(c_config.trace_buf))
+		c_config.trace_cap = self.cap
+
+	# Number of records written so far
+	@property
+	def records(self): return self.emu.sim.c_config.trace_pos
+
+	def close(self):
+		used = self.records
+		self.unmap()
+		self.emu.sim.c_config.trace_pos = 0
+		self.file.truncate(HEADER_SIZE + used * RECORD_SIZE)
+		self.file.close()
+
+# Returns (hardware ID, ROM SHA-256, starting registers) of a trace file,
+# raising ValueError if it is not one
+def read_header(f):
+	data = f.read(HEADER_SIZE)
+	if len(data) < HEADER_SIZE: raise ValueError('Not a trace file')
+	magic, version, record_size, hwid, regs_size, rom_sha256 = header.unpack_from(data)
+	if magic != MAGIC: raise ValueError('Not a trace file')
+	if version > VERSION or record_size != RECORD_SIZE: raise ValueError(f'Trace format version {version} is not supported')
+	return hwid, rom_sha256, data[header.size:header.size+regs_size]
+
+# Streams the instructions of a trace file as (instruction count, CSR:PC, opcode
+# words, read, write, changed registers), where read and write are (seg:addr, size)
+# or None, and changed registers is a list of (offset into u8_regs, new value).
+# block is the number of records read at a time.
+def instructions(path, block = 1 << 16):
+	with open(path, 'rb') as f:
+		read_header(f)
+		icount = 0
+		pending = None
+		while True:
+			data = f.read(block * RECORD_SIZE)
+			if not data: break
+			for pos in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+				csrpc = int.from_bytes(data[pos:pos+4], 'little')
+				if csrpc == TRACE_CONT:
+					_, n, pairs = cont_record.unpack_from(data, pos)
+					if pending is not None: pending[5].extend(zip(pairs[0:2*n:2], pairs[1:2*n:2]))
+					continue
+
+				if pending is not None:
+					yield tuple(pending)
+					pending = None
+				if csrpc == TRACE_SYNC:
+					icount = sync_record.unpack_from(data, pos)[1]
+					continue
+
+				_, ins0, ins1, read, write, n, pairs = ins_record.unpack_from(data, pos)
+				pending = [icount, csrpc, (ins0, ins1), (read & 0xffffff, read >> 24) if read else None, (write & 0xffffff, write >> 24) if write else None, list(zip(pairs[0:2*n:2], pairs[1:2*n:2]))]
+				icount += 1
+
+		if pending is not None: yield tuple(pending)
@@ -1,5 +1,6 @@
 from .brkpoint import Brkpoint
 from .jump import Jump
 from .hexed import DataMem, Write
+from .heatmap import Heatmap
 from .regmodify import GPModify
 from .debugger import RegDisplay, CallStackDisplay, Debugger
@@ -69,6 +69,14 @@ class BrkpointFrame(tk.Frame):
 
 		ttk.Label(self, text = 'H   ').pack(side = 'left')
 
+		# end of the watched range, read/write breakpoints only
+		self.end_frame = tk.Frame(self)
+		ttk.Label(self.end_frame, text = 'to ').pack(side = 'left')
+		self.end = ttk.Entry(self.end_frame, width = 6, justify = 'left', validate = 'key', validatecommand = (self.vcmd, '%S', '%P', '%d', range(0x10000)))
+		self.end.bind('<KeyPress>', self.cap_input)
+		self.end.pack(side = 'left')
+		ttk.Label(self.end_frame, text = 'H   ').pack(side = 'left')
+
 		self.label = tk.StringVar()
 		self.labelselect = ttk.Combobox(self, width = 27, textvariable = self.label)
 		if self.show_exec_labels:
@@ -79,6 +87,8 @@ class BrkpointFrame(tk.Frame):
 
 	def change_type(self):
 		self.gui.sim.brkpoints[self.index]['type'] = self.type.get()
+		self.gui.sim.update_brkpoint(self.gui.sim.brkpoints[self.index]['addr'])
+		self.end_frame.pack_forget()
 		self.labelselect.pack_forget()
 
 		if self.type.get() == 0:
@@ -99,6 +109,7 @@ class BrkpointFrame(tk.Frame):
 		else:
 			self.csr['validatecommand'] = (self.vcmd, '%S', '%P', '%d', range(0x100))
 			self.pc['validatecommand'] = (self.vcmd, '%S', '%P', '%d', range(0x10000))
+			self.end_frame.pack(side = 'left')
 
 			if self.show_data_labels:
 				self.label = ''
@@ -113,15 +124,24 @@ class BrkpointFrame(tk.Frame):
 	def focusout(self, event = None):
 		self.pc.insert(0, '0'*(4-len(self.pc.get())))
 		self.csr.insert(0, '0'*(1+(self.type.get() != 0)-len(self.csr.get())))
+		if self.end.get(): self.end.insert(0, '0'*(4-len(self.end.get())))
 
 		self.change_type()
 
+		old_addr = self.gui.sim.brkpoints[self.index]['addr']
 		self.gui.sim.brkpoints[self.index]['addr'] = (int(self.csr.get(), 16) << 16) + int(self.pc.get(), 16)
+		self.gui.sim.brkpoints[self.index]['end'] = (int(self.csr.get(), 16) << 16) + int(self.end.get(), 16) if self.end.get() else self.gui.sim.brkpoints[self.index]['addr']
+		self.gui.sim.update_brkpoint(old_addr)
+		self.gui.sim.update_brkpoint(self.gui.sim.brkpoints[self.index]['addr'])
 
-	def set_enable(self): self.gui.sim.brkpoints[self.index]['enabled'] = self.enabled.get()
+	def set_enable(self):
+		self.gui.sim.brkpoints[self.index]['enabled'] = self.enabled.get()
+		self.gui.sim.update_brkpoint(self.gui.sim.brkpoints[self.index]['addr'])
 
 	def destroy(self):
+		addr = self.gui.sim.brkpoints[self.index]['addr']
 		del self.gui.sim.brkpoints[self.index]
+		self.gui.sim.update_brkpoint(addr)
 		if len(self.gui.sim.brkpoints) == 0: self.gui.clearbutton['state'] = 'disabled'
 		super().destroy()
 
@@ -153,7 +173,7 @@ class Brkpoint(tk.Toplevel):
 		if len(self.sim.brkpoints) == 0: self.clearbutton['state'] = 'normal'
 
 		widget = BrkpointFrame(self.brkpointframe.interior, self, idx)
-		self.sim.brkpoints[idx] = {'enabled': True, 'type': 0, 'addr': None, 'widget': widget}
+		self.sim.brkpoints[idx] = {'enabled': True, 'type': 0, 'addr': None, 'end': None, 'widget': widget}
 		widget.pack(fill = 'x')
 
 	def clear_all(self, confirm = True):
@@ -1,6 +1,11 @@
 import tkinter as tk
 import tkinter.ttk as ttk
 import functools
+import time
+
+import insmix
+import analysis
+from .disasview import DisasView
 
 class RegDisplay(tk.Toplevel):
 	def __init__(self, sim, fg = None, bg = None, font = None):
@@ -12,6 +17,7 @@ class RegDisplay(tk.Toplevel):
 		self.title('Register display')
 		self.protocol('WM_DELETE_WINDOW', self.withdraw)
 		self.bind('\\', lambda x: self.sim.set_step())
+		if self.sim.rewind is not None: self.bind('|', lambda x: self.sim.reverse_step())
 		self.sim.bind_(self, 's', lambda x: self.sim.set_single_step(True))
 		self.sim.bind_(self, 'p', lambda x: self.sim.set_single_step(False))
 		self['bg'] = bg
@@ -40,7 +46,9 @@ class RegDisplay(tk.Toplevel):
 		sp = regs.sp
 		psw = regs.psw
 		psw_f = format(psw, '08b')
-		label = self.sim.get_instruction_label((csr << 16) + pc)
+		int_counts = self.sim.sim.int_counts()
+		branch = self.sim.last_branch
+		last_branch = f'{self.sim.get_addr_label(branch[0] >> 16, branch[0] & 0xffff)} ⇨ {self.sim.get_addr_label(branch[1] >> 16, branch[1] & 0xffff)}' if branch is not None else 'None'
 		nl = '\n'
 
 		if wm_state == 'normal': self.info_label['text'] = f'''\
@@ -55,7 +63,7 @@ R8   R9   R10  R11  R12  R13  R14  R15
 
 Control registers:
 CSR:PC          {self.sim.get_addr_label(csr, pc)}
-Previous CSR:PC {self.sim.prev_csr_pc} -- Prev. Prev.: {self.sim.prev_prev_csr_pc}
+Last branch     {last_branch}
 Opcode          ''' + ''.join(format(self.sim.read_cmem((pc + i*2) & 0xfffe, csr), '04X') for i in range(ins_len // 2)) + f'''
 Instruction     {ins}
 SP              {sp:04X}H
@@ -83,8 +91,11 @@ Shutdown state           [{'x' if self.sim.shutdown else ' '}]
 Last SWI value           {last_swi if last_swi < 0x40 else 'None'}\
 {nl+'Flash mode               ' + str(self.sim.sim.c_config.flash_mode) if self.sim.sim.c_config.hwid == 2 and self.sim.is_5800p else ''}\
 {nl+'Counts until next WDTINT ' + str(self.sim.wdt.counter) if self.sim.sim.c_config.hwid == 6 else ''}\
-{(nl+'Instructions per second  ' + (format(self.sim.ips, '.1f') if self.sim.ips is not None and not self.sim.single_step else 'None') if self.sim.enable_ips else '')}\
-'''
+{nl+'Timer 0 ticks to match   ' + str(self.sim.sim.timer_ticks_left()) if self.sim.sim.c_config.hwid != 6 and self.sim.sim.c_config.sfr[0x25] & 1 else ''}\
+{(nl+'Instructions per second  ' + (format(self.sim.ips, '.1f') if self.sim.ips is not None and not self.sim.single_step else 'None') if self.sim.enable_ips else '')}
+
+Interrupts taken:
+''' + (nl.join(f'{name:<24} {count}' for name, count in int_counts if count) or 'None')
 
 class CallStackDisplay(tk.Toplevel):
 	def __init__(self, sim, fg = None, bg = None, font = None):
@@ -114,13 +125,16 @@ class CallStackDisplay(tk.Toplevel):
 
 
 		if wm_state == 'normal':
+			call_trace = self.sim.call_trace
+			call_lost = self.sim.sim.c_config.call_lost
 			a = []
-			for j in range(len(self.sim.call_trace)):
-				i = self.sim.call_trace[j]
-				a.append(f'#{j}{nl}Function address  {self.sim.get_addr_label(i[0] >> 16, i[0] & 0xfffe)}{nl}Return address    {self.sim.get_addr_label(i[1] >> 16, i[1] & 0xfffe)}{nl*2}')
+			for j in range(len(call_trace)):
+				i = call_trace[j]
+				a.append(f'#{j}{nl}Function address  {self.sim.get_addr_label(i[0] >> 16, i[0] & 0xfffe)}{nl}Return address    {self.sim.get_addr_label(i[1] >> 16, i[1] & 0xfffe)}{nl}SP at call        {i[2]:04X}H{nl}Instruction #     {i[3]}{nl*2}')
+			if call_lost: a.append(f'({call_lost} older calls not shown)')
 
 			self.info_label['text'] = f'''\
-=== CALL STACK === ({len(self.sim.call_trace)} calls)
+=== CALL STACK === ({len(call_trace) + call_lost} calls)
 {''.join(a)}
 '''
 
@@ -129,26 +143,25 @@ class Debugger(tk.Toplevel):
 		super(Debugger, self).__init__()
 		self.sim = sim
 
-		self.disas_hi = 17
-
 		self.withdraw()
-		self.geometry('1200x600')
+		self.geometry('1600x600')
 		self.resizable(False, False)
 		self.title('Debugger (beta)')
 		self.protocol('WM_DELETE_WINDOW', self.withdraw)
 
 		self.bind('\\', lambda x: self.sim.set_step())
+		if self.sim.rewind is not None: self.bind('|', lambda x: self.sim.reverse_step())
 		self.sim.bind_(self, 's', lambda x: self.sim.set_single_step(True))
 		self.sim.bind_(self, 'p', lambda x: self.sim.set_single_step(False))
 
-		f_disas = tk.Frame(self, width = 800, height = 300)
+		f_disas = tk.Frame(self, width = 800, height = 340)
 		f_disas.grid(row = 0, column = 0, sticky = 'nw')
 		f_disas.pack_propagate(False)
 		ttk.Label(f_disas, text = 'Disassembly').pack()
-		self.disas = tk.Text(f_disas, state = 'disabled', height = self.disas_hi)
-		self.disas.pack(fill = 'x')
+		self.disas = DisasView(f_disas, self.sim, 17)
+		self.disas.pack(fill = 'both', expand = True)
 
-		f_regs = tk.Frame(self, width = 800, height = 300)
+		f_regs = tk.Frame(self, width = 800, height = 260)
 		f_regs.grid(row = 0, column = 0, sticky = 'sw')
 		f_regs.pack_propagate(False)
 		ttk.Label(f_regs, text = 'Register list').pack()
@@ -172,7 +185,57 @@ class Debugger(tk.Toplevel):
 		self.call_stack.configure(yscrollcommand = scroll.set)
 		scroll.pack(side = 'right', fill = 'y')
 		self.call_stack.pack(side = 'left', fill = 'both', expand = True)
-		
+
+		f_tabs = tk.Frame(self, width = 400, height = 600)
+		f_tabs.grid(row = 0, column = 2, sticky = 'se')
+		f_tabs.pack_propagate(False)
+		self.tabs = tabs = ttk.Notebook(f_tabs)
+		tabs.pack(fill = 'both', expand = True)
+		tabs.bind('<<NotebookTabChanged>>', lambda x: self.update_tabs(True))
+		# the instruction mix and cross references are redrawn at most this often while running
+		self.tab_interval = 0.5
+		self.last_tab_update = 0
+
+		f_branch = tk.Frame(tabs)
+		tabs.add(f_branch, text = 'Branch history')
+		ttk.Label(f_branch, text = 'Newest first', justify = 'center').pack()
+		self.branch_list = tk.Text(f_branch, state = 'disabled')
+		scroll = tk.Scrollbar(f_branch, orient = 'vertical', command = self.branch_list.yview)
+		self.branch_list.configure(yscrollcommand = scroll.set)
+		scroll.pack(side = 'right', fill = 'y')
+		self.branch_list.pack(side = 'left', fill = 'both', expand = True)
+
+		self.f_mix = f_mix = tk.Frame(tabs)
+		tabs.add(f_mix, text = 'Instruction mix')
+		f_mix_opts = tk.Frame(f_mix)
+		f_mix_opts.pack(fill = 'x')
+		self.count_ops = tk.BooleanVar(value = False)
+		ttk.Checkbutton(f_mix_opts, text = 'Count instructions', variable = self.count_ops, command = self.set_count_ops).pack(side = 'left')
+		ttk.Button(f_mix_opts, text = 'Clear', command = self.clear_mix).pack(side = 'left')
+		ttk.Button(f_mix_opts, text = 'Export CSV...', command = self.export_mix).pack(side = 'left')
+		self.mix_total = ttk.Label(f_mix)
+		self.mix_total.pack(fill = 'x')
+		self.mix_list = ttk.Treeview(f_mix, columns = ('count', 'percent'))
+		self.mix_list.heading('#0', text = 'Instruction')
+		self.mix_list.heading('count', text = 'Count')
+		self.mix_list.heading('percent', text = '%')
+		self.mix_list.column('#0', width = 200)
+		self.mix_list.column('count', width = 100, anchor = 'e')
+		self.mix_list.column('percent', width = 60, anchor = 'e')
+		scroll = tk.Scrollbar(f_mix, orient = 'vertical', command = self.mix_list.yview)
+		self.mix_list.configure(yscrollcommand = scroll.set)
+		scroll.pack(side = 'right', fill = 'y')
+		self.mix_list.pack(side = 'left', fill = 'both', expand = True)
+		self.insmix = insmix.InsMix(insmix.load_disassembler())
+
+		self.f_xrefs = f_xrefs = tk.Frame(tabs)
+		tabs.add(f_xrefs, text = 'Cross references')
+		self.xrefs = tk.Text(f_xrefs, state = 'disabled')
+		scroll = tk.Scrollbar(f_xrefs, orient = 'vertical', command = self.xrefs.yview)
+		self.xrefs.configure(yscrollcommand = scroll.set)
+		scroll.pack(side = 'right', fill = 'y')
+		self.xrefs.pack(side = 'left', fill = 'both', expand = True)
+
 	def open(self):
 		self.deiconify()
 		self.update()
@@ -181,37 +244,99 @@ class Debugger(tk.Toplevel):
 		try: wm_state = self.wm_state()
 		except Exception: return
 
-		regs = self.sim.sim.core.regs
-
 		nl = '\n'
 
 		if wm_state == 'normal':
-			instructions = ['']*self.disas_hi
-			cur_csr = regs.csr
-			cur_pc = regs.pc
-			format_ins = lambda ins_len, inst: f'{">>>" if i == 0 else "   "} {cur_csr:X}:{cur_pc:04X}H    {"".join(format(self.sim.read_cmem((cur_pc + i*2) & 0xfffe, cur_csr), "04X") for i in range(ins_len // 2)):<13}    {inst}'
-			for i in range(self.disas_hi):
-				ins, ins_len = self.sim.decode_instruction(cur_csr, cur_pc)
-				instructions[i] = format_ins(ins_len, ins)
-				cur_pc = (cur_pc + ins_len) & 0xfffe
-
-			self.disas['state'] = 'normal'
-			self.disas.delete('1.0', 'end')
-			self.disas.insert('1.0', nl.join(instructions))
-			self.disas['state'] = 'disabled'
+			self.disas.update()
 
 			for i in range(16):
 				if self.r[i].get() != f'{self.sim.sim.core.regs.gp[i]:02X}': self.r[i].set(f'{self.sim.sim.core.regs.gp[i]:02X}')
 
+			call_trace = self.sim.call_trace
+			call_lost = self.sim.sim.c_config.call_lost
 			a = []
-			for j in range(len(self.sim.call_trace)):
-				i = self.sim.call_trace[j]
-				a.append(f'#{j}{nl}⇨ {self.sim.get_addr_label(i[0] >> 16, i[0] & 0xfffe)}{nl}⇦ {self.sim.get_addr_label(i[1] >> 16, i[1] & 0xfffe)}{nl*2}')
+			for j in range(len(call_trace)):
+				i = call_trace[j]
+				a.append(f'#{j} (SP {i[2]:04X}H, #{i[3]}){nl}⇨ {self.sim.get_addr_label(i[0] >> 16, i[0] & 0xfffe)}{nl}⇦ {self.sim.get_addr_label(i[1] >> 16, i[1] & 0xfffe)}{nl*2}')
+			if call_lost: a.append(f'({call_lost} older calls not shown)')
 			self.call_stack['state'] = 'normal'
 			self.call_stack.delete('1.0', 'end')
 			self.call_stack.insert('1.0', f'''\
-{len(self.sim.call_trace)} calls
+{len(call_trace) + call_lost} calls
 
 {''.join(a)}
 ''')
 			self.call_stack['state'] = 'disabled'
+
+			# too long to redo every frame while running
+			if not self.sim.single_step:
+				self.update_tabs()
+				return
+			branches = self.sim.branch_trace
+			branch_count = self.sim.sim.c_config.branch_count
+			a = [f'{self.sim.get_addr_label(i[0] >> 16, i[0] & 0xffff)}{nl}⇨ {self.sim.get_addr_label(i[1] >> 16, i[1] & 0xffff)}{nl*2}' for i in branches]
+			if branch_count > len(branches): a.append(f'({branch_count - len(branches)} older branches not shown)')
+			self.branch_list['state'] = 'normal'
+			self.branch_list.delete('1.0', 'end')
+			self.branch_list.insert('1.0', f'''\
+{branch_count} branches taken
+
+{''.join(a)}
+''')
+			self.branch_list['state'] = 'disabled'
+
+			self.update_tabs(True)
+
+	# Redraws the instruction mix or cross references if that tab is shown
+	def update_tabs(self, force = False):
+		now = time.time()
+		if not force and now - self.last_tab_update < self.tab_interval: return
+		self.last_tab_update = now
+		tab = self.tabs.select()
+		if tab == str(self.f_mix): self.update_mix()
+		elif tab == str(self.f_xrefs): self.update_xrefs()
+
+	def set_count_ops(self):
+		if self.count_ops.get(): self.sim.start_op_counts()
+		else: self.sim.stop_op_counts()
+		self.update_mix()
+
+	def clear_mix(self):
+		self.sim.clear_op_counts()
+		self.update_mix()
+
+	def export_mix(self):
+		if self.sim.op_counts is None: return
+		f = tk.filedialog.asksaveasfilename(initialfile = 'insmix.csv', defaultextension = '.csv', filetypes = [('All Files', '*.*'), ('CSV Files', '*.csv')])
+		if not f: return
+		try: self.insmix.write_csv(f, self.sim.op_counts)
+		except OSError as e: tk.messagebox.showerror('Error', f'Cannot export instruction mix:\n{e}')
+
+	def update_mix(self):
+		self.mix_list.delete(*self.mix_list.get_children())
+		if self.sim.op_counts is None:
+			self.mix_total['text'] = ''
+			return
+		classes = self.insmix.classes(self.sim.op_counts)
+		total = sum(c[1] for c in classes)
+		self.mix_total['text'] = f'{total} instructions, {len(classes)} kinds'
+		for cls, count, _ in classes: self.mix_list.insert('', 'end', text = cls, values = (count, f'{count * 100 / total:.2f}'))
+
+	# Function PC is in and where it is called from
+	def update_xrefs(self):
+		result = self.sim.analysis
+		regs = self.sim.sim.core.regs
+		addr = regs.csr << 16 | regs.pc
+		label = lambda addr: self.sim.get_addr_label(addr >> 16, addr & 0xffff)
+		if result is None: text = 'Analysing ROM...' if self.sim.rom_analysis else 'ROM analysis is off (see rom_analysis in the config script)'
+		elif (func := result.function_at(addr)) is None: text = f'{label(addr)} is not in analysed code'
+		else:
+			block = result.block_at(addr)
+			callers = result.callers(func)
+			lines = [f'Function  {label(func)}', f'Block     {label(block[0])} - {label(block[1])}', '', f'{len(callers)} references', '']
+			lines.extend(f'{"BL" if kind == analysis.CALL else "B "} from {label(site)}' for site, kind in callers)
+			text = '\n'.join(lines)
+		self.xrefs['state'] = 'normal'
+		self.xrefs.delete('1.0', 'end')
+		self.xrefs.insert('1.0', text)
+		self.xrefs['state'] = 'disabled'
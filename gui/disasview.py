@@ -0,0 +1,153 @@
+import tkinter as tk
+import tkinter.ttk as ttk
+
+import analysis
+
+# Disassembly listing that scrolls over a whole code segment. Only the visible
+# rows are decoded (through Sim.predecode) and the row labels are reused, so
+# scrolling costs the same anywhere in the segment. When only PC or the
+# breakpoints changed, just the rows whose highlight changed are redrawn.
+class DisasView(tk.Frame):
+	# (current PC, breakpoint) -> background
+	colors = {(False, False): 'white', (True, False): '#ffff80', (False, True): '#ffb0b0', (True, True): '#ffc060'}
+
+	def __init__(self, master, sim, rows, **kw):
+		tk.Frame.__init__(self, master, **kw)
+		self.sim = sim
+
+		self.csr = 0
+		self.top = 0
+		self.addrs = []              # PC of each visible row
+		self.index = {}              # CSR:PC -> row
+		self.drawn = [None] * rows   # (text, background) of each row
+		self.pc = None
+		self.brkpoints = frozenset()
+		self.generation = None
+
+		# global labels by name, for going to them
+		self.names = {v[0]: k for k, v in self.sim.labels.items() if v[1]}
+
+		f_opts = tk.Frame(self)
+		f_opts.pack(fill = 'x')
+		ttk.Label(f_opts, text = 'Segment').pack(side = 'left')
+		self.segment = tk.StringVar(value = '0')
+		ttk.Spinbox(f_opts, width = 3, values = [f'{i:X}' for i in range(len(self.sim.predecode.segments))], textvariable = self.segment, state = 'readonly', command = lambda: self.goto(int(self.segment.get(), 16) << 16)).pack(side = 'left')
+		ttk.Label(f_opts, text = '   Go to').pack(side = 'left')
+		self.target = tk.StringVar()
+		target_cb = ttk.Combobox(f_opts, width = 30, textvariable = self.target, values = sorted(self.names))
+		target_cb.bind('<Return>', lambda x: self.goto_target())
+		target_cb.bind('<<ComboboxSelected>>', lambda x: self.goto_target())
+		target_cb.pack(side = 'left')
+		self.follow = tk.BooleanVar(value = True)
+		ttk.Checkbutton(f_opts, text = 'Follow PC', variable = self.follow, command = self.update).pack(side = 'left')
+
+		f_rows = tk.Frame(self)
+		f_rows.pack(fill = 'both', expand = True)
+		self.scroll = tk.Scrollbar(f_rows, orient = 'vertical', command = self.yview)
+		self.scroll.pack(side = 'right', fill = 'y')
+		f_lines = tk.Frame(f_rows, bg = 'white')
+		f_lines.pack(side = 'left', fill = 'both', expand = True)
+		self.rows = [tk.Label(f_lines, font = 'TkFixedFont', anchor = 'w', justify = 'left', bg = 'white', bd = 0, padx = 2, pady = 0) for _ in range(rows)]
+		for row in self.rows: row.pack(fill = 'x')
+		for w in (f_lines, *self.rows):
+			w.bind('<MouseWheel>', lambda e: self.scroll_rows(-3 if e.delta > 0 else 3))
+			w.bind('<Button-4>', lambda e: self.scroll_rows(-3))
+			w.bind('<Button-5>', lambda e: self.scroll_rows(3))
+
+	# Start of the instruction CSR:PC is in, going by the basic blocks of the ROM
+	# analysis. pc itself if it is not in analysed code.
+	def align(self, csr, pc):
+		result = self.sim.analysis
+		block = None if result is None else result.block_at(csr << 16 | pc)
+		if block is None: return pc
+		cur = block[0] & 0xffff
+		while True:
+			nxt = cur + (self.sim.predecode.get(csr, cur)[1] or 2)
+			if nxt > pc: return cur
+			cur = nxt
+
+	# Start of the instruction before CSR:PC. Outside analysed code this is a
+	# guess: the 4-byte instruction ending at pc if there is one, else pc - 2.
+	def prev_pc(self, csr, pc):
+		if pc < 2: return pc
+		result = self.sim.analysis
+		if result is not None and result.block_at(csr << 16 | pc - 2) is not None: return self.align(csr, pc - 2)
+		return pc - 4 if pc >= 4 and self.sim.predecode.get(csr, pc - 4)[1] == 4 else pc - 2
+
+	# Lists the segment csr from pc on
+	def show(self, csr, pc):
+		self.csr = csr
+		self.top = pc
+		if self.segment.get() != f'{csr:X}': self.segment.set(f'{csr:X}')
+		self.addrs = []
+		while len(self.addrs) < len(self.rows) and pc <= 0xfffe:
+			self.addrs.append(pc)
+			pc += self.sim.predecode.get(csr, pc)[1] or 2
+		self.index = {csr << 16 | pc: i for i, pc in enumerate(self.addrs)}
+		self.generation = self.sim.predecode.generation
+		for i in range(len(self.rows)): self.draw_row(i)
+		self.scroll.set(self.top / 0x10000, min(pc, 0x10000) / 0x10000)
+
+	def row_text(self, pc):
+		csr = self.csr
+		addr = csr << 16 | pc
+		ins, ins_len, _ = self.sim.predecode.get(csr, pc)
+		opcode = ''.join(format(self.sim.read_cmem((pc + i*2) & 0xfffe, csr), '04X') for i in range(ins_len // 2))
+		label = self.sim.labels.get(addr)
+		if label is not None: ins = f'{ins:<30}  ; {("" if label[1] else self.sim.labels[label[2]][0]) + label[0]}'
+		return f'{">>>" if addr == self.pc else "   "} {csr:X}:{pc:04X}H    {opcode:<13}    {ins}'
+
+	def draw_row(self, i):
+		if i >= len(self.addrs): drawn = ('', 'white')
+		else:
+			addr = self.csr << 16 | self.addrs[i]
+			drawn = (self.row_text(self.addrs[i]), self.colors[addr == self.pc, addr in self.brkpoints])
+		if drawn != self.drawn[i]:
+			self.rows[i].configure(text = drawn[0], bg = drawn[1])
+			self.drawn[i] = drawn
+
+	def update(self):
+		regs = self.sim.sim.core.regs
+		pc = regs.csr << 16 | regs.pc
+		brkpoints = frozenset(v['addr'] for v in self.sim.brkpoints.values() if v['enabled'] and v['type'] == 0 and v['addr'] is not None)
+		changed = brkpoints ^ self.brkpoints
+		if pc != self.pc: changed |= {self.pc, pc}
+		self.pc = pc
+		self.brkpoints = brkpoints
+
+		self.sim.predecode.invalidate()
+		if self.follow.get() and pc not in self.index: self.show(regs.csr, regs.pc)
+		elif self.generation != self.sim.predecode.generation: self.show(self.csr, self.top)
+		else:
+			for addr in changed:
+				if addr in self.index: self.draw_row(self.index[addr])
+
+	def scroll_rows(self, n):
+		self.follow.set(False)
+		top = self.top
+		for _ in range(n):
+			nxt = top + (self.sim.predecode.get(self.csr, top)[1] or 2)
+			if nxt > 0xfffe: break
+			top = nxt
+		for _ in range(-n): top = self.prev_pc(self.csr, top)
+		if top != self.top: self.show(self.csr, top)
+
+	# Scrollbar command
+	def yview(self, *args):
+		if args[0] == 'moveto':
+			self.follow.set(False)
+			self.show(self.csr, self.align(self.csr, min(max(int(float(args[1]) * 0x10000), 0), 0xfffe) & 0xfffe))
+		elif args[0] == 'scroll': self.scroll_rows(int(args[1]) * (len(self.rows) - 1 if args[2] == 'pages' else 1))
+
+	def goto(self, addr):
+		self.follow.set(False)
+		self.show(addr >> 16, self.align(addr >> 16, addr & 0xfffe))
+
+	# Goes to the global label or CSR:PC address typed in
+	def goto_target(self):
+		s = self.target.get().strip()
+		if s in self.names: addr = self.names[s]
+		else:
+			try: addr = analysis.parse_addr(s)
+			except ValueError: return
+		if addr >> 16 < len(self.sim.predecode.segments): self.goto(addr)
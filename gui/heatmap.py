@@ -0,0 +1,137 @@
+import tkinter as tk
+import tkinter.ttk as ttk
+import math
+import time
+
+from .hexed import data_segments
+
+class Heatmap(tk.Toplevel):
+	def __init__(self, sim, font = None):
+		super(Heatmap, self).__init__()
+		self.sim = sim
+
+		self.withdraw()
+		self.geometry('560x860')
+		self.resizable(False, False)
+		self.title('Memory heatmap')
+		self.protocol('WM_DELETE_WINDOW', self.withdraw)
+
+		# redrawing is too slow for every frame while running
+		self.interval = 0.5
+		self.last_update = 0
+		self.cells = []
+		self.fills = []
+
+		self.segments = data_segments(self.sim)
+		self.segment_var = tk.StringVar(value = self.segments[0][0])
+		self.segment_cb = ttk.Combobox(self, width = 35, textvariable = self.segment_var, values = [seg[0] for seg in self.segments], state = 'readonly')
+		self.segment_cb.bind('<<ComboboxSelected>>', lambda x: self.draw_grid())
+		self.segment_cb.pack()
+
+		f_opts = tk.Frame(self)
+		f_opts.pack()
+		self.counting = tk.BooleanVar(value = False)
+		ttk.Checkbutton(f_opts, text = 'Count accesses', variable = self.counting, command = self.set_counting).pack(side = 'left')
+		self.mode = tk.StringVar(value = 'both')
+		for text, value in (('Reads', 'reads'), ('Writes', 'writes'), ('Both', 'both')): ttk.Radiobutton(f_opts, text = text, variable = self.mode, value = value, command = lambda: self.update(True)).pack(side = 'left')
+		ttk.Button(f_opts, text = 'Clear', command = self.clear).pack(side = 'left')
+
+		self.canvas = tk.Canvas(self, width = 514, height = 514, bg = 'black', highlightthickness = 0)
+		self.canvas.pack()
+		self.canvas.bind('<Motion>', self.show_cell)
+		self.cell_label = ttk.Label(self, font = font)
+		self.cell_label.pack(fill = 'x')
+
+		self.info = tk.Text(self, font = font, state = 'disabled', height = 18)
+		self.info.pack(fill = 'both', expand = True)
+
+	def open(self):
+		self.deiconify()
+		self.draw_grid()
+
+	def set_counting(self):
+		if self.counting.get(): self.sim.start_heatmap()
+		else: self.sim.stop_heatmap()
+		self.update(True)
+
+	def clear(self):
+		self.sim.clear_heatmap()
+		self.update(True)
+
+	# SFRs get a cell each, everything else a cell per 256-byte page
+	def layout(self):
+		_, seg, start, size = next((s for s in self.segments if s[0] == self.segment_var.get()), self.segments[0])
+		if seg == 0 and start == 0xf000: return seg, start, 1, size, 64
+		return seg, start, 0x100, size // 0x100, 16
+
+	def draw_grid(self):
+		self.canvas.delete('all')
+		_, _, _, count, columns = self.layout()
+		cell = 512 // columns
+		self.cells = [self.canvas.create_rectangle(1 + i % columns * cell, 1 + i // columns * cell, (i % columns + 1) * cell, (i // columns + 1) * cell, fill = 'black', outline = '#202020') for i in range(count)]
+		self.fills = ['black'] * count
+		self.update(True)
+
+	def counts(self):
+		seg, start, unit, count, _ = self.layout()
+		if self.sim.heat_pages is None: return [(0, 0)] * count
+		if unit == 1: return [(h.reads, h.writes) for h in self.sim.heat_sfr[:count]]
+		first = (seg << 16 | start) >> 8
+		return [(h.reads, h.writes) for h in self.sim.heat_pages[first:first + count]]
+
+	def value(self, reads, writes):
+		mode = self.mode.get()
+		return reads if mode == 'reads' else writes if mode == 'writes' else reads + writes
+
+	# black through red and yellow to white, on a log scale
+	@staticmethod
+	def color(value, top):
+		if not value: return 'black'
+		t = math.log1p(value) / math.log1p(top)
+		r = min(int(t * 3 * 255), 255)
+		g = min(max(int((t * 3 - 1) * 255), 0), 255)
+		b = min(max(int((t * 3 - 2) * 255), 0), 255)
+		return f'#{r:02x}{g:02x}{b:02x}'
+
+	def update(self, force = False):
+		try: wm_state = self.wm_state()
+		except Exception: return
+		if wm_state != 'normal' or not self.cells: return
+		now = time.time()
+		if not force and now - self.last_update < self.interval: return
+		self.last_update = now
+
+		counts = self.counts()
+		values = [self.value(*c) for c in counts]
+		top = max(values, default = 0)
+		for i, v in enumerate(values):
+			fill = self.color(v, top)
+			if fill != self.fills[i]:
+				self.canvas.itemconfigure(self.cells[i], fill = fill)
+				self.fills[i] = fill
+
+		seg, start, unit, _, _ = self.layout()
+		hot = sorted(range(len(values)), key = lambda i: -values[i])[:8]
+		lines = ['Hottest:']
+		lines.extend(f'  {seg:02X}:{start + i * unit:04X}H{"" if unit == 1 else f" - {start + (i + 1) * unit - 1:04X}H"}  {counts[i][0]:>12} R {counts[i][1]:>12} W' for i in hot if values[i])
+		lines.append('')
+		lines.append('Regions:')
+		lines.extend(f'  {name:<24} {lo >> 16:02X}:{lo & 0xffff:04X}H - {hi >> 16:02X}:{hi & 0xffff:04X}H  {reads:>12} R {writes:>12} W' for name, lo, hi, reads, writes in self.sim.data_regions())
+
+		self.info['state'] = 'normal'
+		self.info.delete('1.0', 'end')
+		self.info.insert('1.0', '\n'.join(lines))
+		self.info['state'] = 'disabled'
+
+	def show_cell(self, event):
+		seg, start, unit, count, columns = self.layout()
+		cell = 512 // columns
+		i = (event.y - 1) // cell * columns + (event.x - 1) // cell
+		if not 0 <= (event.x - 1) // cell < columns or not 0 <= i < count:
+			self.cell_label['text'] = ''
+			return
+		if self.sim.heat_pages is None: reads = writes = 0
+		else:
+			h = self.sim.heat_sfr[i] if unit == 1 else self.sim.heat_pages[((seg << 16 | start) >> 8) + i]
+			reads, writes = h.reads, h.writes
+		self.cell_label['text'] = f'{seg:02X}:{start + i * unit:04X}H{"" if unit == 1 else f" - {start + (i + 1) * unit - 1:04X}H"}: {reads} reads, {writes} writes'
@@ -52,6 +52,7 @@ class Write(tk.Toplevel):
 			self.sim.write_dmem(adr + index, num, int.from_bytes(byte[index:index+num], 'little'), seg)
 			index += num
 
+		self.sim.state_edited()
 		self.sim.update_displays()
 		self.sim.data_mem.get_mem()
 		self.withdraw()
@@ -60,6 +61,20 @@ class Write(tk.Toplevel):
 		self.pc_entry.delete(0, 'end')
 		self.byte_entry.delete(0, 'end'); self.byte_entry.insert(0, '0')
 
+# (name, segment, start address, size) of the data memory areas worth looking at
+def data_segments(sim):
+	c_config = sim.sim.c_config
+	ram_size = 0xe00 if c_config.real_hw and c_config.hwid in (2, 3) else sim.sim.ramsize
+	segments = [
+	(f'RAM (00:{sim.sim.ramstart:04X}H - 00:{sim.sim.ramstart + ram_size - 1:04X}H)', 0, sim.sim.ramstart, ram_size),
+	('SFRs (00:F000H - 00:FFFFH)', 0, 0xf000, 0x1000),
+	]
+	if not c_config.real_hw:
+		if c_config.hwid == 4: segments.append(('Segment 4 (04:0000H - 04:FFFFH)', 4, 0, 0x10000))
+		elif c_config.hwid == 5: segments.append(('Segment 8 (08:0000H - 08:FFFFH)', 8, 0, 0x10000))
+	if c_config.hwid == 2 and sim.is_5800p: segments.append(('PRAM (04:0000H - 04:7FFFH)', 4, 0, 0x8000))
+	return segments
+
 class DataMem(tk.Toplevel):
 	def __init__(self, sim, width = None, height = None, font = None):
 		super(DataMem, self).__init__()
@@ -74,15 +89,7 @@ class DataMem(tk.Toplevel):
 		self.cursor_position = 0
 		self.first_nibble = None
 
-		segments = [
-		f'RAM (00:{self.sim.sim.ramstart:04X}H - 00:{self.sim.sim.ramstart + self.sim.sim.ramsize - 1:04X}H)',
-		'SFRs (00:F000H - 00:FFFFH)',
-		]
-		if not self.sim.sim.c_config.real_hw:
-			if self.sim.sim.c_config.hwid == 4: segments.append('Segment 4 (04:0000H - 04:FFFFH)')
-			elif self.sim.sim.c_config.hwid == 5: segments.append('Segment 8 (08:0000H - 08:FFFFH)')
-		if self.sim.sim.c_config.hwid in (2, 3): segments[0] = f'RAM (00:8000H - 00:{"8DFF" if self.sim.sim.c_config.real_hw else "EFFF"}H)'
-		if self.sim.sim.c_config.hwid == 2 and self.sim.is_5800p: segments.append('PRAM (04:0000H - 04:7FFFH)')
+		segments = [seg[0] for seg in data_segments(self.sim)]
 
 		self.segment_var = tk.StringVar(value = segments[0])
 		self.segment_cb = ttk.Combobox(self, width = 35, textvariable = self.segment_var, values = segments, state = 'readonly')
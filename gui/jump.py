@@ -32,6 +32,7 @@ class Jump(tk.Toplevel):
 		self.sim.sim.core.regs.csr = int(csr_entry, 16) if csr_entry else 0
 		self.sim.sim.core.regs.pc = int(pc_entry, 16) if pc_entry else 0
 		self.sim.stop_mode = False
+		self.sim.state_edited()
 		self.sim.update_displays()
 		self.withdraw()
 
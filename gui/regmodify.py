@@ -48,6 +48,7 @@ class GPModify(tk.Toplevel):
 	def modify(self):
 		self.withdraw()
 		self.sim.sim.core.regs.gp[int(self.reg_var.get())] = int(self.byte_entry.get(), 16)
+		self.sim.state_edited()
 		self.sim.update_displays()
 
 		self.reg_var.set('0')
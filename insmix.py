@@ -0,0 +1,68 @@
+# Instruction mix
+#
+# The native run loop counts how often each opcode word runs (see
+# Emulator.start_op_counts()). Here the words are grouped into instruction
+# classes by disassembling them with pyu8disas and replacing the operands by
+# what kind they are, so that e.g. all of MOV R0, #1 ... MOV R15, #255 are
+# counted as "MOV Rn, #imm". Without pyu8disas, every word is its own class.
+# CSV files are written by main.py --headless --insmix <file> and by the
+# Instruction mix tab of the debugger.
+
+import re
+import sys
+import csv
+
+operand_kinds = (
+	(re.compile(r'\b(C?[EXQ]?R)\d+\b'), r'\1n'),        # registers
+	(re.compile(r'#[-+]?\w+'), '#imm'),                 # immediates
+	(re.compile(r'(?<![\w])[-+]?(?:0x)?[0-9][0-9A-Fa-f]*[Hh]?\b'), 'n'),  # addresses, displacements, bit numbers
+	(re.compile(r'\s+'), ' '),
+)
+
+# Returns a pyu8disas disassembler, None if it cannot be imported
+def load_disassembler():
+	if 'pyu8disas' not in sys.path: sys.path.append('pyu8disas')
+	try: from pyu8disas import main as disas_main
+	except ImportError: return
+	return disas_main.Disasm()
+
+class InsMix:
+	def __init__(self, disas = None):
+		self.disas = disas
+		self.cache = {}
+
+	# Instruction class of an opcode word
+	def classify(self, word):
+		if word in self.cache: return self.cache[word]
+		if self.disas is None: cls = f'{word:04X}'
+		else:
+			# the words after it only hold operands, which are left out anyway
+			self.disas.input_file = word.to_bytes(2, 'little') + bytes(4)
+			self.disas.addr = 0
+			try: ins_str, _, dsr_prefix, _ = self.disas.decode_ins(True)
+			except Exception: ins_str, dsr_prefix = f'DW {word:04X}', False
+			cls = ins_str.strip()
+			for pattern, repl in operand_kinds: cls = pattern.sub(repl, cls)
+			if dsr_prefix: cls = f'{cls} (DSR prefix)'
+		self.cache[word] = cls
+		return cls
+
+	# [(class, executions, opcode words)] of the words that ran, most executions first.
+	# counts is indexed by opcode word, as Emulator.op_counts.
+	def classes(self, counts):
+		total = {}
+		words = {}
+		for word, count in enumerate(counts):
+			if not count: continue
+			cls = self.classify(word)
+			total[cls] = total.get(cls, 0) + count
+			words.setdefault(cls, []).append(word)
+		return sorted(((cls, total[cls], words[cls]) for cls in total), key = lambda x: (-x[1], x[0]))
+
+	def write_csv(self, path, counts):
+		classes = self.classes(counts)
+		executed = sum(c[1] for c in classes) or 1
+		with open(path, 'w', newline = '') as f:
+			w = csv.writer(f)
+			w.writerow(('class', 'count', 'percent', 'opcodes'))
+			for cls, count, words in classes: w.writerow((cls, count, f'{count * 100 / executed:.4f}', ' '.join(f'{word:04X}' for word in words)))
@@ -0,0 +1,110 @@
+# Input journal
+#
+# Records a session as the save state it started from plus every event
+# Emulator.log_event() sees, each with the instruction count it happened at,
+# so it can be replayed headless at full speed and end up bit-identical.
+# A journal is a text file with one entry per line:
+#   <icount> state <base64 of a zlib compressed save state>
+#   <icount> press|release <key>    key is "KI KO", "reset" or a key ID on TI MathPrint
+#   <icount> stop <ticks>|skip      timer 0 ticks given on a STOP mode wake-up
+#   <icount> end <RAM SHA-256>
+# A state line also follows anything that changed the machine some other way
+# (loading a state, rewinding, debugger edits); replaying carries on from it.
+# Everything after a # is ignored.
+
+import base64
+import hashlib
+import logging
+import zlib
+import collections
+
+import savestate
+
+def format_key(key):
+	if key is None: return 'reset'
+	if isinstance(key, tuple): return f'{key[0]} {key[1]}'
+	return f'0x{key:02x}'
+
+# tokens is what follows press or release
+def parse_key(tokens):
+	if tokens == ['reset']: return None
+	elif len(tokens) == 1: return int(tokens[0], 0)
+	elif len(tokens) == 2: return (int(tokens[0], 0), int(tokens[1], 0))
+	else: raise ValueError('expected "KI KO", "reset" or a key ID')
+
+class Journal:
+	def __init__(self, emu, path):
+		self.emu = emu
+		self.path = path
+		self.file = open(path, 'w')
+		self.file.write('# u8-emu-frontend input journal\n')
+		# written just before the next event, so that nothing is recorded twice
+		self.state_pending = True
+
+	def resync(self): self.state_pending = True
+
+	def write_state(self):
+		state = base64.b64encode(zlib.compress(savestate.dump(self.emu), 1)).decode()
+		self.file.write(f'{self.emu.sim.c_config.icount} state {state}\n')
+		self.state_pending = False
+
+	def log(self, kind, arg):
+		if self.state_pending: self.write_state()
+		if kind == 'stop': arg = 'skip' if arg is None else arg
+		else: arg = format_key(arg)
+		self.file.write(f'{self.emu.sim.c_config.icount} {kind} {arg}\n')
+
+	def close(self):
+		if self.state_pending: self.write_state()
+		self.file.write(f'{self.emu.sim.c_config.icount} end {hashlib.sha256(self.emu.ram_bytes()).hexdigest()}\n')
+		self.file.close()
+
+# Returns a list of (state, events, end) per state line of the journal at path,
+# where events is a deque of (icount, kind, arg) as Emulator.replay() takes them
+# and end is the instruction count recording went on to, None if unknown.
+# The last segment also has the RAM SHA-256 from the end line, None if there is none.
+def load(path):
+	segments = []
+	ram_sha256 = None
+	with open(path) as f:
+		for n, line in enumerate(f, 1):
+			tokens = line.split('#', 1)[0].split()
+			if not tokens: continue
+			try:
+				icount = int(tokens[0], 0)
+				kind = tokens[1]
+				if kind == 'state':
+					segments.append([zlib.decompress(base64.b64decode(tokens[2], validate = True)), collections.deque(), None])
+					continue
+				if not segments: raise ValueError('no state before the first event')
+				if kind == 'end':
+					segments[-1][2] = icount
+					ram_sha256 = bytes.fromhex(tokens[2])
+					continue
+				if kind == 'stop': arg = None if tokens[2:] == ['skip'] else int(tokens[2], 0)
+				elif kind in ('press', 'release'): arg = parse_key(tokens[2:])
+				else: raise ValueError(f'unknown entry {kind!r}')
+				segments[-1][1].append((icount, kind, arg))
+			except (IndexError, ValueError, zlib.error) as e: raise ValueError(f'{path}:{n}: {e}') from None
+
+	if not segments: raise ValueError(f'{path}: no state to start from')
+	return segments, ram_sha256
+
+# Replays the journal at path on emu. Returns whether the RAM ended up as recorded,
+# None if the journal has no end line to compare against.
+def replay(emu, path):
+	segments, ram_sha256 = load(path)
+	emu.idle_in_stop = False
+	for state, events, end in segments:
+		emu.load_state(state)
+		target = end if end is not None else events[-1][0] if events else emu.sim.c_config.icount
+		emu.replay(target, events)
+		# events logged right before the next state or the end line
+		while events and events[0][0] == emu.sim.c_config.icount:
+			_, kind, arg = events.popleft()
+			emu.replay_event(kind, arg)
+		if events: logging.warning(f'Replay stopped at instruction {emu.sim.c_config.icount} with {len(events)} events left')
+		elif emu.sim.c_config.icount != target: logging.warning(f'Replay stopped at instruction {emu.sim.c_config.icount}, recording went on to {target}')
+
+	if ram_sha256 is None: return None
+	return hashlib.sha256(emu.ram_bytes()).digest() == ram_sha256
@@ -1,48 +1,53 @@
+import sys
+headless = '--headless' in sys.argv[1:]
+
 import io
 import os; os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = ''
-try: import PIL.Image
-except ImportError:
-	print('Please install pillow!')
-	sys.exit()
-import sys
+if not headless:
+	try: import PIL.Image
+	except ImportError:
+		print('Please install pillow!')
+		sys.exit()
 import math
 import time
-import ctypes
-try: import pygame
-except ImportError:
-	print('Please install pygame!')
-	sys.exit()
+import collections
+if not headless:
+	try: import pygame
+	except ImportError:
+		print('Please install pygame!')
+		sys.exit()
 import logging
 import cProfile
+import argparse
 import functools
-import importlib
-import importlib.util
 import threading
 import traceback
 import webbrowser
 no_clipboard = False
-try:
-	if os.name == 'nt': import win32clipboard
-	else: import klembord
-except ImportError: no_clipboard = True
-try: import tkinter as tk
-except ImportError:
-	print('Please install tkinter!')
-	sys.exit()
-import tkinter.ttk as ttk
-import tkinter.font
-import tkinter.messagebox
-import tkinter.filedialog
-from enum import IntEnum
-
-sys.path.append('pyu8disas')
-from pyu8disas import main as disas_main
-from pyu8disas.labeltool import labeltool
-from tool8 import tool8
+if not headless:
+	try:
+		if os.name == 'nt': import win32clipboard
+		else: import klembord
+	except ImportError: no_clipboard = True
+	try: import tkinter as tk
+	except ImportError:
+		print('Please install tkinter!')
+		sys.exit()
+	import tkinter.ttk as ttk
+	import tkinter.font
+	import tkinter.messagebox
+	import tkinter.filedialog
+
+	sys.path.append('pyu8disas')
+	from pyu8disas import main as disas_main
 import platform
 
+import emulator
+import insmix
+from emulator import Emulator, stop_reason_e, MAX_WATCHPOINTS
 import peripheral
-import gui
+import predecode
+if not headless: import gui
 
 profile_mode = False
 
@@ -50,257 +55,13 @@ if sys.version_info < (3, 8, 0):
 	print(f'This program requires at least Python 3.8.0. (You are running Python {platform.python_version()})')
 	sys.exit()
 
-if pygame.version.vernum < (2, 2, 0):
+if not headless and pygame.version.vernum < (2, 2, 0):
 	print(f'This program requires at least Pygame 2.2.0. (You are running Pygame {pygame.version.ver})')
 	sys.exit()
 
 level = logging.INFO
 logging.basicConfig(datefmt = '%d/%m/%Y %H:%M:%S', format = '[%(asctime)s] %(levelname)s: %(message)s', level = level)
 
-# For ROM8 reading
-class DisplayBounds(ctypes.Structure):
-	_fields_ = [
-		('x',      ctypes.c_uint16),
-		('y',      ctypes.c_uint16),
-		('width',  ctypes.c_uint16),
-		('height', ctypes.c_uint16),
-		('scale',  ctypes.c_uint16),
-	]
-
-class GUIKey(ctypes.Structure):
-	_fields_ = [
-		('x',      ctypes.c_uint16),
-		('y',      ctypes.c_uint16),
-		('width',  ctypes.c_uint16),
-		('height', ctypes.c_uint16),
-		('keysym', ctypes.c_uint16),
-	]
-
-class Keybind(ctypes.Structure):
-	_fields_ = [
-		('key', ctypes.c_char),
-		('keysym', ctypes.c_uint8),
-	]
-
-# from Delta / @frsr (edited to be compatible with pitust™ quality code)
-class u8_core_t(ctypes.Structure):	# Forward definition so pointers can be used
-	pass
-
-class u8_regs_t(ctypes.Structure):
-	_fields_ = [
-		('gp',		ctypes.c_uint8 * 16),
-		('pc',		ctypes.c_uint16),
-		('csr',		ctypes.c_uint8),
-		('lcsr',	ctypes.c_uint8),
-		('ecsr',	ctypes.c_uint8 * 3),
-		('lr',		ctypes.c_uint16),
-		('elr',		ctypes.c_uint16 * 3),
-		('psw',		ctypes.c_uint8),
-		('epsw',	ctypes.c_uint8 * 3),
-		('sp',		ctypes.c_uint16),
-		('ea',		ctypes.c_uint16),
-		('dsr',		ctypes.c_uint8)
-	]
-
-class _acc_arr(ctypes.Structure):
-	_fields_ = [
-		('array',	ctypes.POINTER(ctypes.c_uint8)),
-		('dirty',	ctypes.c_uint64),
-	]
-
-class _acc_func(ctypes.Structure):
-	_fields_ = [
-		('read',	ctypes.CFUNCTYPE(ctypes.c_uint8, ctypes.POINTER(u8_core_t), ctypes.c_uint8, ctypes.c_uint16)),
-		('write',	ctypes.CFUNCTYPE(None, ctypes.POINTER(u8_core_t), ctypes.c_uint8, ctypes.c_uint16, ctypes.c_uint8))
-	]
-
-class _acc_union(ctypes.Union):
-	_anonymous_ = ['_acc_arr', '_acc_func']
-	_fields_ = [
-		('_acc_arr',	_acc_arr),
-		('_acc_func',	_acc_func)
-	]
-
-class u8_mem_reg_t(ctypes.Structure):
-	_anonymous_ = ['_acc_union']
-	_fields_ = [
-		('type',		ctypes.c_uint),
-		('rw',			ctypes.c_bool),
-		('addr_l',		ctypes.c_uint32),
-		('addr_h',		ctypes.c_uint32),
-
-		('acc',			ctypes.c_uint),
-		('_acc_union',	_acc_union)
-	]
-
-class u8_mem_t(ctypes.Structure):
-	_fields_ = [
-		('num_regions',	ctypes.c_int),
-		('regions',		ctypes.POINTER(u8_mem_reg_t))
-	]
-
-u8_core_t._fields_ = [
-		('regs',			u8_regs_t),
-		('cur_dsr',			ctypes.c_uint8),
-		('last_swi',		ctypes.c_uint8),
-		('last_read',		ctypes.c_uint32),
-		('last_read_size',	ctypes.c_uint8),
-		('last_write',		ctypes.c_uint32),
-		('last_write_size',	ctypes.c_uint8),
-		('u16_mode',		ctypes.c_bool),
-		('small_mm',		ctypes.c_bool),
-		('mem',				u8_mem_t),
-		('codemem',			u8_mem_t),
-	]
-
-class u8_mem_type_e(IntEnum):	
-	U8_REGION_BOTH = 0
-	U8_REGION_DATA = 1
-	U8_REGION_CODE = 2
-
-class u8_mem_acc_e(IntEnum):
-	U8_MACC_ARR  = 0
-	U8_MACC_FUNC = 1
-
-class c_config(ctypes.Structure):
-	_fields_ = [
-		('hwid',		ctypes.c_int),
-		('real_hw',		ctypes.c_bool),
-		('ko_mode',		ctypes.c_bool),
-		('sample',		ctypes.c_bool),
-		('is_5800p',	ctypes.c_bool),
-		('pd_value',	ctypes.c_uint8),
-		('rom',			ctypes.POINTER(ctypes.c_uint8)),
-		('flash',		ctypes.POINTER(ctypes.c_uint8)),
-		('ram',			ctypes.POINTER(ctypes.c_uint8)),
-		('sfr',			ctypes.POINTER(ctypes.c_uint8)),
-		('emu_seg',		ctypes.POINTER(ctypes.c_uint8)),
-		('sfr_write',	(ctypes.CFUNCTYPE(ctypes.c_uint8, ctypes.c_uint16, ctypes.c_uint8)) * 0x1000),
-		('flash_mode',	ctypes.c_int),
-	]
-
-class Core:
-	def __init__(self, sim, rom, flash):
-		self.sim = sim
-
-		pd_value = config.pd_value if hasattr(config, 'pd_value') else 0
-		self.c_config = c_config(config.hardware_id, config.real_hardware, self.sim.ko_mode, self.sim.sample, self.sim.is_5800p)
-		self.c_config.pd_value = pd_value
-
-		self.core = u8_core_t()
-
-		# Initialise memory
-		if config.hardware_id == 5 and config.real_hardware:
-			self.rom_length = 0xfffff
-			self.code_mem = (ctypes.c_uint8 * 0x100000)(*rom, *rom)
-		else:
-			self.rom_length = len(rom)
-			self.code_mem = (ctypes.c_uint8 * (0x80000 if config.hardware_id == 2 and self.sim.is_5800p else 0x100000))(*rom)
-			if config.hardware_id == 2 and self.sim.is_5800p:
-				self.flash_length = len(flash)
-				self.flash_mem = (ctypes.c_uint8 * 0x80000)(*flash)
-			else: self.flash_length = 0
-
-		data_size = {
-		0: (0xe000, 0x1000),
-		3: (0x8000, 0xe00 if config.real_hardware else 0x7000),
-		4: (0xd000, 0x2000),
-		5: (0x9000, 0x6000),
-		6: (0xb000, 0x4000),
-		}
-
-		ramstart, ramsize = data_size[config.hardware_id if config.hardware_id in data_size else 3]
-		self.ramstart = ramstart
-		self.ramsize = ramsize
-
-		self.sfr_write_ft = ctypes.CFUNCTYPE(ctypes.c_uint8, ctypes.c_uint16, ctypes.c_uint8)
-		self.sfr_default_write_f = self.sfr_write_ft(self.sfr_default_write)
-
-		self.setup_mcu(ramstart, ramsize)
-
-	def setup_mcu(self, ramstart, ramsize):
-		sim_lib.setup_mcu(ctypes.pointer(self.c_config), ctypes.pointer(self.core), self.code_mem, self.flash_mem if config.hardware_id == 2 and self.sim.is_5800p else None, ramstart, ramsize)
-
-		if config.hardware_id == 2 and self.sim.is_5800p: self.c_config.sfr[0x46] = 4
-		self.register_sfr(0, 1, self.write_dsr)
-
-		if config.hardware_id in (4, 5):
-			self.register_sfr(0xd0, 1)
-			self.register_sfr(0xd1, 1, lambda x, y: 6 if self.c_config.sfr[0xd0] == 3 and self.c_config.sfr[0xd2] == 0 and y == 5 else y)
-			self.register_sfr(0xd2, 1)
-
-		if config.hardware_id == 5:
-			self.bcd = peripheral.BCD(self.sim)
-			self.register_sfr(0x400, 1, self.bcd.tick)  # BCDCMD
-			self.register_sfr(0x402, 1, self.bcd.tick)  # BCDCON
-			self.c_config.sfr[0x402] = 6
-			self.register_sfr(0x404, 1, self.bcd.tick)  # BCDMCN
-			self.register_sfr(0x405, 1, self.bcd.tick)  # BCDMCR
-			self.register_sfr(0x410, 1)                 # BCDFLG
-			# F414H: BCDLLZ, F415H: BCDMLZ (both read-only)
-			for i in range(4): self.register_sfr(0x480 + i*0x20, 12)  # BCDREG000 - BCDREG311
-
-		if config.hardware_id == 6: self.register_sfr(0x901, 1, lambda a, v: int(not v))
-	
-	def u8_reset(self): sim_lib.u8_reset(ctypes.pointer(self.core))
-
-	def read_reg_er(self, n): return sim_lib.read_reg_er(ctypes.pointer(self.core), n)
-
-	# Memory Access
-	def read_mem_data(self, dsr, offset, size): return sim_lib.read_mem_data(ctypes.pointer(self.core), dsr, offset, size)
-	
-	def write_mem_data(self, dsr, offset, size, value): return sim_lib.write_mem_data(ctypes.pointer(self.core), dsr, offset, size, value)
-	
-	def register_sfr(self, addr, length, handler = None):
-		for i in range(addr, addr+length): self.c_config.sfr_write[i] = self.sfr_default_write_f if handler is None else self.sfr_write_ft(handler)
-
-	def sfr_default_write(self, addr, value): return value
-
-	def write_dsr(self, addr, value):
-		self.core.regs.dsr = value
-		return value
-
-	def write_sfr(self, addr, value):
-		if addr >= 0x1000:
-			label = self.sim.get_instruction_label((self.core.regs.csr << 16) + self.core.regs.pc)
-			logging.warning(f'Overflown write to {(0xf000 + addr) & 0xffff:04X}H @ {self.sim.get_addr_label(self.core.regs.csr, self.core.regs.pc-2)}')
-			return self.read_mem_data(seg, (0xf000 + addr) & 0xffff, 1)
-
-		try:
-			if config.hardware_id == 5:
-				if config.real_hardware:
-					if addr >= 0x800:
-						y, x = self.get_idx(addr - 0x800)
-						if self.c_config.sfr[0x37] & 4: self.sim.cwii_screen_hi[y][x] = value
-						else: self.sim.cwii_screen_lo[y][x] = value
-						return value
-					elif addr == 0xd1: return 
-				if addr == 0x312:
-					if self.sim.shutdown_accept:
-						if value == 0x3c:
-							self.c_config.sfr[0x31] = 3
-							self.sim.shutdown = True
-						elif value != 0x5a: self.sim.shutdown_accept = False
-					elif value == 0x5a: self.sim.shutdown_accept = True
-				elif addr in (0x400, 0x402, 0x404, 0x405): self.sim.bcd.tick(addr)
-				else: return value
-			elif config.hardware_id == 6:
-				if addr == 0xe: return value == 0x5a
-				elif addr == 0x900: return 0x34
-				elif addr == 0x901: return int(not value)
-				else: return value
-			elif addr == 0x46 and config.hardware_id == 2 and self.sim.is_5800p: return 4
-			else: return value
-		except Exception as e:
-			logging.error(f'{type(e).__name__} writing to {0xf000+addr:04X}H: {e}')
-			return 0
-
-	def battery(self, core, seg, addr): return 0xff
-
-	@staticmethod
-	@functools.lru_cache
-	def get_idx(x): return x // 32, x % 32
-
 # https://github.com/JamesGKent/python-tkwidgets/blob/master/Debounce.py
 class Debounce():
 	'''
@@ -503,9 +264,10 @@ class Debounce():
 				if (event.keysym not in evdict) or (evdict[event.keysym] == False):
 					self._on_key_press(event)
 
-class DebounceTk(Debounce, tk.Tk): pass
+if not headless:
+	class DebounceTk(Debounce, tk.Tk): pass
 
-class Sim:
+class Sim(Emulator):
 	def __init__(self, no_clipboard, bcd):
 		self.copyclip = not no_clipboard
 
@@ -516,107 +278,32 @@ class Sim:
 			if not hasattr(config, 's_height'): config.s_height = size[1]
 		except (AttributeError, IOError): pass
 
-		self.rom8 = config.rom8 if hasattr(config, 'rom8') else False
-		self.use_char = config.use_char if hasattr(config, 'use_char') else False
-		self.ko_mode = config.ko_mode if hasattr(config, 'ko_mode') and config.ko_mode == 1 else 0
 		self.text_y = config.text_y if hasattr(config, 'text_y') else 22
 		self.pix_color = config.pix_color if hasattr(config, 'pix_color') else (0, 0, 0)
-		self.is_5800p = config.is_5800p if hasattr(config, 'is_5800p') else False
-		self.sample = config.sample if hasattr(config, 'sample') else False
 		self.buffers_no_2bpp = config.buffers_no_2bpp if hasattr(config, 'buffers_no_2bpp') else False
 
-		if self.rom8:
-			tags = list(tool8.read8(config.rom_file))
-			props = {}
-			keymap = {}
-			found_tags = set()
-			
-			for tag, data in tags:
-				if tag in found_tags and tag != 2:
-					logging.error(f'Duplicate tag (type {int(tag)}) found')
+		super(Sim, self).__init__()
+
+		if self.face is not None:
+			tag, data = self.face
+			if tag == 4:
+				try: import cairosvg
+				except Exception:
+					logging.error(f'CairoSVG threw an error during import.\n{traceback.format_exc()}')
 					sys.exit()
-				else: found_tags.add(tag)
-
-				# end
-				if tag == 0: break
-				# prop
-				elif tag == 2:
-					ds = data.decode().split('=', 1)
-					props[ds[0]] = ds[1]
-				# rom
-				elif tag == 3: rom = data
-				# faceSVG / facePNG
-				elif tag in (4, 5):
-					if tag == 4 and 5 in found_tags:
-						logging.error('facePNG tag already used')
-						sys.exit()
-					elif tag == 5 and 4 in found_tags:
-						logging.error('faceSVG tag already used')
-						sys.exit()
-
-					if tag == 4:
-						try: import cairosvg
-						except Exception:
-							logging.error(f'CairoSVG threw an error during import.\n{traceback.format_exc()}')
-							sys.exit()
-
-						data = cairosvg.svg2png(bytestring = data)
-					
-					name = f'temp{time.time_ns()}.png'
-					with open(name, 'wb') as f: f.write(data)
-					config.interface_path = name
-
-				# faceDisplayBounds
-				elif tag == 6:
-					facedisp = DisplayBounds.from_buffer_copy(data)
-					config.screen_tl_w = facedisp.x
-					config.screen_tl_h = facedisp.y - config.s_height + 1
-					config.pix         = facedisp.scale
-				
-				# faceGUIKeys
-				elif tag == 7:
-					for i in range(0, len(data), 10):
-						key = GUIKey.from_buffer_copy(data[i:i+10])
-						if key.keysym == 0x80: kio = None
-						else: kio = (key.keysym >> 4 & 0xf, key.keysym & 0xf)
-						if kio in keymap: keymap[kio][0] = (key.x, key.y, key.width, key.height)
-						else: keymap[kio] = [(key.x, key.y, key.width, key.height)]
-				
-				# calcType
-				elif tag == 9:
-					calctype = data[0]
-					if calctype & 3 == 1: config.hardware_id = 3
-					elif calctype & 3 == 2: config.hardware_id = 4
-					elif calctype & 3 == 3: config.hardware_id = 5
-					config.real_hardware = calctype & 0xfc != 4
-				
-				# faceKeybinds
-				elif tag == 10:
-					self.use_char = True
-					for i in range(0, len(data), 2):
-						key = Keybind.from_buffer_copy(data[i:i+2])
-						if key.keysym == 0x80: kio = None
-						kio = (key.keysym >> 4 & 0xf, key.keysym & 0xf)
-						if kio not in keymap: keymap[kio] = [(0, 0, 0, 0)]
-						keymap[kio].append(key.key.decode())
-
-			if keymap != {}: config.keymap = keymap
-			if 'model' in props: config.root_w_name = props['model']
-			for k, v in props.items(): logging.info(f'{k}: {v}')
-		else:
-			rom = open(config.rom_file, 'rb').read()
-			if len(rom) % 2 != 0:
-				logging.error('ROM size cannot be odd')
-				sys.exit()
 
-		self.pix_hi = config.pix_hi if hasattr(config, 'pix_hi') else config.pix
+				data = cairosvg.svg2png(bytestring = data)
+			
+			name = f'temp{time.time_ns()}.png'
+			with open(name, 'wb') as f: f.write(data)
+			config.interface_path = name
 
-		if config.hardware_id == 2 and self.is_5800p:
-			flash = open(config.flash_rom_file, 'rb').read()
-			if len(flash) % 2 != 0:
-				logging.error('Flash ROM size cannot be odd')
-				sys.exit()
-		else: flash = None
+		if self.face_bounds is not None:
+			config.screen_tl_w = self.face_bounds.x
+			config.screen_tl_h = self.face_bounds.y - config.s_height + 1
+			config.pix         = self.face_bounds.scale
+
+		self.pix_hi = config.pix_hi if hasattr(config, 'pix_hi') else config.pix
 
 		if any((not hasattr(config, 'width'), not hasattr(config, 'height'))):
 			try:
@@ -628,11 +315,6 @@ class Sim:
 				logging.error(e)
 				sys.exit()
 
-		if config.hardware_id == 2: self.ko_mode = 1 
-		elif config.hardware_id != 3: self.ko_mode = 0
-
-		self.sim = Core(self, rom, flash)
-
 		self.root = DebounceTk()
 		self.root.geometry(f'{config.width}x{config.height}')
 		self.root.resizable(False, False)
@@ -641,11 +323,6 @@ class Sim:
 		self.root.protocol('WM_DELETE_WINDOW', self.exit_sim)
 		self.root.focus_set()
 
-		self.init_sp = rom[0] | rom[1] << 8
-		self.init_pc = rom[2] | rom[3] << 8
-		self.init_brk = rom[4] | rom[5] << 8
-
-		self.keys_pressed = set()
 		self.keys = []
 		if hasattr(config, 'keymap'):
 			for key in [i[1:] for i in config.keymap.values()]: self.keys.extend(key)
@@ -655,44 +332,26 @@ class Sim:
 		self.brkpoint = gui.Brkpoint(self)
 		self.write = gui.Write(self)
 		self.data_mem = gui.DataMem(self, config.data_mem_width, config.data_mem_height, config.data_mem_font)
+		self.heatmap = gui.Heatmap(self, config.data_mem_font)
 		self.gp_modify = gui.GPModify(self)
 		self.reg_display = gui.RegDisplay(self, config.console_fg, config.console_bg, config.console_font)
 		self.call_display = gui.CallStackDisplay(self, config.console_fg, config.console_bg, config.console_font)
-		self.debugger = gui.Debugger(self)
 
-		self.screen_stuff = {
-	   # hwid: (alloc, used, rows,buffers,          columns)
-			0: [0x8,   0x8,  3,   [],               64],
-			2: [0x10,  0xc,  32,  [0x80e0 if self.is_5800p else 0x8600], 96],
-			3: [0x10,  0xc,  32,  [0x87d0],         96],
-			4: [0x20,  0x18, 64,  [0xddd4, 0xe3d4], 192],
-			5: [0x20,  0x18, 64,  [0xca54, 0xd654], 192],
-			6: [0x8,   0x8,  192, [None, None],     64],
-		}
-
-		if config.hardware_id in self.screen_stuff: self.scr = self.screen_stuff[config.hardware_id]
-		else: self.scr = self.screen_stuff[3]
-		if config.hardware_id != 6 and hasattr(config, 'custom_buffers') and type(config.custom_buffers) == list: self.scr[3] = config.custom_buffers
-
-		# actual peripherals
-		self.disp = peripheral.Screen(self, self.scr)
-		self.wdt = peripheral.WDT(self)
-		self.standby = peripheral.Standby(self)
-		self.timer = peripheral.Timer(self)
-		self.kb = peripheral.Keyboard(self)
 		self.disas = disas_main.Disasm()
 
 		if hasattr(config, 'labels') and config.labels:
 			self.labels = {self.init_pc: ['start', True]}
-			if rom[4] | rom[5] << 8 != self.init_pc: self.labels[rom[4] | rom[5] << 8] = ['brk', True]
-			for file in config.labels:
-				labels, data_labels, data_bit_labels = labeltool.load_labels(open(file), 0)
-				for key in labels: self.labels[key] = labels[key]
-				for key in data_labels: self.disas.data_labels[key] = data_labels[key]
-				for key in data_bit_labels: self.disas.data_bit_labels[key] = data_bit_labels[key]
+			if self.init_brk != self.init_pc: self.labels[self.init_brk] = ['brk', True]
+			labels, data_labels, data_bit_labels = emulator.load_labels(config.labels)
+			self.labels.update(labels)
+			self.disas.data_labels.update(data_labels)
+			self.disas.data_bit_labels.update(data_bit_labels)
 			self.labels = {i: self.labels[i] for i in sorted(self.labels.keys())}
 			self.disas.labels = self.labels.copy()
-		else: self.labels = {}
+
+		self.predecode = predecode.Predecoder(self, self.disas)
+		# lists the labels and decodes through the predecoder
+		self.debugger = gui.Debugger(self)
 
 		embed_pygame = tk.Frame(self.root, width = config.width, height = config.height)
 		embed_pygame.pack(side = 'left')
@@ -703,18 +362,7 @@ class Sim:
 				p = v[0]
 				if (event.type == tk.EventType.ButtonPress and event.x in range(p[0], p[0]+p[2]) and event.y in range(p[1], p[1]+p[3])) \
 				or (event.type == tk.EventType.KeyPress and (event.char if self.use_char else event.keysym.lower()) in v[1:]):
-					if config.hardware_id != 6:
-						self.keys_pressed.add(k)
-						if k is None: self.reset_core()
-						else:
-							if config.real_hardware:
-								self.sim.c_config.sfr[0x14] = 2
-								if self.sim.c_config.sfr[0x42] & (1 << k[0]): self.standby.stop_mode = False
-							else:
-								self.standby.stop_mode = False
-								self.write_emu_kb(1, 1 << k[0])
-								self.write_emu_kb(2, 1 << k[1])
-					elif len(self.keys_pressed) == 0: self.curr_key = k
+					self.queue_input(True, k)
 					break
 
 		def display_key(event):
@@ -729,22 +377,23 @@ class Sim:
 
 		def release_cb(event):
 			if config.hardware_id != 6:
+				keys = self.pending_keys()
 				if event.type == tk.EventType.KeyRelease and event.keysym.startswith('Shift'): 
-					self.keys_pressed.clear()
+					for k in keys: self.queue_input(False, k)
 					return
 
 				for k, v in config.keymap.items():
 					p = v[0]
 					if (event.type == tk.EventType.ButtonRelease and event.x in range(p[0], p[0]+p[2]) and event.y in range(p[1], p[1]+p[3])) \
 						or (event.type == tk.EventType.KeyRelease and (event.char if self.use_char else event.keysym.lower()) in v[1:]):
-							try:
-								self.keys_pressed.remove(k)
+							if k in keys:
+								self.queue_input(False, k)
 								return
-							except KeyError: break
+							break
 
-				self.keys_pressed.clear()
+				for k in keys: self.queue_input(False, k)
 				return
-			else: self.curr_key = 0
+			else: self.queue_input(False, None)
 
 		if hasattr(config, 'keymap'):
 			embed_pygame.bind('<KeyPress>', press_cb)
@@ -788,6 +437,12 @@ class Sim:
 
 		self.rc_menu = tk.Menu(self.root, tearoff = 0)
 		self.rc_menu.add_command(label = 'Step', accelerator = '\\', command = self.set_step)
+		if self.rewind is not None:
+			self.rc_menu.add_command(label = 'Reverse step', accelerator = '|', command = self.reverse_step)
+			self.rc_menu.add_command(label = 'Reverse continue', command = self.reverse_continue)
+			rewind_menu = tk.Menu(self.rc_menu, tearoff = 0)
+			for i in (1, 5, 10, 30): rewind_menu.add_command(label = f'{i} second{"s" if i != 1 else ""}', command = lambda i = i: self.rewind_seconds(i))
+			self.rc_menu.add_cascade(label = 'Rewind', menu = rewind_menu)
 		self.rc_menu.add_command(label = 'Enable single-step mode', accelerator = 'S', command = lambda: self.set_single_step(True))
 		self.rc_menu.add_command(label = 'Resume execution (unpause)', accelerator = 'P', command = lambda: self.set_single_step(False))
 		self.rc_menu.add_separator()
@@ -796,6 +451,7 @@ class Sim:
 		self.rc_menu.add_command(label = 'Manage breakpoints', accelerator = 'B', command = self.brkpoint.deiconify)
 		self.rc_menu.add_separator()
 		self.rc_menu.add_command(label = 'Show data memory', accelerator = 'M', command = self.data_mem.open)
+		self.rc_menu.add_command(label = 'Memory heatmap', command = self.heatmap.open)
 		self.rc_menu.add_separator()
 		self.rc_menu.add_command(label = 'Register display', accelerator = 'R', command = self.reg_display.open)
 		self.rc_menu.add_command(label = 'Call stack display', command = self.call_display.open)
@@ -807,41 +463,6 @@ class Sim:
 		else: self.display = pygame.Surface((self.scr[4]*config.pix, (self.scr[2] - 1)*self.pix_hi + self.sbar_hi))
 		self.display.fill((255, 255, 255))
 
-		if config.hardware_id == 6: self.int_table = {
-			# (irqsfr,bit):(vtadr,ie_sfr,bit, name)
-				(0x18, 0): (0x08, None, None, 'WDTINT'),     # Watchdog timer interrupt
-			}
-		elif config.hardware_id == 0: self.int_table = {
-			# (irqsfr,bit):(vtadr,ie_sfr,bit, name)
-				(0x14, 0): (0x08, 0x10, 0,    'XI0INT'),     # External interrupt 0
-				(0x14, 1): (0x0a, 0x10, 1,    'TM0INT'),     # Timer 0 interrupt
-				(0x14, 2): (0x0c, 0x10, 2,    'L256SINT'),
-				(0x14, 3): (0x0e, 0x10, 3,    'L1024SINT'),
-				(0x14, 4): (0x10, 0x10, 4,    'L4096SINT'),
-				(0x14, 5): (0x12, 0x10, 5,    'L16384SINT'),
-			}
-
-		else: self.int_table = {
-			# (irqsfr,bit):(vtadr,ie_sfr,bit, name)
-				(0x14, 0): (0x08, None, None, 'WDTINT'),     # Watchdog timer interrupt
-				(0x14, 1): (0x0a, 0x10, 1,    'XI0INT'),     # External interrupt 0
-			 	(0x14, 2): (0x0c, 0x10, 2,    'XI1INT'),     # External interrupt 1
-				(0x14, 3): (0x0e, 0x10, 3,    'XI2INT'),     # External interrupt 2
-				(0x14, 4): (0x10, 0x10, 4,    'XI3INT'),     # External interrupt 3
-				(0x14, 5): (0x12, 0x10, 5,    'TM0INT'),     # Timer 0 interrupt
-				(0x14, 6): (0x14, 0x10, 6,    'L256SINT'),
-				(0x14, 7): (0x16, 0x10, 7,    'L1024SINT'),
-				(0x15, 0): (0x18, 0x11, 0,    'L4096SINT'),
-				(0x15, 1): (0x1a, 0x11, 1,    'L16384SINT'),
-				(0x15, 2): (0x1c, 0x11, 2,    'SIO0INT'),    # Synchronous serial port 0 interrupt
-				(0x15, 3): (0x1e, 0x11, 3,    'I2C0INT'),    # I²C bus 0 interrupt
-				(0x15, 4): (0x20, 0x11, 4,    'I2C1INT'),    # I²C bus 1 interrupt
-				(0x15, 5): (0x22, 0x11, 5,    'BENDINT'),
-				(0x15, 6): (0x24, 0x11, 6,    'BLOWINT'),
-				(0x15, 7): (0x26, 0x11, 7,    'RTCINT'),     # Real-time clock interrupt
-				(0x16, 0): (0x28, 0x12, 0,    'AL0INT'),     # RTC alarm 0 interrupt
-				(0x16, 1): (0x2a, 0x12, 1,    'AL1INT'),     # RTC alarm 1 interrupt
-			}
 
 		# first item can be anything
 		self.cwii_screen_colors = (None, (170, 170, 170), (85, 85, 85), (0, 0, 0))
@@ -863,6 +484,16 @@ class Sim:
 		extra_funcs.add_command(label = 'Write to data memory', command = self.write.deiconify)
 		extra_funcs.add_command(label = 'Modify general registers', command = self.gp_modify.open)
 		if config.hardware_id == 2 and self.is_5800p: extra_funcs.add_command(label = 'Save flash ROM', command = self.save_flash)
+		extra_funcs.add_separator()
+		extra_funcs.add_command(label = 'Save state...', command = self.save_state_as)
+		extra_funcs.add_command(label = 'Load state...', command = self.load_state_from)
+		extra_funcs.add_command(label = 'Record inputs...', command = self.record_journal_as)
+		extra_funcs.add_command(label = 'Stop recording inputs', command = self.stop_recording)
+		extra_funcs.add_command(label = 'Trace execution...', command = self.trace_as)
+		extra_funcs.add_command(label = 'Stop tracing', command = self.stop_tracing)
+		extra_funcs.add_command(label = 'Start profiling', command = self.start_profiling)
+		extra_funcs.add_command(label = 'Stop profiling...', command = self.stop_profiling)
+		extra_funcs.add_separator()
 
 		save_display = tk.Menu(extra_funcs, tearoff = 0)
 		save_display.add_command(label = f'Copy to clipboard{" ("+("pywin32" if os.name == "nt" else "klembord")+" package required)" if not self.copyclip else ""}', state = 'normal' if self.copyclip else 'disabled', command = self.save_display)
@@ -882,7 +513,7 @@ class Sim:
 		options.add_checkbutton(label = 'FPS display', variable = self.enable_fps_tk, command = lambda: self.set_tk_var('enable_fps'))
 		if config.hardware_id == 6: options.add_checkbutton(label = 'Always update display', variable = self.always_update_tk, command = lambda: self.set_tk_var('always_update'))
 		if config.hardware_id in (2, 3, 4, 5): options.add_checkbutton(label = 'Force normal screen', variable = self.force_display_tk, command = lambda: self.set_tk_var('force_display'))
-		if config.hardware_id in (3, 4, 5): options.add_checkbutton(label = 'Factory test mode', variable = self.factory_test_tk, command = lambda: self.set_tk_var('factory_test'))
+		if config.hardware_id in (3, 4, 5): options.add_checkbutton(label = 'Factory test mode', variable = self.factory_test_tk, command = self.set_factory_test)
 		self.rc_menu.add_cascade(label = 'Options', menu = options)
 
 		self.rc_menu.add_separator()
@@ -892,6 +523,7 @@ class Sim:
 		self.rc_menu.add_command(label = 'u8-emu-frontend by Steveyboi / GamingWithEvets Inc.', command = self.open_gh)
 		self.root.bind('<Button-3>', self.open_popup)
 		self.root.bind('\\', lambda x: self.set_step())
+		if self.rewind is not None: self.root.bind('|', lambda x: self.reverse_step())
 		self.bind_(self.root, 's', lambda x: self.set_single_step(True))
 		self.bind_(self.root, 'p', lambda x: self.set_single_step(False))
 		self.bind_(self.root, 'j', lambda x: self.jump.deiconify())
@@ -900,36 +532,19 @@ class Sim:
 		self.bind_(self.root, 'r', lambda x: self.reg_display.open())
 		if config.hardware_id not in (0, 6): self.bind_(self.root, 'd', lambda x: self.disp_lcd.set((self.disp_lcd.get() + 1) % (self.num_buffers + 1)))
 
-		if config.hardware_id == 5 and config.real_hardware:
-			self.cwii_screen_hi = [bytearray(32) for _ in range(64)]
-			self.cwii_screen_lo = [bytearray(32) for _ in range(64)]
-
 		self.curr_buffer = -1
 
-		self.single_step = False
 		self.ok = True
 		self.step = False
+		self.core_thread = None
+		# run on the GUI thread by pygame_loop(), see gui_call()
+		self.gui_calls = collections.deque()
 		self.brkpoints = {}
 		self.stack = {}
 		self.clock = pygame.time.Clock()
 
-		self.prev_csr_pc = None
-		self.prev_prev_csr_pc = None
-		self.shutdown_accept = False
-		self.shutdown = False
-
-		self.int_timer = 0
-
 		self.scr_ranges = (31, 15, 19, 23, 27, 27, 9, 9)
 
-		self.call_trace = []
-
-		# TI MathPrint only
-		self.screen_changed = False
-		self.curr_key = 0
-
-		self.qr_active = False
-
 	@staticmethod
 	def open_gh(): webbrowser.open_new_tab('https://github.com/gamingwithevets/u8-emu-frontend')
 
@@ -947,31 +562,19 @@ class Sim:
 		setattr(self, var+'_tk', tk.BooleanVar(value = getattr(self, var)))
 	def set_tk_var(self, var): setattr(self, var, getattr(self, var+'_tk').get())
 
-	@functools.lru_cache
-	def get_emu_kb_addr(self, idx):
-		segment = 0
-		if config.hardware_id == 0: addr = 0xe800 + idx
-		elif config.hardware_id in (4, 5):
-			segment = 4 if config.hardware_id == 4 else 8
-			if config.hardware_id == 5 and self.sample:
-				if idx == 0: addr = 0x8e07
-				elif idx == 1: addr = 0x8e05
-				elif idx == 2: addr = 0x8e08
-			else: addr = 0x8e00 + idx
-		else: addr = 0x8e00 + idx
-		return segment, addr
-
-	def read_emu_kb(self, idx): return self.sim.read_mem_data(*self.get_emu_kb_addr(idx), 1)
-
-	def write_emu_kb(self, idx, val): self.sim.write_mem_data(*self.get_emu_kb_addr(idx), 1, val)
+	def set_factory_test(self):
+		self.set_tk_var('factory_test')
+		self.sim.c_config.factory_test = self.factory_test
 
 	def run(self):
 		self.reset_core()
+		if config.hardware_id == 6: self.wdt.start_wdt()
+		if self.rom_analysis: self.start_analysis()
+		if self.resume and self.load_resume(): logging.info('Resumed from last session')
 		self.set_single_step(self.single_step)
 		self.pygame_loop()
 
 		if os.name != 'nt': os.system('xset r off')
-		if config.hardware_id == 6: self.wdt.start_wdt()
 		self.root.mainloop()
 
 	@staticmethod
@@ -999,35 +602,6 @@ class Sim:
 
 		return True
 
-	def read_dmem(self, addr, num_bytes, segment = 0): return self.sim.read_mem_data(segment, addr, num_bytes)
-
-	def write_dmem(self, addr, num_bytes, data, segment = 0): self.sim.write_mem_data(segment, addr, num_bytes, data)
-
-	def read_dmem_bytes(self, addr, num_bytes, segment = 0):
-		data = b''
-		bytes_grabbed = 0
-
-		if num_bytes > 8:
-			while bytes_grabbed < num_bytes:
-				remaining = num_bytes - bytes_grabbed
-				if remaining >= 8: grab = 8
-				else: grab = remaining
-
-				dt = self.read_dmem(addr + bytes_grabbed, grab, segment)
-				data += dt.to_bytes(grab, 'little')
-				bytes_grabbed += grab
-			
-			return data
-		else: return self.read_dmem(addr, num_bytes, segment).to_bytes(num_bytes, 'little')
-
-
-	def read_cmem(self, addr, segment = 0):
-		if config.hardware_id == 2 and self.is_5800p and segment > 7:
-			mem = self.sim.flash_mem
-			segment -= 8
-		else: mem = self.sim.code_mem
-		return (mem[(segment << 16) + addr + 1] << 8) + mem[(segment << 16) + addr]
-
 	def calc_checksum(self):
 		csum = 0
 		if config.hardware_id == 3:
@@ -1085,9 +659,37 @@ class Sim:
 	def set_step(self): self.step = True
 
 	def set_single_step(self, val):
+		# a thread told to stop may still be finishing its slice, a running one is kept
+		if not val and self.single_step: self.stop_core_thread()
+		start = not val and (self.core_thread is None or not self.core_thread.is_alive())
 		self.single_step = val
+		self.wake_event.set()
 		if val: self.update_displays()
-		else: threading.Thread(target = self.core_step_loop, daemon = True).start()
+		elif start:
+			self.core_thread = threading.Thread(target = self.core_step_loop, daemon = True)
+			self.core_thread.start()
+
+	# Lets the current slice finish, so the machine state can be changed from the GUI thread
+	def stop_core_thread(self):
+		self.single_step = True
+		self.wake_event.set()
+		if self.core_thread is not None: self.core_thread.join()
+
+	def rewind_seconds(self, seconds):
+		sstep = self.single_step
+		self.stop_core_thread()
+		self.rewind.rewind_seconds(seconds)
+		self.set_single_step(sstep)
+
+	def reverse_step(self):
+		self.stop_core_thread()
+		if not self.rewind.step_back(): logging.info('Cannot step back past the oldest rewind snapshot')
+		self.set_single_step(True)
+
+	def reverse_continue(self):
+		self.stop_core_thread()
+		if not self.rewind.continue_back(): tk.messagebox.showinfo('Reverse continue', 'No breakpoint was hit in the recorded history.')
+		self.set_single_step(True)
 
 	def open_popup(self, x):
 		try:
@@ -1098,143 +700,61 @@ class Sim:
 			self.rc_menu.grab_release()
 			self.set_single_step(sstep_bak)
 
-	def keyboard(self):
-		if not self.sim.c_config.sfr[0x46] and self.factory_test:
-			self.sim.c_config.sfr[0x40] = 0b11100111
-			return
-
-		ki = 0xff
-		if len(self.keys_pressed) > 0:
-			ko = self.sim.c_config.sfr[0x44] ^ 0xff if self.ko_mode else self.sim.c_config.sfr[0x46]
-
-			try:
-				for val in self.keys_pressed:
-					if val == None: continue
-					if ko & (1 << val[1]): ki &= ~(1 << val[0])
-			except RuntimeError: pass
-
-		self.sim.c_config.sfr[0x40] = ki
+	# The core thread must not wait on tk, as stop_core_thread() may be joining it
+	# from the GUI thread, so anything it shows is left for pygame_loop() to run.
+	def gui_call(self, func, *args):
+		if threading.current_thread() is threading.main_thread(): func(*args)
+		else: self.gui_calls.append(functools.partial(func, *args))
+
+	def show_qr_notice(self): self.gui_call(tk.messagebox.showinfo, 'QR code', 'Detected emulator ROM QR code!\nGet the URL with right-click > Extra functions > QR code export > Copy URL to clipboard\n\nNote: due to the nature of the emulator, you might not see the QR code immediately')
+
+	def core_step(self, max_steps = 1):
+		icount = self.sim.c_config.icount
+		reason = super(Sim, self).core_step(max_steps)
+		steps = self.sim.c_config.icount - icount
+
+		if reason in (stop_reason_e.STOP_BRKPOINT, stop_reason_e.STOP_WATCH): self.hit_brkpoint()
+		elif reason == stop_reason_e.STOP_BRK:
+			self.gui_call(tk.messagebox.showwarning, 'Warning', 'BRK instruction hit!')
+			self.hit_brkpoint()
+		elif reason == stop_reason_e.STOP_WILD:
+			self.gui_call(tk.messagebox.showwarning, 'Warning', 'Jumped to unallocated code memory!')
+			self.hit_brkpoint()
+
+		if self.enable_ips and steps > 0:
+			self.ips_ctr += steps
+			cur = time.time()
+			if cur - self.ips_start >= 0.5:
+				self.ips = self.ips_ctr / (cur - self.ips_start)
+				self.ips_start = cur
+				self.ips_ctr = 0
+
+		return reason
 
-	def check_stop_type(self):
-		temp = self.read_emu_kb(0)
-		if temp in (2, 8): self.write_emu_kb(0, int([self.read_emu_kb(i) for i in (1, 2)] == [1<<2, 1<<4]))
-		elif temp in (5, 7) and not self.qr_active:
-			self.qr_active = True
-			tk.messagebox.showinfo('QR code', 'Detected emulator ROM QR code!\nGet the URL with right-click > Extra functions > QR code export > Copy URL to clipboard\n\nNote: due to the nature of the emulator, you might not see the QR code immediately')
-		elif temp == 6: self.qr_active = False
-
-	@staticmethod
-	def find_bit(num): return (num & -num).bit_length() - 1
-
-	def check_ints(self):
-		rang = (0x14, 0x16) if config.hardware_id != 6 else (0x18, 0x20)
-		if any(v != 0 for v in self.sim.c_config.sfr[rang[0]:rang[1]]):
-			for i in range(*rang):
-				if self.sim.c_config.sfr[i] == 0: continue
-				self.raise_int(i, self.find_bit(self.sim.c_config.sfr[i]))
-
-	def raise_int(self, irq, bit):
-		intdata = self.int_table[(irq, bit)]
-		if intdata[1] is not None and intdata[2] is not None: cond = self.sim.c_config.sfr[intdata[1]] & (1 << intdata[2])
-		else: cond = True
-
-		elevel = 2 if intdata[0] == 8 else 1
-		mie = elevel & (1 << 3) if elevel == 1 else 1
-		if cond and (self.sim.core.regs.psw & 3 >= elevel or elevel == 2) and mie:
-			#logging.info(f'{intdata[3]} interrupt raised {"@ "+self.get_addr_label(self.sim.core.regs.csr, self.sim.core.regs.pc) if intdata[3] != "WDTINT" else ""}')
-			self.standby.stop_mode = False
-			self.sim.c_config.sfr[irq] &= ~(1 << bit)
-			self.sim.core.regs.elr[elevel-1] = self.sim.core.regs.pc
-			self.sim.core.regs.ecsr[elevel-1] = self.sim.core.regs.csr
-			self.sim.core.regs.epsw[elevel-1] = self.sim.core.regs.psw
-			self.sim.core.regs.psw &= 0b11111100 if elevel == 2 else 0b11110100
-			self.sim.core.regs.psw |= elevel
-			self.sim.core.regs.csr = 0
-			self.sim.core.regs.pc = (self.sim.code_mem[intdata[0]+1] << 8) + self.sim.code_mem[intdata[0]]
-
-			self.int_timer = 2
-
-	def core_step(self):
-		if self.shutdown: return
-		prev_csr_pc = f'{self.sim.core.regs.csr:X}:{self.sim.core.regs.pc:04X}H'
-		if not self.standby.stop_mode:
-			prev_csrpc_int = (self.sim.core.regs.csr << 16) + self.sim.core.regs.pc
-
-			ins_word = self.read_cmem(self.sim.core.regs.pc, self.sim.core.regs.csr)
-			# BL Cadr
-			if ins_word & 0xf0ff == 0xf001: self.call_trace.insert(0, [((ins_word >> 8 & 0xf) << 16) + self.read_cmem(self.sim.core.regs.pc+2, self.sim.core.regs.csr), (self.sim.core.regs.csr << 16) + ((self.sim.core.regs.pc + 4) & 0xfffe)])
-			# BL ERn
-			elif ins_word & 0xff0f == 0xf003: self.call_trace.insert(0, [(self.sim.core.regs.csr << 16) + self.sim.read_reg_er(ins_word >> 4 & 0xf), (self.sim.core.regs.csr << 16) + ((self.sim.core.regs.pc + 2) & 0xfffe)])
-			# RT/POP PC
-			elif ins_word == 0xfe1f or ins_word & 0xf2ff == 0xf28e:
-				if len(self.call_trace) > 0: del self.call_trace[0]
-			# BRK
-			elif ins_word == 0xffff:
-				if self.sim.core.regs.psw & 3 < 2:
-					tk.messagebox.showwarning('Warning', 'BRK instruction hit!')
-					self.hit_brkpoint()
-
-			try: sim_lib.core_step(ctypes.pointer(self.sim.c_config), ctypes.pointer(self.sim.core))
-			except Exception as e: logging.error(f'{e} @ {self.get_addr_label(self.sim.core.regs.csr, self.sim.core.regs.pc-2)}')
-
-			if self.prev_csr_pc is not None: self.prev_prev_csr_pc = self.prev_csr_pc
-			if prev_csr_pc != self.prev_csr_pc: self.prev_csr_pc = prev_csr_pc
-
-			csrpc = (self.sim.core.regs.csr << 16) + self.sim.core.regs.pc
-			a = lambda x: x < self.sim.rom_length or 0x80000 <= x < 0x80000+self.sim.flash_length
-			if not a(csrpc) and a(prev_csrpc_int) and not self.single_step:
-				tk.messagebox.showwarning('Warning', 'Jumped to unallocated code memory!')
-				self.hit_brkpoint()
-
-			if config.hardware_id == 6:
-				last_swi = self.sim.core.last_swi
-				if last_swi < 0x40:
-					if last_swi == 1:
-						self.scr[3][0] = self.sim.read_reg_er(0)
-						self.sim.core.regs.gp[0] = self.sim.core.regs.gp[1] = 0
-						self.screen_changed = True
-					elif last_swi == 2:
-						self.sim.core.regs.gp[1] = 0
-						self.sim.core.regs.gp[0] = self.curr_key
-						#if self.curr_key != 0: self.hit_brkpoint()
-						self.curr_key = 0
-					elif last_swi == 4:
-						self.scr[3][1] = self.sim.read_reg_er(0)
-						self.sim.core.regs.gp[0] = self.sim.core.regs.gp[1] = 0
-						self.screen_changed = True
-
-			if self.enable_ips:
-				if self.ips_ctr % 1000 == 0:
-					cur = time.time()
-					try: self.ips = 1000 / (cur - self.ips_start)
-					except ZeroDivisionError: self.ips = None
-					self.ips_start = cur
-				self.ips_ctr += 1
-
-			if len(self.brkpoints) > 0:
-				if self.find_brkpoint((self.sim.core.regs.csr << 16) + self.sim.core.regs.pc, 0): self.hit_brkpoint()
-				if self.sim.core.last_read_size != 0 and any(self.find_brkpoint(i, 1) for i in range(self.sim.core.last_read, self.sim.core.last_read + self.sim.core.last_read_size)): self.hit_brkpoint()
-				if self.sim.core.last_write_size != 0 and any(self.find_brkpoint(i, 2) for i in range(self.sim.core.last_write, self.sim.core.last_write + self.sim.core.last_write_size)): self.hit_brkpoint()
-			
-		if config.hardware_id != 6:
-			if self.standby.stop_mode:
-				self.timer.timer()
-			self.keyboard()
-			if not config.real_hardware and self.standby.stop_mode: self.check_stop_type()
-		if (config.hardware_id != 2 or (config.hardware_id == 2 and self.is_5800p)) and self.int_timer == 0: self.check_ints()
-		if self.int_timer != 0: self.int_timer -= 1
+	def find_brkpoint(self, addr, typ): return any([v['enabled'] and v['addr'] == addr and v['type'] == typ for v in self.brkpoints.values()])
 
-		if config.hardware_id == 6: self.wdt.dec_wdt()
+	def update_brkpoint(self, addr):
+		# data addresses in segments 10H and up would alias onto code in the bitmap
+		if addr is not None and addr < 0x100000: self.sim.set_brkpoint(addr, self.find_brkpoint(addr, 0))
 
-	def find_brkpoint(self, addr, typ): return any([v['enabled'] and v['addr'] == addr and v['type'] == typ for v in self.brkpoints.values()])
+		self.sim.clear_watchpoints()
+		for v in self.brkpoints.values():
+			if v['enabled'] and v['type'] != 0 and v['addr'] is not None:
+				if not self.sim.add_watchpoint(v['type'], v['addr'], max(v['addr'], v['end'] or 0)):
+					logging.warning(f'Too many read/write breakpoints, only the first {MAX_WATCHPOINTS} are active')
+					break
 
 	def hit_brkpoint(self):
 		if not self.single_step:
-			self.set_single_step(True)
-			self.reg_display.open()
-			self.call_display.open()
-			self.debugger.open()
-			self.keys_pressed.clear()
+			self.single_step = True
+			for k in tuple(self.keys_pressed): self.apply_input(False, k)
+			self.gui_call(self.open_debugger)
+
+	def open_debugger(self):
+		self.set_single_step(True)
+		self.reg_display.open()
+		self.call_display.open()
+		self.debugger.open()
 
 	def update_displays(self):
 		self.screen_changed = True
@@ -1242,11 +762,80 @@ class Sim:
 		self.call_display.print_regs()
 		self.debugger.update()
 		self.data_mem.get_mem()
+		self.heatmap.update()
 
 	def save_flash(self):
 		f = tk.filedialog.asksaveasfile(mode = 'wb', initialfile = 'flash.bin', defaultextension = '.bin', filetypes = [('All Files', '*.*'), ('Binary Files', '*.bin')])
 		if f is not None: f.write(bytes(self.sim.flash_mem))
 
+	def save_state_as(self):
+		f = tk.filedialog.asksaveasfilename(initialfile = 'state.u8s', defaultextension = '.u8s', filetypes = [('All Files', '*.*'), ('Save States', '*.u8s')])
+		if not f: return
+		sstep = self.single_step
+		self.stop_core_thread()
+		try: self.save_state(f)
+		except OSError as e: tk.messagebox.showerror('Error', f'Cannot save state:\n{e}')
+		self.set_single_step(sstep)
+
+	def load_state_from(self):
+		f = tk.filedialog.askopenfilename(filetypes = [('All Files', '*.*'), ('Save States', '*.u8s')])
+		if not f: return
+		sstep = self.single_step
+		self.stop_core_thread()
+		try: self.load_state(f)
+		except (OSError, ValueError) as e: tk.messagebox.showerror('Error', f'Cannot load save state:\n{e}')
+		self.set_single_step(sstep)
+
+	def load_state(self, src):
+		super(Sim, self).load_state(src)
+		self.update_displays()
+
+	def record_journal_as(self):
+		f = tk.filedialog.asksaveasfilename(initialfile = 'inputs.u8j', defaultextension = '.u8j', filetypes = [('All Files', '*.*'), ('Input Journals', '*.u8j')])
+		if not f: return
+		sstep = self.single_step
+		self.stop_core_thread()
+		try: self.start_journal(f)
+		except OSError as e: tk.messagebox.showerror('Error', f'Cannot record inputs:\n{e}')
+		self.set_single_step(sstep)
+
+	def stop_recording(self):
+		sstep = self.single_step
+		self.stop_core_thread()
+		self.stop_journal()
+		self.set_single_step(sstep)
+
+	def trace_as(self):
+		f = tk.filedialog.asksaveasfilename(initialfile = 'trace.u8t', defaultextension = '.u8t', filetypes = [('All Files', '*.*'), ('Execution Traces', '*.u8t')])
+		if not f: return
+		sstep = self.single_step
+		self.stop_core_thread()
+		try: self.start_trace(f)
+		except OSError as e: tk.messagebox.showerror('Error', f'Cannot trace execution:\n{e}')
+		self.set_single_step(sstep)
+
+	def stop_tracing(self):
+		sstep = self.single_step
+		self.stop_core_thread()
+		self.stop_trace()
+		self.set_single_step(sstep)
+
+	def start_profiling(self):
+		sstep = self.single_step
+		self.stop_core_thread()
+		self.start_profile()
+		self.set_single_step(sstep)
+
+	def stop_profiling(self):
+		if self.profiler is None: return
+		sstep = self.single_step
+		self.stop_core_thread()
+		self.profiler.close()
+		self.set_single_step(sstep)
+		f = tk.filedialog.asksaveasfilename(initialfile = 'profile.txt', defaultextension = '.txt', filetypes = [('All Files', '*.*'), ('Text Files', '*.txt')])
+		try: self.stop_profile(f or None)
+		except OSError as e: tk.messagebox.showerror('Error', f'Cannot save profile:\n{e}')
+
 	def save_display(self, clipboard = True):
 		if clipboard:
 			temp = io.BytesIO()
@@ -1289,46 +878,20 @@ class Sim:
 	def core_step_loop(self):
 		if profile_mode:
 			with cProfile.Profile() as pr:
-				while not self.single_step: self.core_step()
+				while not self.single_step: self.core_step(self.slice_steps)
 				pr.print_stats()
 		else:
-			while not self.single_step: self.core_step()
+			while not self.single_step: self.core_step(self.slice_steps)
 
 	def decode_instruction(self, csr = None, pc = None):
 		if csr is None: csr = self.sim.core.regs.csr
 		if pc is None: pc = self.sim.core.regs.pc
-		return self.decode_instruction_(csr, pc)
+		return self.predecode.get(csr, pc)[:2]
 
-	@functools.lru_cache
-	def decode_instruction_(self, csr, pc):
-		self.disas.input_file = b''
-		for i in range(3): self.disas.input_file += self.read_cmem((pc + i*2) & 0xfffe, csr).to_bytes(2, 'little')
-		self.disas.addr = 0
-		ins_str, ins_len, dsr_prefix, _ = self.disas.decode_ins(True)
-		if dsr_prefix:
-			self.disas.last_dsr_prefix = ins_str
-			last_dsr_prefix_str = f'DW {int.from_bytes(self.disas.input_file[:2], "little"):04X}'
-			self.disas.addr += 2
-			ins_str, inslen, _, used_dsr_prefix = self.disas.decode_ins(True)
-			if used_dsr_prefix: return ins_str, inslen
-			else: return last_dsr_prefix_str, 2
-		return ins_str, ins_len
-
-	@staticmethod
-	def nearest_num(l, n): return max([i for i in l if i <= n], default = None)
-
-	def get_instruction_label(self, addr):
-		near = self.nearest_num(self.labels.keys(), addr)
-		if near is None: return
-		elif near >> 16 != addr >> 16: return
-		label = self.labels[near]
-		offset = addr - near
-		offset_str = hex(offset) if offset > 9 else str(offset)
-		return f'{label[0] if label[1] else self.labels[label[2]][0]+label[0]}{"+"+offset_str if offset != 0 else ""}'
-
-	def get_addr_label(self, csr, pc):
-		label = self.get_instruction_label((csr << 16) + pc)
-		return f'{csr:X}:{pc:04X}H{" ("+label+")" if label is not None else ""}'
+	def state_loaded(self):
+		super(Sim, self).state_loaded()
+		# flash is replaced behind write_flash()'s back
+		if self.sim.flash_length: self.predecode.clear()
 
 	def draw_text(self, text, size, x, y, color = (255, 255, 255), font_name = None, anchor = 'center'):
 		font = pygame.font.SysFont(font_name, int(size))
@@ -1529,29 +1092,21 @@ class Sim:
 		return screen_data_status_bar, screen_data
 
 	def reset_core(self):
-		self.sim.u8_reset()
-		if config.hardware_id == 6:
-			self.scr[3][0] = self.scr[3][1] = None
-			for i in range(0x1000): self.sim.c_config.sfr[i] = 0xff
-			self.sim.c_config.sfr[2] = 0x13
-			self.sim.c_config.sfr[3] = 3
-			self.sim.c_config.sfr[4] = 2
-			self.sim.c_config.sfr[5] = 0x40
-			self.sim.c_config.sfr[0xa] = 3
-			self.sim.c_config.sfr[0xe] = 0
-			self.sim.c_config.sfr[0xf] = 0x82
-			self.sim.c_config.sfr[0x900] = 6
-			self.sim.c_config.sfr[1] = 0x30
-			for i in range(0x10, 0x4f): self.sim.c_config.sfr[i] = 0
-		elif config.hardware_id == 2 and self.is_5800p: self.sim.write_mem_data(4, 0x7ffe, 2, 0x44ff)
-
-		self.call_trace = []
-		self.standby.stop_mode = False
-		self.shutdown = False
-		self.prev_csr_pc = None
+		super(Sim, self).reset_core()
+		self.state_edited()
 		self.update_displays()
 
 	def exit_sim(self):
+		self.stop_core_thread()
+		self.stop_journal()
+		self.stop_trace()
+		self.stop_profile()
+		try: self.stop_coverage(self.coverage_file)
+		except OSError as e: logging.warning(f'Cannot save coverage: {e}')
+		if self.resume:
+			try: self.save_resume()
+			except OSError as e: logging.warning(f'Cannot save resume state: {e}')
+
 		if self.rom8: os.remove(config.interface_path)
 
 		pygame.quit()
@@ -1560,6 +1115,7 @@ class Sim:
 		sys.exit()
 
 	def pygame_loop(self):
+		while self.gui_calls: self.gui_calls.popleft()()
 		if self.single_step and self.step: self.core_step()
 		if (self.single_step and self.step) or not self.single_step: self.update_displays()
 
@@ -1570,8 +1126,9 @@ class Sim:
 		if config.hardware_id == 6 and self.curr_key != 0:
 			pygame.draw.rect(self.screen, (255, 255, 255), config.keymap[self.curr_key][0])
 			self.screen.blit(self.interface, config.keymap[self.curr_key][0][:2], config.keymap[self.curr_key][0], pygame.BLEND_RGB_SUB)
-		elif len(self.keys_pressed) > 0:
-			for key in self.keys_pressed:
+		else:
+			# the core thread adds and removes keys while this runs
+			for key in tuple(self.keys_pressed):
 				pygame.draw.rect(self.screen, (255, 255, 255), config.keymap[key][0])
 				self.screen.blit(self.interface, config.keymap[key][0][:2], config.keymap[key][0], pygame.BLEND_RGB_SUB)
 
@@ -1669,46 +1226,63 @@ def report_exception(e, exc, tb):
 	traceback.print_exc()
 
 if __name__ == '__main__':
-	if len(sys.argv) > 2:
-		print('Usage:\n  main.py <script-path>\n  main.py <module-name>')
-		sys.exit()
-
-	logging.info(f'Importing config script {sys.argv[1] if len(sys.argv) > 1 else "config.py"}')
-	spec = importlib.util.spec_from_file_location('config', sys.argv[1] if len(sys.argv) > 1 else 'config.py')
-	if spec is None:
-		logging.warning(f'Cannot import config script as file, importing as module')
-		try: config = importlib.import_module(sys.argv[1] if len(sys.argv) > 1 else 'config')
-		except ImportError as e:
-			logging.error(f'Cannot import config script as module: {str(e)}')
-			sys.exit()
+	parser = argparse.ArgumentParser(description = 'u8-emu-frontend')
+	parser.add_argument('config', nargs = '?', help = 'config script path or module name (default: config.py)')
+	parser.add_argument('--headless', action = 'store_true', help = 'run without the GUI; Tk, pygame and PIL are not loaded')
+	parser.add_argument('--steps', type = int, help = 'headless: number of instructions to run (default: until the ROM stops)')
+	parser.add_argument('--lcd', help = 'headless: write the final LCD contents to this file')
+	parser.add_argument('--input', help = 'headless: input script of timed key presses and releases')
+	parser.add_argument('--replay', help = 'headless: replay an input journal recorded with --record')
+	parser.add_argument('--record', help = 'record an input journal of the session to this file')
+	parser.add_argument('--trace', help = 'write an execution trace of every instruction to this file')
+	parser.add_argument('--coverage', help = 'headless: write the code coverage of the run to this file, see execcov.py')
+	parser.add_argument('--insmix', help = 'headless: count the instructions run and write the instruction mix to this CSV file')
+	parser.add_argument('--profile', help = 'headless: profile the ROM and write the flat profile to this file, and the folded stacks next to it')
+	args = parser.parse_args()
+
+	config = emulator.load_config(args.config)
+	sim_lib = emulator.load_lib()
+
+	if args.headless:
+		try:
+			emu = Emulator()
+			if args.trace is not None: emu.start_trace(args.trace)
+			if args.coverage is not None:
+				emu.coverage_file = args.coverage
+				emu.start_coverage()
+			if args.insmix is not None: emu.start_op_counts()
+			if args.profile is not None:
+				if hasattr(config, 'labels') and config.labels: emu.labels = emulator.load_labels(config.labels)[0]
+				emu.start_profile()
+			start = time.time()
+			if args.replay is not None:
+				match = emu.replay_journal(args.replay)
+				emu.stop_trace()
+				emu.stop_profile(args.profile)
+				emu.stop_coverage(emu.coverage_file)
+				elapsed = time.time() - start
+				logging.info(f'Replayed up to instruction {emu.sim.c_config.icount} in {elapsed:.2f}s')
+				if match is not None: (logging.info if match else logging.error)(f'RAM {"matches" if match else "does not match"} the recording')
+			else:
+				if args.record is not None: emu.start_journal(args.record)
+				reason = emu.run(args.steps, emulator.load_inputs(args.input) if args.input is not None else ())
+				emu.stop_journal()
+				emu.stop_trace()
+				emu.stop_profile(args.profile)
+				emu.stop_coverage(emu.coverage_file)
+				elapsed = time.time() - start
+				icount = emu.sim.c_config.icount
+				logging.info(f'Stopped ({reason.name}) after {icount} instructions in {elapsed:.2f}s ({icount / elapsed if elapsed else 0:.0f} IPS)')
+			if args.insmix is not None: insmix.InsMix(insmix.load_disassembler()).write_csv(args.insmix, emu.op_counts)
+			if args.lcd is not None:
+				with open(args.lcd, 'wb') as f: f.write(emu.lcd_bytes())
+		except Exception: report_exception(*sys.exc_info())
 	else:
-		config = importlib.util.module_from_spec(spec)
-		sys.modules['config'] = config
-		spec.loader.exec_module(config)
-
-	if hasattr(config, 'dt_format') and config.dt_format != '%d/%m/%Y %H:%M:%S':
-		logging.basicConfig(datefmt = config.dt_format, format = '[%(asctime)s] %(levelname)s: %(message)s', level = level, force = True)
-		logging.info(f'Config script imported sucessfully. Date-time format is {config.dt_format}')
-	else: logging.info('Config script imported sucessfully')
-
-	# Load the sim library
-	sim_lib = ctypes.CDLL(os.path.abspath(config.shared_lib))
-
-	sim_lib.u8_step.argtypes = [ctypes.POINTER(u8_core_t)]
+		tk.Tk.report_callback_exception = report_exception
 
-	sim_lib.setup_mcu.argtypes = [ctypes.POINTER(c_config), ctypes.POINTER(u8_core_t), ctypes.POINTER(ctypes.c_uint8), ctypes.POINTER(ctypes.c_uint8), ctypes.c_int, ctypes.c_int]
-	sim_lib.core_step.argtypes = [ctypes.POINTER(c_config), ctypes.POINTER(u8_core_t)]
-
-	sim_lib.read_reg_er.argtypes = [ctypes.POINTER(u8_core_t), ctypes.c_uint8]
-	sim_lib.read_reg_er.restype = ctypes.c_uint16
-
-	sim_lib.read_mem_data.argtypes = [ctypes.POINTER(u8_core_t), ctypes.c_uint8, ctypes.c_uint16, ctypes.c_uint8]
-	sim_lib.read_mem_data.restype = ctypes.c_uint64
-	sim_lib.write_mem_data.argtypes = [ctypes.POINTER(u8_core_t), ctypes.c_uint8, ctypes.c_uint16, ctypes.c_uint8, ctypes.c_uint64]
-
-	tk.Tk.report_callback_exception = report_exception
-
-	try:
-		sim = Sim(no_clipboard, peripheral.bcd)
-		sim.run()
-	except Exception: report_exception(*sys.exc_info())
+		try:
+			sim = Sim(no_clipboard, peripheral.bcd)
+			if args.record is not None: sim.start_journal(args.record)
+			if args.trace is not None: sim.start_trace(args.trace)
+			sim.run()
+		except Exception: report_exception(*sys.exc_info())
@@ -1,10 +1,161 @@
 #include <stdio.h>
+#include <stddef.h>
 #include <string.h>
 #include <stdlib.h>
 
 #include "u8_emu/src/core/core.h"
 #include "u8_emu/src/core/mem.h"
 
+#define CALL_TRACE_MAX 1024  // must be a power of 2
+#define BRANCH_MAX 4096  // must be a power of 2
+#define MAX_WATCHPOINTS 64
+#define SNAP_PAGE 256  // granularity of rewind snapshots
+#define TRACE_PAIRS 7         // changed register bytes that fit in an instruction record
+#define TRACE_CONT_PAIRS 13   // and in each continuation record
+#define TRACE_MAX_RECORDS 5   // records one instruction can take: sync, instruction, 3 continuations
+#define TRACE_CONT 0xffffffff  // trace record holding more changed registers of the instruction before it
+#define TRACE_SYNC 0xfffffffe  // trace record giving the instruction count of the next instruction
+#define COV_HALFWORDS 0x80000  // code halfwords covered by the coverage bitmap, 1 MiB of code
+#define CODE_PAGE 256  // granularity of code_dirty
+#define HEAT_PAGES 0x10000  // 256-byte data pages counted by the heatmap
+#define PROF_DEPTH 64  // innermost call frames kept per profiler sample
+#define PROF_MAX_WORDS (2 + PROF_DEPTH)
+#define PROF_TRUNCATED 0x80000000  // sample flag: the call stack goes deeper than the frames kept
+
+// Reasons for run_steps() to return to the frontend
+enum stop_reason {
+	STOP_NONE     = 0,       // step budget exhausted
+	STOP_BRK      = 1 << 0,  // BRK instruction executed
+	STOP_SWI      = 1 << 1,  // SWI executed (TI MathPrint only)
+	STOP_STOPMODE = 1 << 2,  // CPU is in STOP mode
+	STOP_WILD     = 1 << 3,  // jumped to unallocated code memory
+	STOP_BRKPOINT = 1 << 4,  // reached an execute breakpoint
+	STOP_WATCH    = 1 << 5,  // touched a read/write watchpoint
+	STOP_TRACE    = 1 << 6,  // trace buffer is full, returned whatever the mask
+	STOP_PROFILE  = 1 << 7,  // profiler sample buffer is full, returned whatever the mask
+};
+
+// How timer 0 advances while the CPU is in STOP mode
+enum timer_mode {
+	TIMER_WALL    = 0,  // frontend advances it from the host clock
+	TIMER_VIRTUAL = 1,  // jumps straight to its next match
+};
+
+// Watchpoint types, same values as the breakpoint types of the frontend
+enum watch_type {
+	WATCH_READ  = 1,
+	WATCH_WRITE = 2,
+};
+
+// (irqsfr,bit):(vtadr,ie_sfr,bit, name)
+struct int_entry
+{
+	int irq;
+	int bit;
+	int vector;
+	int ie_sfr;  // -1 = non-maskable
+	int ie_bit;
+	const char *name;
+};
+
+// TI MathPrint
+static const struct int_entry int_table_ti[] = {
+	{0x18, 0, 0x08, -1,   0, "WDTINT"},      // Watchdog timer interrupt
+};
+
+// SOLAR II
+static const struct int_entry int_table_solar2[] = {
+	{0x14, 0, 0x08, 0x10, 0, "XI0INT"},      // External interrupt 0
+	{0x14, 1, 0x0a, 0x10, 1, "TM0INT"},      // Timer 0 interrupt
+	{0x14, 2, 0x0c, 0x10, 2, "L256SINT"},
+	{0x14, 3, 0x0e, 0x10, 3, "L1024SINT"},
+	{0x14, 4, 0x10, 0x10, 4, "L4096SINT"},
+	{0x14, 5, 0x12, 0x10, 5, "L16384SINT"},
+};
+
+// ES, ES PLUS, ClassWiz
+static const struct int_entry int_table_es[] = {
+	{0x14, 0, 0x08, -1,   0, "WDTINT"},      // Watchdog timer interrupt
+	{0x14, 1, 0x0a, 0x10, 1, "XI0INT"},      // External interrupt 0
+	{0x14, 2, 0x0c, 0x10, 2, "XI1INT"},      // External interrupt 1
+	{0x14, 3, 0x0e, 0x10, 3, "XI2INT"},      // External interrupt 2
+	{0x14, 4, 0x10, 0x10, 4, "XI3INT"},      // External interrupt 3
+	{0x14, 5, 0x12, 0x10, 5, "TM0INT"},      // Timer 0 interrupt
+	{0x14, 6, 0x14, 0x10, 6, "L256SINT"},
+	{0x14, 7, 0x16, 0x10, 7, "L1024SINT"},
+	{0x15, 0, 0x18, 0x11, 0, "L4096SINT"},
+	{0x15, 1, 0x1a, 0x11, 1, "L16384SINT"},
+	{0x15, 2, 0x1c, 0x11, 2, "SIO0INT"},     // Synchronous serial port 0 interrupt
+	{0x15, 3, 0x1e, 0x11, 3, "I2C0INT"},     // I2C bus 0 interrupt
+	{0x15, 4, 0x20, 0x11, 4, "I2C1INT"},     // I2C bus 1 interrupt
+	{0x15, 5, 0x22, 0x11, 5, "BENDINT"},
+	{0x15, 6, 0x24, 0x11, 6, "BLOWINT"},
+	{0x15, 7, 0x26, 0x11, 7, "RTCINT"},      // Real-time clock interrupt
+	{0x16, 0, 0x28, 0x12, 0, "AL0INT"},      // RTC alarm 0 interrupt
+	{0x16, 1, 0x2a, 0x12, 1, "AL1INT"},      // RTC alarm 1 interrupt
+};
+
+#define MAX_INTS (sizeof(int_table_es) / sizeof(int_table_es[0]))
+#define INT_IRQ_BASE 0x14
+#define INT_IRQ_END  0x20
+
+// Shadow call stack entry
+struct call_frame
+{
+	uint32_t func;    // CSR:PC of the called function
+	uint32_t ret;     // return CSR:PC
+	uint16_t sp;      // SP at the call
+	uint64_t icount;  // instruction count at the call
+};
+
+// Execution trace record, one per instruction plus continuations. Changed
+// registers are (offset into struct u8_regs, new value) pairs against the
+// previous instruction record; PC is left out as the next record has it.
+struct trace_record
+{
+	uint32_t csrpc;  // CSR:PC of the instruction, or TRACE_CONT/TRACE_SYNC
+	union {
+		struct {
+			uint16_t ins[2];  // opcode word and the word after it
+			uint32_t read;    // last data read as size << 24 | seg:addr, 0 if none
+			uint32_t write;   // same for the last data write
+			uint8_t nregs;    // changed register bytes in this record, TRACE_CONT records follow if it is full
+			uint8_t regs[TRACE_PAIRS][2];
+			uint8_t pad;
+		};
+		struct {
+			uint8_t nregs;
+			uint8_t regs[TRACE_CONT_PAIRS][2];
+			uint8_t pad;
+		} cont;
+		struct {
+			uint32_t icount_lo;
+			uint32_t icount_hi;
+		} sync;
+	};
+};
+
+// Last branch record entry
+struct branch
+{
+	uint32_t from;  // CSR:PC of the branch instruction
+	uint32_t to;    // CSR:PC it went to
+};
+
+// Data accesses counted by the heatmap
+struct heat
+{
+	uint64_t reads;
+	uint64_t writes;
+};
+
+struct watchpoint
+{
+	int type;
+	uint32_t start;  // seg:addr, inclusive
+	uint32_t end;
+};
+
 // Only necessary config parameters for peripheral handling
 struct config
 {
@@ -21,9 +172,68 @@ struct config
 	uint8_t *emu_seg;
 	uint8_t (*sfr_write[0x1000])(uint16_t, uint8_t);
 	int flash_mode;
+
+	// Run loop state
+	uint32_t rom_size;
+	uint32_t flash_size;
+	uint64_t icount;
+	bool stop_mode;
+	bool factory_test;
+	bool tick_pending;
+	int int_timer;
+	int wdt_counter;
+	uint8_t kb_matrix[8];  // KI bits of the pressed keys, indexed by KO line
+	int num_ints;
+	const struct int_entry *ints;
+	int8_t int_lookup[INT_IRQ_END - INT_IRQ_BASE][8];  // index into ints for each IRQ flag, -1 if none
+	uint32_t int_count[MAX_INTS];                      // times each interrupt was taken
+	int call_depth;  // valid frames in call_trace
+	int call_top;    // next free slot in call_trace
+	uint32_t call_lost;  // frames overwritten by deeper calls
+	struct call_frame call_trace[CALL_TRACE_MAX];
+	uint32_t branch_top;    // next free slot in branches
+	uint64_t branch_count;  // branches taken since reset, the last BRANCH_MAX are kept
+	struct branch branches[BRANCH_MAX];
+	uint8_t *brk_bitmap;  // one bit per CSR:PC
+	int num_watchpoints;
+	struct watchpoint watchpoints[MAX_WATCHPOINTS];
+	uint8_t *watch_pages;  // watch types present in each 256-byte data page
+	int watch_hit;         // index of the last watchpoint hit, -1 if none
+	int timer_mode;
+	uint64_t timer_ticks;  // timer 0 ticks skipped in virtual mode
+	uint32_t emu_seg_size;
+	struct trace_record *trace_buf;  // NULL if not tracing
+	uint64_t trace_pos;              // records written
+	uint64_t trace_cap;              // records trace_buf has room for
+	int trace_steps;                 // steps run before the last STOP_TRACE
+	bool trace_sync;                 // write a TRACE_SYNC record before the next instruction
+	uint8_t trace_regs[sizeof(struct u8_regs)];  // registers as of the last instruction record
+	uint8_t *cov_bitmap;  // one bit per code halfword executed, NULL if not recording coverage
+	uint8_t *cov_counts;  // executions of each instruction, saturating at 255, NULL if not counting
+	uint64_t *op_counts;      // executions of each opcode word, NULL if not counting
+	struct heat *heat_pages;  // accesses per 256-byte data page, NULL if not counting
+	struct heat *heat_sfr;    // accesses per SFR, counted along with heat_pages
+	uint32_t *prof_buf;       // profiler samples, NULL if not profiling
+	uint32_t prof_pos;        // words written
+	uint32_t prof_cap;        // words prof_buf has room for
+	uint32_t prof_interval;   // instructions between samples
+	uint32_t prof_countdown;  // instructions left until the next sample
+	int prof_steps;           // steps run before the last STOP_PROFILE
+	uint8_t *code_dirty;  // one byte per CODE_PAGE of flash programmed or erased, NULL if nobody asked
+	bool code_changed;    // some code_dirty byte is set
+};
+
+// The frontend allocates each core inside one of these, so that memory
+// callbacks, which are only handed the core, can find the matching config
+struct machine
+{
+	struct u8_core core;  // must stay the first member
+	struct config *config;
 };
 
-struct config *confptr;
+static inline struct config *get_config(struct u8_core *core) {
+	return ((struct machine *)core)->config;
+}
 
 void add_mem_region(struct u8_core *core, struct u8_mem_reg reg) {
 	++core->mem.num_regions;
@@ -36,11 +246,12 @@ void add_mem_region(struct u8_core *core, struct u8_mem_reg reg) {
 }
 
 uint8_t read_sfr(struct u8_core *core, uint8_t seg, uint16_t addr) {
-	return confptr->sfr[addr];
+	return get_config(core)->sfr[addr];
 }
 
 void write_sfr(struct u8_core *core, uint8_t seg, uint16_t addr, uint8_t val) {
-	if (confptr->sfr_write[addr]) confptr->sfr[addr] = confptr->sfr_write[addr](addr, val);
+	struct config *config = get_config(core);
+	if (config->sfr_write[addr]) config->sfr[addr] = config->sfr_write[addr](addr, val);
 }
 
 uint8_t battery(struct u8_core *core, uint8_t seg, uint16_t addr) {
@@ -48,73 +259,87 @@ uint8_t battery(struct u8_core *core, uint8_t seg, uint16_t addr) {
 }
 
 uint8_t read_flash(struct u8_core *core, uint8_t seg, uint16_t offset) {
+	struct config *config = get_config(core);
 	uint32_t fo = ((seg << 16) + offset) & 0x7ffff;
-	if (confptr->flash_mode == 6) {
-		confptr->flash_mode = 0;
+	if (config->flash_mode == 6) {
+		config->flash_mode = 0;
 		return 0x80;
 	}
-	return confptr->flash[fo];
+	return config->flash[fo];
+}
+
+// Tells the frontend that flash code in [fo, fo + len) changed, see Predecoder
+static void code_written(struct config *config, uint32_t fo, uint32_t len) {
+	if (!config->code_dirty) return;
+	for (uint32_t page = fo / CODE_PAGE; page <= (fo + len - 1) / CODE_PAGE; page++) config->code_dirty[page] = 1;
+	config->code_changed = true;
 }
 
 void write_flash(struct u8_core *core, uint8_t seg, uint16_t offset, uint8_t data) {
+	struct config *config = get_config(core);
 	uint32_t fo = ((seg << 16) + offset) & 0x7ffff;
-	switch (confptr->flash_mode) {
+	switch (config->flash_mode) {
 		case 0:
 			if (fo == 0xaaa && data == 0xaa) {
-				confptr->flash_mode = 1;
+				config->flash_mode = 1;
 				return;
 			}
 			break;
 		case 1:
 			if (fo == 0x555 && data == 0x55) {
-				confptr->flash_mode = 2;
+				config->flash_mode = 2;
 				return;
 			}
 			break;
 		case 2:
 			if (fo == 0xAAA && data == 0xA0) {
-				confptr->flash_mode = 3;
+				config->flash_mode = 3;
 				return;
 			}
 			if (fo == 0xaaa && data == 0x80) {
-				confptr->flash_mode = 4;
+				config->flash_mode = 4;
 				return;
 			}
 			break;
 		case 3:
 			//printf("%05X = %02x\n", fo + 0x80000, data);
-			confptr->flash[fo] = data;
-			confptr->flash_mode = 0;
+			config->flash[fo] = data;
+			code_written(config, fo, 1);
+			config->flash_mode = 0;
 			return;
 		case 4:
 			if (fo == 0xAAA && data == 0xaa) {
-				confptr->flash_mode = 5;
+				config->flash_mode = 5;
 				return;
 			}
 			break;
 		case 5:
 			if (fo == 0x555 && data == 0x55) {
-				confptr->flash_mode = 6;
+				config->flash_mode = 6;
 				return;
 			}
 			break;
 		case 6: // we dont know sector's mapping(?)
-			if (fo == 0)
-				memset(&confptr->flash[fo], 0xff, 0x7fff);
-			if (fo == 0x20000 || fo == 0x30000)
-				memset(&confptr->flash[fo], 0xff, 0xffff);
+			if (fo == 0) {
+				memset(&config->flash[fo], 0xff, 0x7fff);
+				code_written(config, fo, 0x7fff);
+			}
+			if (fo == 0x20000 || fo == 0x30000) {
+				memset(&config->flash[fo], 0xff, 0xffff);
+				code_written(config, fo, 0xffff);
+			}
 			//printf("erase %05X (%02x)\n", fo+0x80000, data);
 			return;
 		case 7:
 			if (fo == 0xaaa && data == 0xaa) {
-				confptr->flash_mode = 1;
+				config->flash_mode = 1;
 				return;
 			}
 			break;
 	}
 	if (data == 0xf0) {
 		//printf("reset mode\n");
-		confptr->flash_mode = 0;
+		config->flash_mode = 0;
 		return;
 	}
 	//if (data == 0xb0) {
@@ -129,9 +354,27 @@ void write_flash(struct u8_core *core, uint8_t seg, uint16_t offset, uint8_t dat
 }
 
 void setup_mcu(struct config *config, struct u8_core *core, uint8_t *rom, uint8_t *flash, int ramstart, int ramsize) {
-	confptr = config;
+	((struct machine *)core)->config = config;
 	config->rom = rom;
 	config->flash = flash;
+	config->brk_bitmap = calloc(0x100000 / 8, 1);
+	config->watch_pages = calloc(0x10000, 1);
+	config->watch_hit = -1;
+
+	// Interrupts
+	if (config->hwid == 6) {
+		config->ints = int_table_ti;
+		config->num_ints = sizeof(int_table_ti) / sizeof(int_table_ti[0]);
+	} else if (config->hwid == 0) {
+		config->ints = int_table_solar2;
+		config->num_ints = sizeof(int_table_solar2) / sizeof(int_table_solar2[0]);
+	} else {
+		config->ints = int_table_es;
+		config->num_ints = MAX_INTS;
+	}
+	memset(config->int_lookup, -1, sizeof(config->int_lookup));
+	for (int i = 0; i < config->num_ints; i++)
+		config->int_lookup[config->ints[i].irq - INT_IRQ_BASE][config->ints[i].bit] = i;
 
 	// ROM
 	core->codemem.num_regions = (config->hwid == 2 && config->is_5800p) ? 2 : 1;
@@ -212,6 +455,7 @@ void setup_mcu(struct config *config, struct u8_core *core, uint8_t *rom, uint8_
 				// Segment 4/8 [emulator]
 				config->emu_seg = malloc(0x10000);
 				memset(config->emu_seg, 0, 0x10000);
+				config->emu_seg_size = 0x10000;
 				add_mem_region(core, (struct u8_mem_reg){
 					.type = U8_REGION_DATA,
 					.rw = true,
@@ -303,6 +547,7 @@ void setup_mcu(struct config *config, struct u8_core *core, uint8_t *rom, uint8_
 				// PRAM
 				config->emu_seg = malloc(0x80000);
 				memset(config->emu_seg, 0, 0x80000);
+				config->emu_seg_size = 0x80000;
 				add_mem_region(core, (struct u8_mem_reg){
 					.type = U8_REGION_DATA,
 					.rw = true,
@@ -328,11 +573,403 @@ void setup_mcu(struct config *config, struct u8_core *core, uint8_t *rom, uint8_
 
 }
 
-void core_step(struct config *config, struct u8_core *core) {
+// Releases everything setup_mcu() allocated
+void free_mcu(struct config *config, struct u8_core *core) {
+	free(core->mem.regions);
+	free(core->codemem.regions);
+	core->mem.regions = core->codemem.regions = NULL;
+	core->mem.num_regions = core->codemem.num_regions = 0;
+
+	free(config->ram);
+	free(config->sfr);
+	free(config->emu_seg);
+	free(config->brk_bitmap);
+	free(config->watch_pages);
+	config->ram = config->sfr = config->emu_seg = config->brk_bitmap = config->watch_pages = NULL;
+	config->emu_seg_size = 0;
+}
+
+// One instruction, for run_steps() only: it masks CSR before the fetch
+static void core_step(struct config *config, struct u8_core *core) {
 	write_mem_data(core, 0, 0xf000, 1, core->regs.dsr);
-	
-	uint8_t wdp = read_mem_data(core, 0, 0xf00e, 1) & 1;
-	
-	core->regs.csr &= (config->real_hw && config->hwid == 3) ? 1 : 0xf;
 	u8_step(core);
 }
+
+uint16_t read_code(struct config *config, uint8_t csr, uint16_t pc) {
+	uint8_t *mem = config->rom;
+	if (config->hwid == 2 && config->is_5800p && csr > 7) {
+		mem = config->flash;
+		csr -= 8;
+	}
+	uint32_t addr = ((uint32_t)csr << 16) + pc;
+	return mem[addr] | mem[addr + 1] << 8;
+}
+
+void set_brkpoint(struct config *config, uint32_t csrpc, bool enabled) {
+	csrpc &= 0xfffff;
+	if (enabled) config->brk_bitmap[csrpc >> 3] |= 1 << (csrpc & 7);
+	else config->brk_bitmap[csrpc >> 3] &= ~(1 << (csrpc & 7));
+}
+
+void clear_watchpoints(struct config *config) {
+	config->num_watchpoints = 0;
+	memset(config->watch_pages, 0, 0x10000);
+}
+
+bool add_watchpoint(struct config *config, int type, uint32_t start, uint32_t end) {
+	if (config->num_watchpoints == MAX_WATCHPOINTS) return false;
+	start &= 0xffffff;
+	end &= 0xffffff;
+	config->watchpoints[config->num_watchpoints++] = (struct watchpoint){type, start, end};
+	for (uint32_t page = start >> 8; page <= end >> 8; page++) config->watch_pages[page] |= type;
+	return true;
+}
+
+static bool check_watch(struct config *config, int type, uint32_t addr, uint8_t size) {
+	uint32_t end = (addr + size - 1) & 0xffffff;
+	if (!((config->watch_pages[addr >> 8] | config->watch_pages[end >> 8]) & type)) return false;
+
+	for (int i = 0; i < config->num_watchpoints; i++) {
+		struct watchpoint *w = &config->watchpoints[i];
+		if ((w->type & type) && addr <= w->end && end >= w->start) {
+			config->watch_hit = i;
+			return true;
+		}
+	}
+	return false;
+}
+
+static inline bool code_allocated(struct config *config, uint32_t csrpc) {
+	return csrpc < config->rom_size || (csrpc >= 0x80000 && csrpc < 0x80000 + config->flash_size);
+}
+
+static void raise_int(struct config *config, struct u8_core *core, int irq, int bit) {
+	int idx = config->int_lookup[irq - INT_IRQ_BASE][bit];
+	if (idx < 0) return;
+	const struct int_entry *intdata = &config->ints[idx];
+
+	bool cond = intdata->ie_sfr < 0 || (config->sfr[intdata->ie_sfr] & (1 << intdata->ie_bit));
+
+	int elevel = intdata->vector == 8 ? 2 : 1;
+	// maskable interrupts need PSW.MIE set and ELEVEL at most 1, the NMI is always taken
+	bool enabled = elevel == 2 || ((core->regs.psw & (1 << 3)) && (core->regs.psw & 3) <= 1);
+	if (cond && enabled) {
+		config->stop_mode = false;
+		config->sfr[irq] &= ~(1 << bit);
+		core->regs.elr[elevel-1] = core->regs.pc;
+		core->regs.ecsr[elevel-1] = core->regs.csr;
+		core->regs.epsw[elevel-1] = core->regs.psw;
+		core->regs.psw &= elevel == 2 ? 0b11111100 : 0b11110100;
+		core->regs.psw |= elevel;
+		core->regs.csr = 0;
+		core->regs.pc = config->rom[intdata->vector] | config->rom[intdata->vector + 1] << 8;
+
+		config->int_timer = 2;
+		++config->int_count[idx];
+	}
+}
+
+static void check_ints(struct config *config, struct u8_core *core) {
+	int start = config->hwid != 6 ? 0x14 : 0x18;
+	int end = config->hwid != 6 ? 0x16 : 0x20;
+	for (int i = start; i < end; i++)
+		if (config->sfr[i]) raise_int(config, core, i, __builtin_ctz(config->sfr[i]));
+}
+
+static void keyboard(struct config *config) {
+	if (!config->sfr[0x46] && config->factory_test) {
+		config->sfr[0x40] = 0b11100111;
+		return;
+	}
+
+	uint8_t ki = 0xff;
+	uint8_t ko = config->ko_mode ? config->sfr[0x44] ^ 0xff : config->sfr[0x46];
+	for (int i = 0; i < 8; i++)
+		if (ko & (1 << i)) ki &= ~config->kb_matrix[i];
+
+	config->sfr[0x40] = ki;
+}
+
+static void wdt_tick(struct config *config) {
+	static const int ms[] = {4096, 16384, 65536, 262144};
+	if (config->wdt_counter > 0 && --config->wdt_counter == 0) {
+		config->sfr[0x18] |= 1;
+		config->wdt_counter = ms[config->sfr[0xf] & 3];
+	}
+}
+
+// Per-iteration peripheral work that used to be done by the frontend after every step
+static void peripheral_tick(struct config *config, struct u8_core *core) {
+	config->tick_pending = false;
+	if (config->hwid != 6) keyboard(config);
+	if ((config->hwid != 2 || config->is_5800p) && config->int_timer == 0) check_ints(config, core);
+	if (config->int_timer != 0) --config->int_timer;
+	if (config->hwid == 6) wdt_tick(config);
+}
+
+static void trace_call(struct config *config, struct u8_core *core, uint16_t ins) {
+	uint8_t csr = core->regs.csr;
+	uint16_t pc = core->regs.pc;
+	uint32_t func, ret;
+
+	// BL Cadr
+	if ((ins & 0xf0ff) == 0xf001) {
+		func = ((uint32_t)(ins >> 8 & 0xf) << 16) + read_code(config, csr, pc + 2);
+		ret = ((uint32_t)csr << 16) + ((pc + 4) & 0xfffe);
+	}
+	// BL ERn
+	else if ((ins & 0xff0f) == 0xf003) {
+		func = ((uint32_t)csr << 16) + read_reg_er(core, ins >> 4 & 0xf);
+		ret = ((uint32_t)csr << 16) + ((pc + 2) & 0xfffe);
+	}
+	// RT/POP PC
+	else if (ins == 0xfe1f || (ins & 0xf2ff) == 0xf28e) {
+		if (config->call_depth > 0) {
+			--config->call_depth;
+			config->call_top = (config->call_top - 1) & (CALL_TRACE_MAX - 1);
+		} else if (config->call_lost > 0) --config->call_lost;
+		return;
+	}
+	else return;
+
+	config->call_trace[config->call_top] = (struct call_frame){func, ret, core->regs.sp, config->icount};
+	config->call_top = (config->call_top + 1) & (CALL_TRACE_MAX - 1);
+	if (config->call_depth < CALL_TRACE_MAX) ++config->call_depth;
+	else ++config->call_lost;
+}
+
+static void write_emu_kb(struct config *config, struct u8_core *core, int idx, uint8_t val) {
+	uint8_t seg = 0;
+	uint16_t addr = 0x8e00 + idx;
+	if (config->hwid == 0) addr = 0xe800 + idx;
+	else if (config->hwid == 4 || config->hwid == 5) {
+		seg = config->hwid == 4 ? 4 : 8;
+		if (config->hwid == 5 && config->sample) addr = idx == 0 ? 0x8e07 : idx == 1 ? 0x8e05 : 0x8e08;
+	}
+	write_mem_data(core, seg, addr, 1, val);
+}
+
+// Timer 0 ticks until TM0C reaches TM0D, 0 if it already has or the timer is stopped
+uint32_t timer_ticks_left(struct config *config) {
+	if (!(config->sfr[0x25] & 1)) return 0;
+	uint16_t counter = config->sfr[0x22] | config->sfr[0x23] << 8;
+	uint16_t target = config->sfr[0x20] | config->sfr[0x21] << 8;
+	return counter >= target ? 0 : target - counter;
+}
+
+// Advance timer 0, waking the CPU from STOP mode on a match
+void timer_tick(struct config *config, struct u8_core *core, uint32_t ticks) {
+	if (!(config->sfr[0x25] & 1)) return;
+	uint16_t counter = config->sfr[0x22] | config->sfr[0x23] << 8;
+	uint16_t target = config->sfr[0x20] | config->sfr[0x21] << 8;
+
+	counter += ticks;
+	config->sfr[0x22] = counter & 0xff;
+	config->sfr[0x23] = counter >> 8;
+
+	if (counter >= target && config->stop_mode) {
+		config->stop_mode = false;
+		config->sfr[0x14] = 0x20;
+		if (!config->real_hw) {
+			write_emu_kb(config, core, 1, 0);
+			write_emu_kb(config, core, 2, 0);
+		}
+	}
+}
+
+// Jump timer 0 straight to its next match
+void timer_skip(struct config *config, struct u8_core *core) {
+	uint32_t ticks = timer_ticks_left(config);
+	config->timer_ticks += ticks;
+	timer_tick(config, core, ticks);
+}
+
+static void trace_step(struct config *config, struct u8_core *core, uint32_t csrpc, uint16_t ins) {
+	struct trace_record *r = &config->trace_buf[config->trace_pos++];
+
+	if (config->trace_sync) {
+		config->trace_sync = false;
+		r->csrpc = TRACE_SYNC;
+		r->sync.icount_lo = (config->icount - 1) & 0xffffffff;
+		r->sync.icount_hi = (config->icount - 1) >> 32;
+		r = &config->trace_buf[config->trace_pos++];
+	}
+
+	r->csrpc = csrpc;
+	r->ins[0] = ins;
+	r->ins[1] = read_code(config, csrpc >> 16, (csrpc + 2) & 0xffff);
+	r->read = core->last_read_size ? (uint32_t)core->last_read_size << 24 | (core->last_read & 0xffffff) : 0;
+	r->write = core->last_write_size ? (uint32_t)core->last_write_size << 24 | (core->last_write & 0xffffff) : 0;
+
+	uint8_t *now = (uint8_t *)&core->regs;
+	uint8_t *prev = config->trace_regs;
+	memcpy(prev + offsetof(struct u8_regs, pc), now + offsetof(struct u8_regs, pc), sizeof(core->regs.pc));
+
+	uint8_t *nregs = &r->nregs;
+	uint8_t (*pairs)[2] = r->regs;
+	int room = TRACE_PAIRS;
+	*nregs = 0;
+	for (size_t w = 0; w < sizeof(struct u8_regs); w += 8) {
+		// most instructions change a byte or two, so skip equal words whole
+		size_t len = sizeof(struct u8_regs) - w < 8 ? sizeof(struct u8_regs) - w : 8;
+		if (!memcmp(now + w, prev + w, len)) continue;
+		for (size_t i = w; i < w + len; i++) {
+			if (now[i] == prev[i]) continue;
+			if (!room) {
+				r = &config->trace_buf[config->trace_pos++];
+				r->csrpc = TRACE_CONT;
+				nregs = &r->cont.nregs;
+				pairs = r->cont.regs;
+				room = TRACE_CONT_PAIRS;
+				*nregs = 0;
+			}
+			pairs[*nregs][0] = i;
+			pairs[*nregs][1] = prev[i] = now[i];
+			++*nregs;
+			--room;
+		}
+	}
+}
+
+// Counts the data accesses of the last instruction. Like watchpoints, this sees
+// the last read and write of each instruction, each counted as one access.
+static inline void heat_step(struct config *config, struct u8_core *core) {
+	if (core->last_read_size) {
+		uint32_t addr = core->last_read & 0xffffff;
+		++config->heat_pages[addr >> 8].reads;
+		if ((addr & 0xfff000) == 0xf000) ++config->heat_sfr[addr & 0xfff].reads;
+	}
+	if (core->last_write_size) {
+		uint32_t addr = core->last_write & 0xffffff;
+		++config->heat_pages[addr >> 8].writes;
+		if ((addr & 0xfff000) == 0xf000) ++config->heat_sfr[addr & 0xfff].writes;
+	}
+}
+
+// Adds up heat_pages over each data memory region set up by setup_mcu(), in order
+void heat_regions(struct config *config, struct u8_core *core, struct heat *out) {
+	for (int i = 0; i < core->mem.num_regions; i++) {
+		struct u8_mem_reg *reg = &core->mem.regions[i];
+		out[i] = (struct heat){0, 0};
+		for (uint32_t page = reg->addr_l >> 8; page <= reg->addr_h >> 8 && page < HEAT_PAGES; page++) {
+			out[i].reads += config->heat_pages[page].reads;
+			out[i].writes += config->heat_pages[page].writes;
+		}
+	}
+}
+
+// Marks the instruction at csrpc as executed, and its second word if wide
+static inline void cover(struct config *config, uint32_t csrpc, bool wide) {
+	uint32_t h = csrpc >> 1 & (COV_HALFWORDS - 1);
+	config->cov_bitmap[h >> 3] |= 1 << (h & 7);
+	if (wide) config->cov_bitmap[(h + 1) >> 3 & (COV_HALFWORDS / 8 - 1)] |= 1 << ((h + 1) & 7);
+	if (config->cov_counts && config->cov_counts[h] != 0xff) ++config->cov_counts[h];
+}
+
+// Profiler sample: frame count (| PROF_TRUNCATED), CSR:PC about to run,
+// then the functions of the innermost call frames, outermost first
+static void prof_sample(struct config *config, struct u8_core *core) {
+	uint32_t *s = &config->prof_buf[config->prof_pos];
+	int n = config->call_depth < PROF_DEPTH ? config->call_depth : PROF_DEPTH;
+	s[0] = n | (n < config->call_depth || config->call_lost ? PROF_TRUNCATED : 0);
+	s[1] = ((uint32_t)core->regs.csr << 16) + core->regs.pc;
+	for (int i = 0; i < n; i++) s[2 + i] = config->call_trace[(config->call_top - n + i) & (CALL_TRACE_MAX - 1)].func;
+	config->prof_pos += 2 + n;
+	config->prof_countdown = config->prof_interval;
+}
+
+int run_steps(struct config *config, struct u8_core *core, int max_steps, int stop_mask) {
+	if (config->tick_pending) peripheral_tick(config, core);
+
+	for (int i = 0; i < max_steps; i++) {
+		if (config->stop_mode) {
+			peripheral_tick(config, core);
+			// Emulator ROMs need the frontend to check the STOP type first, see Sim.core_step()
+			if (config->stop_mode && config->timer_mode == TIMER_VIRTUAL && config->real_hw && config->hwid != 6) timer_skip(config, core);
+			if (config->stop_mode && (stop_mask & STOP_STOPMODE)) return STOP_STOPMODE;
+			continue;
+		}
+
+		if (config->trace_buf && config->trace_pos + TRACE_MAX_RECORDS > config->trace_cap) {
+			config->trace_steps = i;
+			return STOP_TRACE;
+		}
+
+		if (config->prof_buf && config->prof_countdown == 1 && config->prof_pos + PROF_MAX_WORDS > config->prof_cap) {
+			config->prof_steps = i;
+			return STOP_PROFILE;
+		}
+
+		// before the fetch, so the opcode seen here is the one that runs and stays inside code memory
+		core->regs.csr &= (config->real_hw && config->hwid == 3) ? 1 : 0xf;
+		uint32_t prev_csrpc = ((uint32_t)core->regs.csr << 16) + core->regs.pc;
+		uint16_t ins = read_code(config, core->regs.csr, core->regs.pc);
+		trace_call(config, core, ins);
+		if (config->op_counts) ++config->op_counts[ins];
+		bool brk = ins == 0xffff && (core->regs.psw & 3) < 2;
+
+		core_step(config, core);
+		++config->icount;
+
+		// The frontend has to fix up registers before the next interrupt check
+		if (config->hwid == 6 && core->last_swi < 0x40 && (stop_mask & STOP_SWI)) {
+			if (config->trace_buf) trace_step(config, core, prev_csrpc, ins);
+			if (config->cov_bitmap) cover(config, prev_csrpc, false);
+			config->tick_pending = true;
+			return STOP_SWI;
+		}
+
+		peripheral_tick(config, core);
+		if (config->trace_buf) trace_step(config, core, prev_csrpc, ins);
+		if (config->heat_pages) heat_step(config, core);
+		if (config->prof_buf && --config->prof_countdown == 0) prof_sample(config, core);
+
+		// Anything but the next instruction is a taken branch, interrupts included.
+		// Instructions are 2 or 4 bytes long; Bcond is 2, so +4 means it skipped one.
+		uint32_t csrpc = ((uint32_t)core->regs.csr << 16) + core->regs.pc;
+		uint32_t delta = csrpc - prev_csrpc;
+		bool sequential = delta == 2 || (delta == 4 && (ins & 0xf000) != 0xc000);
+		if (!sequential) {
+			config->branches[config->branch_top] = (struct branch){prev_csrpc, csrpc};
+			config->branch_top = (config->branch_top + 1) & (BRANCH_MAX - 1);
+			++config->branch_count;
+		}
+		// B/BL Cadr are the only 4-byte instructions that branch
+		if (config->cov_bitmap) cover(config, prev_csrpc, (sequential && delta == 4) || (ins & 0xf0fe) == 0xf000);
+
+		if (brk && (stop_mask & STOP_BRK)) return STOP_BRK;
+
+		if ((stop_mask & STOP_WILD) && !code_allocated(config, csrpc) && code_allocated(config, prev_csrpc)) return STOP_WILD;
+		if ((stop_mask & STOP_BRKPOINT) && (config->brk_bitmap[(csrpc & 0xfffff) >> 3] & (1 << (csrpc & 7)))) return STOP_BRKPOINT;
+		if (stop_mask & STOP_WATCH) {
+			if (core->last_read_size && check_watch(config, WATCH_READ, core->last_read, core->last_read_size)) return STOP_WATCH;
+			if (core->last_write_size && check_watch(config, WATCH_WRITE, core->last_write, core->last_write_size)) return STOP_WATCH;
+		}
+	}
+
+	return STOP_NONE;
+}
+
+// Rewind snapshots: brings shadow up to date with mem one page at a time,
+// saving the old contents of every page that changed to undo and its index
+// to pages. Returns the number of changed pages.
+int diff_pages(const uint8_t *mem, uint8_t *shadow, uint32_t size, uint8_t *undo, uint32_t *pages) {
+	int n = 0;
+	for (uint32_t i = 0; i < size; i += SNAP_PAGE) {
+		uint32_t len = size - i < SNAP_PAGE ? size - i : SNAP_PAGE;
+		if (memcmp(mem + i, shadow + i, len)) {
+			memcpy(undo + n * SNAP_PAGE, shadow + i, len);
+			memcpy(shadow + i, mem + i, len);
+			pages[n++] = i / SNAP_PAGE;
+		}
+	}
+	return n;
+}
+
+// Writes pages saved by diff_pages() back into shadow
+void undo_pages(uint8_t *shadow, uint32_t size, const uint8_t *undo, const uint32_t *pages, int n) {
+	for (int i = 0; i < n; i++) {
+		uint32_t addr = pages[i] * SNAP_PAGE;
+		memcpy(shadow + addr, undo + i * SNAP_PAGE, size - addr < SNAP_PAGE ? size - addr : SNAP_PAGE);
+	}
+}
@@ -8,6 +8,13 @@ class Standby:
 		self.sim.sim.register_sfr(8, 1, self.stpacp)
 		self.sim.sim.register_sfr(9, 1, self.sbycon)
 
+	# kept in the C config so the native run loop can see it
+	@property
+	def stop_mode(self): return self.sim.sim.c_config.stop_mode
+
+	@stop_mode.setter
+	def stop_mode(self, val): self.sim.sim.c_config.stop_mode = val
+
 	def stpacp(self, addr, val):
 		if self.stop_accept[0]:
 			if val & 0xa0 == 0xa0: self.stop_accept[1] = True
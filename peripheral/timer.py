@@ -7,12 +7,23 @@ class Timer:
 		self.nsps = 1e9
 		self.max_ns_per_update = 1e9
 		self.tps = 10000
+		self.max_ticks_per_update = 100
 		self.last_time = 0
 		self.passed_time = 0
 
 		self.sim.sim.register_sfr(0x20, 6)
 
+	# Returns the ticks applied, None in virtual mode
 	def timer(self):
+		ticks = self.ticks_due()
+		if ticks is None: self.sim.sim.timer_skip()
+		else: self.timer_tick(ticks)
+		return ticks
+
+	# Ticks of wall-clock time since the last call, None in virtual mode
+	def ticks_due(self):
+		if self.sim.timer_mode == 1: return
+
 		now = time.time_ns()
 		passed_ns = now - self.last_time
 		self.last_time = now
@@ -20,24 +31,13 @@ class Timer:
 		elif passed_ns > self.max_ns_per_update: passed_ns = 0
 
 		self.passed_time += passed_ns * self.tps / self.nsps
-		ticks = int(self.passed_time) if self.passed_time < 100 else 100
+		ticks = int(self.passed_time) if self.passed_time < self.max_ticks_per_update else self.max_ticks_per_update
 		self.passed_time -= ticks
+		return ticks
 
-		self.timer_tick(ticks)
-
-	def timer_tick(self, tick):
-		if self.sim.sim.c_config.sfr[0x25] & 1:
-			counter = (self.sim.sim.c_config.sfr[0x23] << 8) + self.sim.sim.c_config.sfr[0x22]
-			target = (self.sim.sim.c_config.sfr[0x21] << 8) + self.sim.sim.c_config.sfr[0x20]
-
-			counter = (counter + tick) & 0xffff
-
-			self.sim.sim.c_config.sfr[0x22] = counter & 0xff
-			self.sim.sim.c_config.sfr[0x23] = counter >> 8
+	# Seconds until timer 0 reaches its target, None if it is stopped
+	def time_to_match(self):
+		if not self.sim.sim.c_config.sfr[0x25] & 1: return None
+		return min(self.sim.sim.timer_ticks_left(), self.max_ticks_per_update) / self.tps
 
-			if counter >= target and self.sim.standby.stop_mode:
-				self.sim.standby.stop_mode = False
-				self.sim.sim.c_config.sfr[0x14] = 0x20
-				if not self.sim.sim.c_config.real_hw:
-					self.sim.write_emu_kb(1, 0)
-					self.sim.write_emu_kb(2, 0)
+	def timer_tick(self, tick): self.sim.sim.timer_tick(tick)
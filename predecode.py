@@ -0,0 +1,100 @@
+# Predecoded instructions
+#
+# Disassembling an instruction is slow compared to drawing it, and the
+# debugger asks for the same ones over and over while stepping. Decoded
+# instructions are kept in a table indexed by CSR:PC, split into 256-byte
+# pages, and read straight out of code_mem / flash_mem through memoryviews.
+#
+# On the fx-5800P, code in flash can be programmed and erased by the running
+# program. write_flash() in peripheral.c marks the flash pages it changed in
+# code_dirty, and the pages are dropped from the table the next time an
+# instruction is looked up. The page before a dirty one is dropped as well,
+# as its last instructions can run into the dirty page. Loading a state
+# replaces flash as a whole, so Sim.state_loaded() calls clear().
+
+import ctypes
+
+PAGE_SHIFT = 8
+FLASH_PAGES = 0x80000 >> PAGE_SHIFT
+
+class Predecoder:
+	def __init__(self, emu, disas):
+		self.emu = emu
+		self.disas = disas
+		# page (CSR:PC >> 8) -> {CSR:PC: (instruction, length, DSR prefix or None)}
+		self.pages = {}
+		# bumped whenever decoded instructions are dropped, so views know to redraw
+		self.generation = 0
+
+		sim = emu.sim
+		code = memoryview(sim.code_mem).cast('B')
+		self.segments = [code[seg << 16:(seg + 1) << 16] for seg in range(len(code) >> 16)]
+		self.dirty = None
+		if sim.flash_length:
+			flash = memoryview(sim.flash_mem).cast('B')
+			self.segments[8:] = [flash[seg << 16:(seg + 1) << 16] for seg in range(len(flash) >> 16)]
+			self.dirty = (ctypes.c_uint8 * FLASH_PAGES)()
+			sim.c_config.code_dirty = self.dirty
+			sim.c_config.code_changed = False
+
+	def clear(self):
+		self.pages.clear()
+		self.generation += 1
+
+	# Drops the pages of flash programmed or erased since the last call
+	def invalidate(self):
+		if self.dirty is None: return
+		c_config = self.emu.sim.c_config
+		if not c_config.code_changed: return
+		# write_flash() on the core thread may mark more pages meanwhile: it sets
+		# the flag after the pages, and only the bytes seen set here are cleared
+		c_config.code_changed = False
+		self.generation += 1
+		dirty = self.dirty
+		for i in (i for i, d in enumerate(bytes(dirty)) if d):
+			dirty[i] = 0
+			page = (8 << 16 >> PAGE_SHIFT) + i
+			self.pages.pop(page, None)
+			self.pages.pop(page - 1, None)
+
+	def decode(self, csr, pc):
+		pc &= 0xfffe
+		if csr >= len(self.segments): data = bytes(6)
+		else:
+			seg = self.segments[csr]
+			# wraps around within the segment, like the CPU
+			data = bytes(seg[pc:pc + 6]) if pc <= 0xfffa else bytes(seg[pc:]) + bytes(seg[:pc - 0xfffa])
+
+		disas = self.disas
+		disas.input_file = data
+		disas.addr = 0
+		ins_str, ins_len, dsr_prefix, _ = disas.decode_ins(True)
+		if not dsr_prefix: return ins_str, ins_len, None
+
+		disas.last_dsr_prefix = ins_str
+		disas.addr += 2
+		ins_str_, ins_len_, _, used_dsr_prefix = disas.decode_ins(True)
+		if used_dsr_prefix: return ins_str_, ins_len_, ins_str
+		return f'DW {int.from_bytes(data[:2], "little"):04X}', 2, ins_str
+
+	# (instruction, length, DSR prefix or None) at CSR:PC. A DSR prefix is
+	# decoded together with the instruction that uses it.
+	def get(self, csr, pc):
+		if self.dirty is not None: self.invalidate()
+		csrpc = csr << 16 | pc
+		page = self.pages.get(csrpc >> PAGE_SHIFT)
+		if page is None: page = self.pages[csrpc >> PAGE_SHIFT] = {}
+		ins = page.get(csrpc)
+		if ins is None: ins = page[csrpc] = self.decode(csr, pc)
+		return ins
+
+	# Decodes [start, end) of a segment in one go, following instruction lengths.
+	# Returns [(PC, instruction, length, DSR prefix or None)].
+	def fill(self, csr, start, end):
+		result = []
+		pc = start & 0xfffe
+		while pc < end:
+			ins = self.get(csr, pc)
+			result.append((pc, *ins))
+			pc += ins[1] or 2
+		return result
@@ -0,0 +1,106 @@
+# Sampling profiler for the emulated CPU
+#
+# Every interval instructions, the native run loop writes CSR:PC and the
+# functions on the shadow call stack into a sample buffer (see prof_sample()
+# in peripheral.c). When the buffer is full, run_steps() returns STOP_PROFILE
+# and Core.run_steps() drains it into a count of identical stacks, so memory
+# use follows the number of distinct stacks, not the length of the run.
+#
+# Samples are only taken while instructions run, so time spent in STOP mode
+# is not counted. Functions are named by the code labels of the config script,
+# or by their CSR:PC when there are none.
+#
+# Reports (see Profiler.write()):
+#   flat profile   samples per function, self (the function was running)
+#                  and total (the function was on the call stack)
+#   folded stacks  one line per distinct stack, "outer;...;inner <samples>",
+#                  as taken by flamegraph.pl, speedscope, inferno and the like
+
+import os
+import ctypes
+import collections
+
+BUF_WORDS = 1 << 16
+PROF_TRUNCATED = 0x80000000
+
+class Profiler:
+	def __init__(self, emu, interval, buf_words = BUF_WORDS):
+		if interval < 1: raise ValueError('Profiling interval must be at least 1 instruction')
+		self.emu = emu
+		self.interval = interval
+		self.buf = (ctypes.c_uint32 * buf_words)()
+		# (truncated, call frame functions outermost first, CSR:PC) -> samples
+		self.stacks = collections.Counter()
+		self.samples = 0
+
+		c_config = emu.sim.c_config
+		c_config.prof_buf = self.buf
+		c_config.prof_cap = buf_words
+		c_config.prof_pos = 0
+		c_config.prof_interval = interval
+		c_config.prof_countdown = interval
+
+	# Called by Core.run_steps() when the sample buffer is full
+	def drain(self):
+		c_config = self.emu.sim.c_config
+		data = self.buf[:c_config.prof_pos]
+		c_config.prof_pos = 0
+
+		i = 0
+		while i < len(data):
+			n = data[i] & ~PROF_TRUNCATED
+			self.stacks[bool(data[i] & PROF_TRUNCATED), tuple(data[i+2:i+2+n]), data[i+1]] += 1
+			i += 2 + n
+			self.samples += 1
+
+	def close(self):
+		self.drain()
+		c_config = self.emu.sim.c_config
+		c_config.prof_buf = None
+		c_config.prof_cap = 0
+		c_config.prof_interval = 0
+
+	def name(self, addr):
+		label = self.emu.get_function_label(addr)
+		return f'{addr >> 16:X}:{addr & 0xffff:04X}H' if label is None else label
+
+	# Stacks with function names, outermost first, and their sample counts.
+	# The running function is named by its label if there is one, else by the
+	# innermost call frame, so functions entered through a jump (tail calls,
+	# interrupt handlers) are still told apart when labels are loaded.
+	def named_stacks(self):
+		names = collections.Counter()
+		for (truncated, frames, csrpc), count in self.stacks.items():
+			stack = ['...'] if truncated else []
+			stack.extend(self.name(func) for func in frames)
+			label = self.emu.get_function_label(csrpc)
+			if label is not None:
+				if not stack or stack[-1] != label: stack.append(label)
+			elif not frames: stack.append(self.name(csrpc))
+			names[tuple(stack)] += count
+		return names
+
+	# [(function, self samples, total samples)], most self samples first
+	def flat(self):
+		own = collections.Counter()
+		total = collections.Counter()
+		for stack, count in self.named_stacks().items():
+			own[stack[-1]] += count
+			for name in set(stack): total[name] += count
+		return sorted(((name, own[name], total[name]) for name in total), key = lambda x: (-x[1], -x[2], x[0]))
+
+	def write_flat(self, path):
+		samples = max(self.samples, 1)
+		with open(path, 'w') as f:
+			f.write(f'# {self.samples} samples, one every {self.interval} instructions\n')
+			f.write(f'{"self %":>7} {"self":>9} {"total %":>7} {"total":>9}  function\n')
+			for name, own, total in self.flat(): f.write(f'{own * 100 / samples:7.2f} {own:9} {total * 100 / samples:7.2f} {total:9}  {name}\n')
+
+	def write_folded(self, path):
+		with open(path, 'w') as f:
+			for stack, count in sorted(self.named_stacks().items()): f.write(f'{";".join(stack)} {count}\n')
+
+	# Writes the flat profile to path and the folded stacks next to it, with the extension .folded
+	def write(self, path):
+		self.write_flat(path)
+		self.write_folded(os.path.splitext(path)[0] + '.folded')
@@ -0,0 +1,186 @@
+# Rewind buffer
+#
+# A snapshot is taken every `interval` instructions and whenever the CPU goes
+# to sleep after running. Each one holds a save state without memory, plus the
+# old contents of the 256-byte pages of every memory region that changed since
+# the snapshot before it. A shadow copy of each region holds its contents as of
+# the latest snapshot, so finding changed pages is one memcmp per page, and
+# going back is undoing pages into the shadows, newest snapshot first, then
+# copying the shadows over the real memory.
+#
+# Everything that changes the machine from outside between native calls (key
+# presses and releases, timer 0 ticks given while in STOP mode) is logged with
+# the instruction count it happened at. Emulator.replay() feeds that log back,
+# so any instruction count since the oldest snapshot can be reached exactly by
+# restoring the snapshot before it and running forward.
+
+import time
+import zlib
+import ctypes
+import collections
+
+import savestate
+
+PAGE = 256
+# rough memory used by one logged event, counted against the budget
+EVENT_SIZE = 96
+
+class Region:
+	def __init__(self, addr, size):
+		self.addr = addr
+		self.size = size
+		npages = -(-size // PAGE)
+		self.shadow = (ctypes.c_uint8 * size)()
+		self.undo = (ctypes.c_uint8 * (npages * PAGE))()
+		self.pages = (ctypes.c_uint32 * npages)()
+
+	def reset(self): ctypes.memmove(self.shadow, self.addr, self.size)
+
+class Snapshot:
+	__slots__ = ('icount', 'seq', 'time', 'state', 'undo', 'size')
+
+	def __init__(self, icount, seq, state, undo):
+		self.icount = icount
+		self.seq = seq  # number of events logged before it
+		self.time = time.monotonic()
+		self.state = state
+		self.undo = undo  # (page count, old pages, page indices) per region, None if nothing changed
+		self.size = len(state) + self.undo_size()
+
+	def undo_size(self): return sum(len(u[1]) + len(u[2]) for u in self.undo if u is not None)
+
+class Rewind:
+	def __init__(self, emu, interval = 1000000, budget = 64 << 20):
+		self.emu = emu
+		self.interval = interval
+		self.budget = budget
+
+		self.regions = [Region(addr, size) for tag, addr, size in savestate.mem_sections(emu) if tag != b'CORE']
+		self.snapshots = collections.deque()
+		self.used = 0
+		self.started = False
+
+		# (instruction count, kind, argument), see Emulator.replay()
+		self.events = collections.deque()
+		self.events_base = 0  # sequence number of events[0]
+
+	def clear(self):
+		for r in self.regions: r.reset()
+		self.snapshots.clear()
+		self.used = 0
+		self.events.clear()
+		self.started = True
+		self.snapshot()
+
+	def log(self, kind, arg):
+		if not self.started: return
+		self.events.append((self.emu.sim.c_config.icount, kind, arg))
+		self.used += EVENT_SIZE
+		self.trim()
+
+	def checkpoint(self):
+		if not self.started: self.clear()
+		else: self.snapshot()
+
+	def snapshot(self):
+		sim = self.emu.sim
+		undo = []
+		for r in self.regions:
+			n = sim.diff_pages(r.addr, r.shadow, r.size, r.undo, r.pages)
+			undo.append((n, ctypes.string_at(r.undo, n * PAGE), ctypes.string_at(r.pages, n * 4)) if n else None)
+
+		# the oldest snapshot has nothing older to undo to
+		if not self.snapshots: undo = [None] * len(undo)
+		snap = Snapshot(sim.c_config.icount, self.events_base + len(self.events), zlib.compress(savestate.dump(self.emu, False), 1), undo)
+		self.snapshots.append(snap)
+		self.used += snap.size
+		self.trim()
+
+	# Drops the oldest snapshots, and the events before them, until the budget is kept
+	def trim(self):
+		while self.used > self.budget and len(self.snapshots) > 1:
+			self.used -= self.snapshots.popleft().size
+			oldest = self.snapshots[0]
+			self.used -= oldest.undo_size()
+			oldest.size -= oldest.undo_size()
+			oldest.undo = [None] * len(self.regions)
+			while self.events_base < oldest.seq:
+				self.events.popleft()
+				self.events_base += 1
+				self.used -= EVENT_SIZE
+
+	# Called after every run slice, idle is whether the CPU went to sleep
+	def update(self, idle = False):
+		if not self.started: self.clear()
+		elif self.emu.sim.c_config.icount - self.snapshots[-1].icount >= self.interval or (idle and self.emu.sim.c_config.icount != self.snapshots[-1].icount): self.snapshot()
+
+	# Go back to snapshots[idx], dropping every snapshot and event after it.
+	# Returns the dropped events.
+	def restore(self, idx):
+		if idx < 0: idx += len(self.snapshots)
+		if not 0 <= idx < len(self.snapshots): raise IndexError('No such snapshot')
+
+		sim = self.emu.sim
+		while len(self.snapshots) > idx + 1:
+			snap = self.snapshots.pop()
+			self.used -= snap.size
+			for r, u in zip(self.regions, snap.undo):
+				if u is not None: sim.undo_pages(r.shadow, r.size, u[1], u[2], u[0])
+
+		for r in self.regions: ctypes.memmove(r.addr, r.shadow, r.size)
+		snap = self.snapshots[idx]
+		savestate.load(self.emu, zlib.decompress(snap.state), False)
+		self.emu.state_loaded()
+
+		events = collections.deque()
+		while self.events_base + len(self.events) > snap.seq: events.appendleft(self.events.pop())
+		self.used -= len(events) * EVENT_SIZE
+		return events
+
+	# Index of the latest snapshot taken at or before instruction count icount, None if there is none
+	def find_icount(self, icount):
+		for i in range(len(self.snapshots) - 1, -1, -1):
+			if self.snapshots[i].icount <= icount: return i
+
+	# Go to the moment instruction count icount was first reached. Returns False
+	# if that is older than the oldest snapshot, leaving the emulator untouched.
+	def seek(self, icount):
+		idx = self.find_icount(icount) if self.started else None
+		if idx is None: return False
+		events = self.restore(idx)
+		self.emu.replay(icount, events)
+		return True
+
+	def step_back(self): return self.seek(self.emu.sim.c_config.icount - 1)
+
+	# Go back to the last breakpoint or watchpoint hit before the current
+	# instruction count. Scans the history one snapshot at a time, newest
+	# first. Returns False, ending up at the oldest snapshot, if none was hit.
+	def continue_back(self):
+		if not self.started: return False
+		now = end = self.emu.sim.c_config.icount
+		idx = self.find_icount(end - 1)
+		while idx is not None:
+			events = self.restore(idx)
+			hit = None
+			while self.emu.sim.c_config.icount < end:
+				if not self.emu.replay(end, events, True): break
+				if self.emu.sim.c_config.icount < now: hit = self.emu.sim.c_config.icount
+			if hit is not None: return self.seek(hit)
+
+			if idx == 0: break
+			end = self.snapshots[idx].icount
+			idx -= 1
+
+		self.restore(0)
+		return False
+
+	# Index of the latest snapshot at least `seconds` old, the oldest one if there is none
+	def find_seconds_ago(self, seconds):
+		t = time.monotonic() - seconds
+		for i in range(len(self.snapshots) - 1, -1, -1):
+			if self.snapshots[i].time <= t: return i
+		return 0
+
+	def rewind_seconds(self, seconds):
+		if self.started: self.restore(self.find_seconds_ago(seconds))
@@ -0,0 +1,158 @@
+# Save states
+#
+# A save state is a header followed by tagged sections:
+#   header   magic, format version (u16), hardware ID (u8), flags (u8), ROM SHA-256
+#   section  tag (4 bytes), length (u32), data
+# Memory and native run loop state are copied in bulk with ctypes.memmove(),
+# the Python side of the peripherals is packed with struct. Loaders skip
+# sections they don't know about and leave state from missing sections alone,
+# so new sections can be added without bumping the version.
+
+import ctypes
+import struct
+
+MAGIC = b'U8SS'
+VERSION = 2
+
+header = struct.Struct('<4sHBB32s')
+section = struct.Struct('<4sI')
+
+# c_config fields that change while running, the rest is set up by setup_mcu()
+config_fields = (
+	'flash_mode', 'icount', 'stop_mode', 'factory_test', 'tick_pending', 'int_timer', 'wdt_counter',
+	'kb_matrix', 'int_count', 'call_depth', 'call_top', 'call_lost', 'call_trace', 'branch_top', 'branch_count', 'branches', 'timer_ticks',
+)
+
+# shutdown_accept, shutdown, qr_active, screen_changed, curr_key, STOP acceptors,
+# WDT mode, timer 0 fraction, high screen select, TI MathPrint screen buffers
+periph_state = struct.Struct('<????i??bd?ii')
+
+bcd_fields = (
+	'data_operator', 'data_type_1', 'data_type_2', 'param1', 'param2', 'param3', 'data_a', 'data_b', 'data_c', 'data_d',
+	'f402_copy', 'param4', 'f405_copy', 'data_mode', 'f404_copy', 'data_repeat_flag',
+)
+bcd_state = struct.Struct('<' + 'q'*len(bcd_fields))
+
+def get_flags(emu):
+	c_config = emu.sim.c_config
+	return c_config.real_hw | c_config.ko_mode << 1 | c_config.is_5800p << 2
+
+def config_ranges(c_config):
+	base = ctypes.addressof(c_config)
+	return [(base + getattr(type(c_config), f).offset, getattr(type(c_config), f).size) for f in config_fields]
+
+# (tag, address, size) of everything copied straight out of native memory
+def mem_sections(emu):
+	sim = emu.sim
+	c_config = sim.c_config
+	sections = [
+		(b'CORE', ctypes.addressof(sim.core), type(sim.core).mem.offset),  # registers and flags, stops before the memory maps
+		(b'RAM ', ctypes.addressof(c_config.ram.contents), sim.ramsize),
+		(b'SFR ', ctypes.addressof(c_config.sfr.contents), 0x1000),
+	]
+	if c_config.emu_seg_size: sections.append((b'EMUS', ctypes.addressof(c_config.emu_seg.contents), c_config.emu_seg_size))
+	if sim.flash_length: sections.append((b'FLSH', ctypes.addressof(sim.flash_mem), ctypes.sizeof(sim.flash_mem)))
+	return sections
+
+# Returns the state of an Emulator as a bytearray. Without memory, only CORE
+# of the memory sections is included, for callers that keep memory themselves.
+def dump(emu, memory = True):
+	c_config = emu.sim.c_config
+	scr_bufs = emu.scr[3] if emu.config.hardware_id == 6 else (None, None)
+
+	parts = mem_sections(emu) if memory else mem_sections(emu)[:1]
+	parts.append((b'CONF', b''.join(ctypes.string_at(addr, size) for addr, size in config_ranges(c_config))))
+	parts.append((b'PERI', periph_state.pack(
+		emu.shutdown_accept, emu.shutdown, emu.qr_active, emu.screen_changed, emu.curr_key,
+		*emu.standby.stop_accept, -1 if emu.wdt.mode is None else emu.wdt.mode, emu.timer.passed_time, emu.disp.draw_hi_scr,
+		*(-1 if b is None else b for b in scr_bufs),
+	)))
+	parts.append((b'SCRN', b''.join(map(bytes, emu.disp.screen))))
+	if hasattr(emu, 'cwii_screen_hi'): parts.append((b'CWSC', b''.join(emu.cwii_screen_hi + emu.cwii_screen_lo)))
+	if hasattr(emu.sim, 'bcd'): parts.append((b'BCD ', bcd_state.pack(*(getattr(emu.sim.bcd, f) for f in bcd_fields))))
+
+	parts = [p if len(p) == 3 else (p[0], p[1], len(p[1])) for p in parts]
+	buf = bytearray(header.size + sum(section.size + p[2] for p in parts))
+	header.pack_into(buf, 0, MAGIC, VERSION, c_config.hwid, get_flags(emu), emu.rom_sha256)
+
+	base = ctypes.addressof(ctypes.c_char.from_buffer(buf))
+	pos = header.size
+	for tag, src, size in parts:
+		section.pack_into(buf, pos, tag, size)
+		pos += section.size
+		ctypes.memmove(base + pos, src, size)
+		pos += size
+
+	return buf
+
+# Restores a state returned by dump(). Raises ValueError, leaving the emulator
+# untouched, if the state is damaged or comes from another ROM or model.
+# memory has to match what the state was dumped with.
+def load(emu, data, memory = True):
+	mv = memoryview(data).cast('B')
+	if len(mv) < header.size: raise ValueError('Not a save state')
+	magic, version, hwid, flags, rom_sha256 = header.unpack_from(mv)
+	if magic != MAGIC: raise ValueError('Not a save state')
+	if version > VERSION: raise ValueError(f'Save state format version {version} is newer than this emulator supports')
+	# version 2 replaced the previous CSR:PC pair with the branch history
+	if version < VERSION: raise ValueError(f'Save state format version {version} is no longer supported')
+	if hwid != emu.sim.c_config.hwid or flags != get_flags(emu): raise ValueError('Save state is from a different hardware configuration')
+	if rom_sha256 != emu.rom_sha256: raise ValueError('Save state is from a different ROM')
+
+	sections = {}
+	pos = header.size
+	while pos < len(mv):
+		if pos + section.size > len(mv): raise ValueError('Save state is truncated')
+		tag, size = section.unpack_from(mv, pos)
+		pos += section.size
+		if pos + size > len(mv): raise ValueError('Save state is truncated')
+		sections[tag] = (pos, size)
+		pos += size
+
+	c_config = emu.sim.c_config
+	conf_ranges = config_ranges(c_config)
+	expected = {tag: size for tag, _, size in mem_sections(emu)}
+	expected[b'CONF'] = sum(size for _, size in conf_ranges)
+	expected[b'PERI'] = periph_state.size
+	expected[b'SCRN'] = sum(map(len, emu.disp.screen))
+	if hasattr(emu, 'cwii_screen_hi'): expected[b'CWSC'] = sum(map(len, emu.cwii_screen_hi + emu.cwii_screen_lo))
+	if hasattr(emu.sim, 'bcd'): expected[b'BCD '] = bcd_state.size
+	if not all(tag in sections for tag in ((b'CORE', b'RAM ', b'SFR ', b'CONF') if memory else (b'CORE', b'CONF'))): raise ValueError('Save state is incomplete')
+	for tag, (_, size) in sections.items():
+		if tag in expected and size != expected[tag]: raise ValueError(f'Save state section {tag.decode().strip()} has the wrong size')
+
+	raw = (ctypes.c_char * len(mv)).from_buffer_copy(mv) if mv.readonly else (ctypes.c_char * len(mv)).from_buffer(mv)
+	base = ctypes.addressof(raw)
+
+	for tag, dst, size in mem_sections(emu):
+		if tag in sections: ctypes.memmove(dst, base + sections[tag][0], size)
+
+	if b'CONF' in sections:
+		pos = base + sections[b'CONF'][0]
+		for dst, size in conf_ranges:
+			ctypes.memmove(dst, pos, size)
+			pos += size
+
+	if b'PERI' in sections:
+		state = periph_state.unpack_from(mv, sections[b'PERI'][0])
+		emu.shutdown_accept, emu.shutdown, emu.qr_active, emu.screen_changed, emu.curr_key = state[:5]
+		emu.standby.stop_accept = list(state[5:7])
+		emu.wdt.mode = None if state[7] < 0 else state[7]
+		emu.timer.passed_time = state[8]
+		emu.disp.draw_hi_scr = state[9]
+		if emu.config.hardware_id == 6: emu.scr[3][:] = [None if b < 0 else b for b in state[10:12]]
+
+	if b'SCRN' in sections:
+		pos = sections[b'SCRN'][0]
+		for row in emu.disp.screen:
+			row[:] = mv[pos:pos+len(row)]
+			pos += len(row)
+
+	if b'CWSC' in sections:
+		pos = sections[b'CWSC'][0]
+		for row in emu.cwii_screen_hi + emu.cwii_screen_lo:
+			row[:] = mv[pos:pos+len(row)]
+			pos += len(row)
+
+	if b'BCD ' in sections:
+		for f, v in zip(bcd_fields, bcd_state.unpack_from(mv, sections[b'BCD '][0])): setattr(emu.sim.bcd, f, type(getattr(emu.sim.bcd, f))(v))
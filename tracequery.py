@@ -0,0 +1,212 @@
+# Finds the instructions that wrote an address in an execution trace
+# written by exectrace, e.g. who last wrote 00:8E05H before instruction #N.
+#
+# The trace is streamed once to build an index next to it (<trace>.idx),
+# which is rebuilt whenever the trace changes. Queries are binary searches
+# in the index, so neither file is ever read whole.
+#
+# Index layout (native byte order):
+#   header   magic, version (u16), trace size (u64), trace mtime (u64, ns),
+#            address count (u64), write count (u64), padded to 64 bytes
+#   addrs    seg:addr of every address written (u32), ascending
+#   counts   writes to each address (u32)
+#   offsets  index of the first write of each address in icounts/csrpcs (u64)
+#   icounts  instruction counts of the writes, ascending per address (u64)
+#   csrpcs   CSR:PC of the writing instructions (u32)
+# A write of several bytes is indexed under each byte. Writes undone by a jump
+# back in the trace (rewinding, loading an older state) are left out.
+#
+# Usage: tracequery.py <trace> <seg:addr> [--before N] [-n count] [-c config]
+
+import os
+import mmap
+import array
+import bisect
+import struct
+import logging
+import argparse
+import tempfile
+
+import exectrace
+
+MAGIC = b'U8TI'
+VERSION = 1
+BUCKETS = 256  # temporary files the writes are spread over by address while indexing
+
+header = struct.Struct('<4sH2xQQQQ24x')
+entry = struct.Struct('<IIQI')  # seg:addr, trace segment, instruction count, CSR:PC
+
+def trace_id(path):
+	st = os.stat(path)
+	return st.st_size, st.st_mtime_ns
+
+# Streams the trace, spreading every byte written over the bucket files by
+# address. Returns the instruction count each trace segment after the first starts at.
+def scan(path, buckets, block = 1 << 16):
+	syncs = []
+	bufs = [bytearray() for _ in buckets]
+	icount = 0
+	segment = -1
+	unpack = struct.Struct('<IIII16x').iter_unpack
+
+	with open(path, 'rb') as f:
+		exectrace.read_header(f)
+		while True:
+			data = f.read(block * exectrace.RECORD_SIZE)
+			if not data: break
+			for csrpc, a, b, write in unpack(data[:len(data) - len(data) % exectrace.RECORD_SIZE]):
+				if csrpc >= exectrace.TRACE_SYNC:
+					if csrpc == exectrace.TRACE_SYNC:
+						icount = a | b << 32
+						if segment >= 0: syncs.append(icount)
+						segment += 1
+					continue
+
+				if write:
+					addr = write & 0xffffff
+					for i in range(write >> 24):
+						byte = addr & 0xff0000 | (addr + i) & 0xffff
+						bufs[byte % BUCKETS] += entry.pack(byte, segment, icount, csrpc)
+				icount += 1
+
+			for buf, bucket in zip(bufs, buckets):
+				if len(buf) >= 1 << 20:
+					bucket.write(buf)
+					del buf[:]
+
+	for buf, bucket in zip(bufs, buckets): bucket.write(buf)
+	return syncs
+
+def build_index(path, index_path):
+	logging.info(f'Indexing {path}')
+	size, mtime = trace_id(path)
+	with tempfile.TemporaryDirectory(dir = os.path.dirname(os.path.abspath(index_path))) as tmp:
+		buckets = [open(os.path.join(tmp, f'{i}.bin'), 'w+b') for i in range(BUCKETS)]
+		try:
+			syncs = scan(path, buckets)
+
+			# a write in segment k is undone if a later segment starts at or before it
+			cut = [float('inf')] * (len(syncs) + 1)
+			for k in range(len(syncs) - 1, -1, -1): cut[k] = min(cut[k + 1], syncs[k])
+
+			addrs, counts, offsets = array.array('I'), array.array('I'), array.array('Q')
+			nwrites = 0
+			with open(os.path.join(tmp, 'icounts.bin'), 'w+b') as icounts_f, open(os.path.join(tmp, 'csrpcs.bin'), 'w+b') as csrpcs_f:
+				table = []
+				for bucket in buckets:
+					bucket.seek(0)
+					writes = [e for e in entry.iter_unpack(bucket.read()) if e[2] < cut[e[1]]]
+					bucket.close()
+					# stable, so each address keeps trace order, which is instruction count order once undone writes are gone
+					writes.sort(key = lambda e: e[0])
+					start = 0
+					for i in range(1, len(writes) + 1):
+						if i == len(writes) or writes[i][0] != writes[start][0]:
+							table.append((writes[start][0], i - start, nwrites + start))
+							start = i
+					array.array('Q', (e[2] for e in writes)).tofile(icounts_f)
+					array.array('I', (e[3] for e in writes)).tofile(csrpcs_f)
+					nwrites += len(writes)
+
+				table.sort()
+				for addr, count, offset in table:
+					addrs.append(addr)
+					counts.append(count)
+					offsets.append(offset)
+
+				with open(index_path + '.tmp', 'wb') as f:
+					f.write(header.pack(MAGIC, VERSION, size, mtime, len(addrs), nwrites))
+					for a in (addrs, counts):
+						a.tofile(f)
+						if len(a) % 2: f.write(bytes(4))
+					offsets.tofile(f)
+					for src in (icounts_f, csrpcs_f):
+						src.seek(0)
+						while chunk := src.read(1 << 24): f.write(chunk)
+				os.replace(index_path + '.tmp', index_path)
+		finally:
+			for bucket in buckets: bucket.close()
+
+class Index:
+	def __init__(self, path, index_path = None):
+		self.index_path = path + '.idx' if index_path is None else index_path
+		if not self.up_to_date(path): build_index(path, self.index_path)
+
+		self.file = open(self.index_path, 'rb')
+		self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+		_, _, _, _, naddrs, nwrites = header.unpack_from(self.map)
+		mv = memoryview(self.map)
+		pos = header.size
+		pad = 4 * (naddrs % 2)
+		self.addrs = mv[pos:pos + 4*naddrs].cast('I')
+		pos += 4*naddrs + pad
+		self.counts = mv[pos:pos + 4*naddrs].cast('I')
+		pos += 4*naddrs + pad
+		self.offsets = mv[pos:pos + 8*naddrs].cast('Q')
+		pos += 8*naddrs
+		self.icounts = mv[pos:pos + 8*nwrites].cast('Q')
+		pos += 8*nwrites
+		self.csrpcs = mv[pos:pos + 4*nwrites].cast('I')
+
+	def up_to_date(self, path):
+		try:
+			with open(self.index_path, 'rb') as f: data = f.read(header.size)
+		except FileNotFoundError: return False
+		if len(data) < header.size: return False
+		magic, version, size, mtime, _, _ = header.unpack(data)
+		return magic == MAGIC and version == VERSION and (size, mtime) == trace_id(path)
+
+	def close(self):
+		for mv in (self.addrs, self.counts, self.offsets, self.icounts, self.csrpcs): mv.release()
+		self.map.close()
+		self.file.close()
+
+	# (instruction count, CSR:PC) of the last count writes to seg:addr addr
+	# before instruction count before (None = the end of the trace), latest first
+	def writes(self, addr, before = None, count = 1):
+		i = bisect.bisect_left(self.addrs, addr)
+		if i == len(self.addrs) or self.addrs[i] != addr: return []
+		start = self.offsets[i]
+		end = start + self.counts[i]
+		if before is not None: end = start + bisect.bisect_left(self.icounts[start:end], before)
+		return [(self.icounts[j], self.csrpcs[j]) for j in range(end - 1, max(start, end - count) - 1, -1)]
+
+	def last_write(self, addr, before = None):
+		w = self.writes(addr, before)
+		return w[0] if w else None
+
+# seg:addr as the GUI shows it, e.g. 00:8E05H or 8E05
+def parse_addr(s):
+	s = s.strip().rstrip('Hh')
+	seg, _, addr = s.rpartition(':')
+	return (int(seg, 16) if seg else 0) << 16 | int(addr, 16)
+
+if __name__ == '__main__':
+	logging.basicConfig(datefmt = '%d/%m/%Y %H:%M:%S', format = '[%(asctime)s] %(levelname)s: %(message)s', level = logging.INFO)
+
+	parser = argparse.ArgumentParser(description = 'Find the instructions that wrote an address in an execution trace')
+	parser.add_argument('trace', help = 'trace file written with --trace or Trace execution...')
+	parser.add_argument('addr', help = 'address as seg:addr, e.g. 00:8E05H')
+	parser.add_argument('--before', type = int, help = 'only writes before this instruction count (default: the end of the trace)')
+	parser.add_argument('-n', type = int, default = 1, help = 'number of writes to list, latest first (default: 1)')
+	parser.add_argument('-c', '--config', help = 'config script to take code labels from (default: config.py)')
+	args = parser.parse_args()
+
+	import emulator
+	labels = {}
+	cfg = emulator.load_config(args.config)
+	if hasattr(cfg, 'labels') and cfg.labels:
+		try: labels = emulator.load_labels(cfg.labels)[0]
+		except (ImportError, OSError) as e: logging.warning(f'Cannot load labels: {e}')
+
+	try: addr = parse_addr(args.addr)
+	except ValueError: parser.error(f'invalid address {args.addr!r}')
+
+	label_keys = sorted(labels)
+	index = Index(args.trace)
+	writes = index.writes(addr, args.before, args.n)
+	if not writes: print(f'{addr >> 16:02X}:{addr & 0xffff:04X}H was not written' + (f' before #{args.before}' if args.before is not None else ''))
+	for icount, csrpc in writes:
+		label = emulator.instruction_label(labels, csrpc, label_keys)
+		print(f'#{icount}  {csrpc >> 16:X}:{csrpc & 0xffff:04X}H{" ("+label+")" if label is not None else ""}')
+	index.close()